@@ -21,6 +21,13 @@ class EndType(ABC):
     def __init__(self,*args,**kwargs):
         pass
 
+    def checkpoint_state(self) -> dict:
+        """ A JSON serializable state, from which `restore_checkpoint_state` continues the session. """
+        return {}
+
+    def restore_checkpoint_state(self, state: dict):
+        pass
+
     @abstractmethod
     def did_end(self, session_room: SessionRoom) -> bool:
         """
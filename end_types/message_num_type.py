@@ -26,6 +26,12 @@ class EndTypeNumMsgs(EndType):
         self.max_num_msgs: int = max_num_msgs
         self.current_msg_num: int = start_iteration
 
+    def checkpoint_state(self) -> dict:
+        return {"current_msg_num": self.current_msg_num}
+
+    def restore_checkpoint_state(self, state: dict):
+        self.current_msg_num = state["current_msg_num"]
+
     def did_end(self, session_room: SessionRoom) -> bool:
 
         return session_room.session_length >= self.max_num_msgs
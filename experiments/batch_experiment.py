@@ -5,6 +5,7 @@ from typing import TYPE_CHECKING, Union
 from session_rooms import get_session_room
 from persons import get_person_class
 
+from persons.model_planner import plan_and_preload
 from persons.person import Person
 from persons.batch.batcher import AutoBatchPerson
 from .experiment import Experiment
@@ -35,6 +36,14 @@ class BatchExperiment(Experiment):
 
     @staticmethod
     def _load_persons(persons_list: list[dict]) -> list[BatchedPerson]:
+        # The models of all the persons load in parallel, while the persons are created, as planned to
+        # fit into the memory budget together.
+        def preload():
+            for p_dict in persons_list:
+                p_cls = get_person_class(p_dict.get("class"))
+                if p_cls is not None and issubclass(p_cls, (BatchedPerson, Person)):
+                    p_cls.preload_models(**p_dict)
+        plan_and_preload(preload)
         persons: list[BatchedPerson] = []
         for p_dict in persons_list:
             p_cls = get_person_class(p_dict.get("class"))
@@ -88,8 +97,8 @@ class BatchExperiment(Experiment):
         return super()._load_session_room(session_room, experiment)
 
     @classmethod
-    def load_from_string(cls, config_string: str) -> BatchExperiment:
-        loaded_exp: BatchExperiment = super().load_from_string(config_string)
+    def load_from_string(cls, config_string: str, configure_process: bool = True) -> BatchExperiment:
+        loaded_exp: BatchExperiment = super().load_from_string(config_string, configure_process)
         log.debug(f"Updating session room batch size to {loaded_exp.persons[0].batch_count}")
         loaded_exp.session_room.batch_size = loaded_exp.persons[0].batch_count
         return loaded_exp
@@ -3,6 +3,7 @@ This file describes the base experiment class
 """
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
 from typing import Dict, List, Optional, TYPE_CHECKING
@@ -13,6 +14,9 @@ from end_types import get_end_type_class
 import time
 from session_rooms import get_session_room
 from persons.batch.batch_person import BatchedPerson
+from persons.generation_engine import configure_generation_engine
+from persons.model_planner import configure_model_planner, plan_and_preload
+from persons.model_registry import configure_model_registry
 from persons.person import Person
 
 if TYPE_CHECKING:
@@ -64,6 +68,14 @@ class Experiment:
     @staticmethod
     def _load_persons(persons_list: List[Dict]) -> List[Person | BatchedPerson]:
         experiment_start_time = time.strftime("%H:%M:%S")
+        # The models of all the persons load in parallel, while the persons are created, as planned to
+        # fit into the memory budget together.
+        def preload():
+            for p_dict in persons_list:
+                p_cls = get_person_class(p_dict.get("class"))
+                if p_cls and issubclass(p_cls, Person):
+                    p_cls.preload_models(**p_dict)
+        plan_and_preload(preload)
         persons: List[Person] = []
         for p_dict in persons_list:
             p_cls = get_person_class(p_dict.get("class"))
@@ -109,11 +121,24 @@ class Experiment:
             raise TypeError("No scenario given")
         return Experiment(persons, session_room, host, end, scenario, survey_questions)
 
+    @staticmethod
+    def configure_process(exp_config: Dict):
+        """
+        Applies the process-wide settings of a configuration: the models (memory budget, preloading and
+        plan) and the generation engine, shared by all the experiments of the process.
+        """
+        # The models are loaded by the persons, under the memory budget of the configuration.
+        configure_model_registry(exp_config.get("models"))
+        configure_model_planner(exp_config.get("models"))
+        configure_generation_engine(exp_config.get("generation_engine"))
+
     @classmethod
-    def load_from_string(cls, config_string: str):
+    def load_from_string(cls, config_string: str, configure_process: bool = True):
         """
         Creates a new Experiment instance base on given string
         :param config_string: to parse
+        :param configure_process: whether to apply the process-wide settings of the configuration (see
+            `configure_process`), False if the caller applied them (e.g. for experiments run concurrently)
         :return: new Experiment instance
         """
         exp_config: Optional[Dict] = None
@@ -147,6 +172,8 @@ class Experiment:
         else:
             survey_questions = experiment_type_obj.get("survey_questions", [])
 
+        if configure_process:
+            cls.configure_process(exp_config)
         persons: List[Person] = cls._load_persons(persons_obj)
         session_room: SessionRoom = cls._load_session_room(session_room_obj, None)
         host: Host = cls._load_host(host_obj, persons)
@@ -165,6 +192,17 @@ class Experiment:
         assert self.session_room is not None
         return self.session_room.run(save_session_file_name)
 
+    async def arun(self, save_session_file_name: str = None) -> ExperimentOutput:
+        """
+        Coroutine version of `run`, allowing several experiments to share the same event loop.
+        Session rooms without an asynchronous loop are run in the default executor.
+        """
+        assert self.session_room is not None
+        if hasattr(self.session_room, "arun"):
+            return await self.session_room.arun(save_session_file_name)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.session_room.run, save_session_file_name)
+
     def export_file(self, path: str):
         """
         Export all the needed information of the experiment
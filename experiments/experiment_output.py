@@ -3,7 +3,7 @@ from __future__ import annotations
 import json
 
 from typing import TYPE_CHECKING
-from dataclasses import dataclass,asdict,field
+from dataclasses import dataclass,field
 
 if TYPE_CHECKING:
     from experiments.survey_question import SurveyQuestion
@@ -16,7 +16,8 @@ class ExperimentOutput:
     survey_question: list['SurveyQuestion'] = field(default_factory=list)
 
     def __json__(self):
-        return asdict(self)
+        # Not `asdict`, which deep copies every entry (and the history of its lazy prompt).
+        return {"chat_entry": self.chat_entry, "survey_question": self.survey_question}
     
     @classmethod
     def from_json(cls,source:dict | str):
@@ -0,0 +1,168 @@
+"""
+This file contains a streaming sink for the experiment output.
+
+Instead of keeping the output in memory and dumping it once the experiment is done, the sink
+writes every `ChatEntry` and every survey answer as a single JSON line, as soon as it is produced.
+A crash in the middle of an experiment keeps everything that was generated before it.
+
+Batch experiments write one file (shard) per batch room.
+Such a file is read back lazily, one record at a time (`iter_chat_entries`, `iter_survey_questions`),
+or into memory as a whole `ExperimentOutput` (`load_experiment_output`).
+"""
+from __future__ import annotations
+
+import json
+import threading
+from pathlib import Path
+from typing import IO, Iterator, Union
+
+# `json_fix` should not be removed it enables the __json__ to be the handler for json.dump & json.dumps
+import json_fix
+
+from experiments.experiment_output import ExperimentOutput
+from experiments.survey_question import SurveyQuestion
+from session_rooms.ChatEntry import ChatEntry
+
+CHAT_ENTRY_RECORD = "chat_entry"
+SURVEY_QUESTION_RECORD = "survey_question"
+SURVEY_ANSWER_RECORD = "survey_answer"
+
+
+def chat_entry_to_json(chat_entry: ChatEntry) -> dict:
+    """ The JSON form of a chat entry, the same as in the JSON output of the experiment. """
+    return chat_entry.__json__()
+
+
+class JsonlOutputSink:
+    """
+    Writes the experiment output as JSON lines while the experiment is running.
+
+    :param path: the file to write into. When `shards` > 1, shard `i` is written into
+        `<stem>.room<i><suffix>` next to it.
+    :param shards: the number of separate output files (one per batch room).
+    :param append: whether to append to existing files (e.g. when resuming), instead of overwriting.
+    """
+
+    def __init__(self, path: Union[str, Path], shards: int = 1, append: bool = False):
+        self.path = Path(path)
+        self.shards = shards
+        self.append = append
+        self._files: dict[int, IO[str]] = {}
+        self._lock = threading.Lock()
+
+    def shard_path(self, shard: int) -> Path:
+        if self.shards <= 1:
+            return self.path
+        return self.path.with_name(f"{self.path.stem}.room{shard}{self.path.suffix}")
+
+    def write_chat_entry(self, chat_entry: ChatEntry, shard: int = 0):
+        self._write(shard, {"record": CHAT_ENTRY_RECORD, "chat_entry": chat_entry_to_json(chat_entry)})
+
+    def write_survey_question(self, survey_question: SurveyQuestion, shard: int = 0):
+        self._write(shard, {
+            "record": SURVEY_QUESTION_RECORD,
+            "question_id": survey_question.question_id,
+            "question_content": survey_question.question_content,
+            "iteration": survey_question.iteration,
+        })
+
+    def write_survey_answer(self, survey_question: SurveyQuestion, chat_entry: ChatEntry,
+                            shard: int = 0):
+        self._write(shard, {
+            "record": SURVEY_ANSWER_RECORD,
+            "question_id": survey_question.question_id,
+            "chat_entry": chat_entry_to_json(chat_entry),
+        })
+
+    def close(self):
+        with self._lock:
+            for file in self._files.values():
+                file.close()
+            self._files.clear()
+
+    def __enter__(self) -> JsonlOutputSink:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _write(self, shard: int, record: dict):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            file = self._files.get(shard)
+            if file is None:
+                shard_path = self.shard_path(shard)
+                shard_path.parent.mkdir(parents=True, exist_ok=True)
+                file = self._files[shard] = open(shard_path, "a" if self.append else "w",
+                                                     encoding="utf-8")
+            file.write(line)
+            # Every record is flushed, so it survives a crash of the experiment.
+            file.flush()
+
+
+def iter_records(path: Union[str, Path]) -> Iterator[dict]:
+    """ Lazily yields the records of a JSON lines output file. A truncated last line is skipped. """
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # The experiment crashed while writing this line.
+                break
+
+
+def iter_chat_entries(path: Union[str, Path]) -> Iterator[ChatEntry]:
+    """ Lazily yields the chat entries (without the survey answers) of a JSON lines output file. """
+    for record in iter_records(path):
+        if record.get("record") == CHAT_ENTRY_RECORD:
+            yield _chat_entry_from_json(record["chat_entry"])
+
+
+def iter_survey_questions(path: Union[str, Path]) -> Iterator[SurveyQuestion]:
+    """
+    Lazily yields the survey questions of a JSON lines output file, each one with its answers (so
+    only the answers of a single question are in memory at a time).
+    """
+    survey_question = None
+    for record in iter_records(path):
+        kind = record.get("record")
+        if kind == SURVEY_QUESTION_RECORD:
+            if survey_question is not None:
+                yield survey_question
+            survey_question = SurveyQuestion(
+                question_id=record["question_id"],
+                question_content=record["question_content"],
+                iteration=record["iteration"],
+                chat_entry=[])
+        elif kind == SURVEY_ANSWER_RECORD and survey_question is not None:
+            survey_question.chat_entry.append(_chat_entry_from_json(record["chat_entry"]))
+    if survey_question is not None:
+        yield survey_question
+
+
+def load_experiment_output(path: Union[str, Path]) -> ExperimentOutput:
+    """
+    Rebuilds the `ExperimentOutput` written into `path` by a `JsonlOutputSink`, with all of its records
+    in memory (`iter_chat_entries` and `iter_survey_questions` read the file lazily instead).
+    The entity of each rebuilt `ChatEntry` is the JSON form of the original entity (a dict).
+    """
+    output = ExperimentOutput()
+    for record in iter_records(path):
+        kind = record.get("record")
+        if kind == CHAT_ENTRY_RECORD:
+            output.chat_entry.append(_chat_entry_from_json(record["chat_entry"]))
+        elif kind == SURVEY_QUESTION_RECORD:
+            output.survey_question.append(SurveyQuestion(
+                question_id=record["question_id"],
+                question_content=record["question_content"],
+                iteration=record["iteration"],
+                chat_entry=[]))
+        elif kind == SURVEY_ANSWER_RECORD and output.survey_question:
+            output.survey_question[-1].chat_entry.append(_chat_entry_from_json(record["chat_entry"]))
+    return output
+
+
+def _chat_entry_from_json(chat_entry: dict) -> ChatEntry:
+    return ChatEntry(**chat_entry)
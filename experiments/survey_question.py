@@ -1,6 +1,6 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 
 if TYPE_CHECKING:
     from session_rooms.ChatEntry import ChatEntry
@@ -13,3 +13,6 @@ class SurveyQuestion:
     iteration:int
     chat_entry:list[ChatEntry]
 
+    def __json__(self):
+        return {field.name: getattr(self, field.name) for field in fields(self)}
+
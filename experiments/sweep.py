@@ -0,0 +1,280 @@
+"""
+This file contains a runner for sweeps over many experiment configurations.
+
+A sweep is a list of configurations, given as files, directories or glob patterns, optionally
+expanded by a parameter grid: a JSON object mapping a dotted path inside the configuration to the
+list of values it should take, e.g.
+    {"endType.max_num_msgs": [6, 12], "persons.0.background_story": ["...", "..."]}
+Every base configuration is run once for each combination of the grid values.
+
+The configurations are run on a pool of worker processes. Configurations that load the same
+models are sent to the same worker, and each worker runs its configurations one after another,
+so the model caches of the persons load the weights only once per worker. A worker may also run
+several configurations at once, on threads, so with the generation engine enabled their
+generations share the forward passes of their models (see `persons.generation_engine`), as long as
+they share the same model and generation engine settings, which are process-wide. On hosts
+without a GPU, the workers may be pinned to disjoint sets of cores, so their models don't compete for
+the same cores (see `persons.inference_backend`).
+"""
+from __future__ import annotations
+
+import copy
+import glob
+import itertools
+import json
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from queue import Empty
+from typing import Any, Dict, List, Optional
+
+# `json_fix` should not be removed it enables the __json__ to be the handler for json.dump & json.dumps
+import json_fix
+
+log = logging.getLogger(__name__)
+
+SUMMARY_FILE_NAME = "sweep_summary.json"
+# The keys of a person configuration that choose the models it loads (see the `preload_models` of the persons),
+# and where they are loaded.
+_MODEL_KEYS = ("model_path", "model_name", "generation_model_name", "scheduling_model_name", "adapter_path",
+               "adapter_paths", "adapters", "draft_model_path", "draft_model_name", "backend")
+# The keys of a configuration with process-wide settings (see `Experiment.configure_process`).
+_PROCESS_KEYS = ("models", "generation_engine")
+
+
+@dataclass
+class SweepConfig:
+    """ A single configuration of the sweep. """
+    name: str
+    source: str
+    config: Dict[str, Any]
+    grid_values: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class SweepResult:
+    name: str
+    source: str
+    grid_values: Dict[str, Any]
+    output: Optional[str]
+    succeeded: bool
+    seconds: float
+    chat_entries: int = 0
+    error: Optional[str] = None
+
+
+def collect_config_paths(patterns: List[str]) -> List[Path]:
+    """ Expands files, directories (all the `.json` files in them) and glob patterns into config files. """
+    paths: List[Path] = []
+    for pattern in patterns:
+        path = Path(pattern)
+        if path.is_dir():
+            paths.extend(sorted(path.glob("*.json")))
+        elif path.is_file():
+            paths.append(path)
+        else:
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                raise FileNotFoundError(f"No configuration matches {pattern}")
+            paths.extend(Path(match) for match in matches)
+    # The same file may be matched by several patterns.
+    return list(dict.fromkeys(paths))
+
+
+def grid_combinations(grid: Optional[Dict[str, list]]) -> List[Dict[str, Any]]:
+    """ Returns every combination of the values in `grid`, as a mapping from dotted path to value. """
+    if not grid:
+        return [{}]
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def set_config_value(config: Dict[str, Any], dotted_path: str, value: Any):
+    """ Sets `value` at `dotted_path` (e.g. `persons.0.name`) inside `config`. """
+    *parents, last = dotted_path.split(".")
+    node = config
+    for key in parents:
+        node = node[int(key)] if isinstance(node, list) else node.setdefault(key, {})
+    if isinstance(node, list):
+        node[int(last)] = value
+    else:
+        node[last] = value
+
+
+def load_sweep_configs(patterns: List[str], grid: Optional[Dict[str, list]] = None) -> List[SweepConfig]:
+    configs: List[SweepConfig] = []
+    for path in collect_config_paths(patterns):
+        with open(path, "r") as file:
+            base_config = json.load(file)
+        combinations = grid_combinations(grid)
+        for i, grid_values in enumerate(combinations):
+            config = copy.deepcopy(base_config)
+            for dotted_path, value in grid_values.items():
+                set_config_value(config, dotted_path, value)
+            name = path.stem if len(combinations) == 1 else f"{path.stem}__{i}"
+            configs.append(SweepConfig(name, str(path), config, grid_values))
+    # Names must be unique, as they name the output files.
+    seen: Dict[str, int] = {}
+    for sweep_config in configs:
+        count = seen.get(sweep_config.name, 0)
+        seen[sweep_config.name] = count + 1
+        if count:
+            sweep_config.name = f"{sweep_config.name}__{count}"
+    return configs
+
+
+def model_key(config: Dict[str, Any]) -> tuple:
+    """ Identifies the models loaded by a configuration: the class of each person and its model keys. """
+    models = set()
+    for person in config.get("persons", []):
+        models.add((person.get("class"),) + tuple(
+            json.dumps(person.get(key), sort_keys=True) for key in _MODEL_KEYS))
+    return tuple(sorted(models, key=str))
+
+
+def assign_workers(configs: List[SweepConfig], workers: int) -> List[List[SweepConfig]]:
+    """
+    Splits the configurations between `workers` workers. All the configurations with the same
+    `model_key` go to the same worker, and the largest groups are placed first on the least busy worker.
+    """
+    groups: Dict[tuple, List[SweepConfig]] = {}
+    for sweep_config in configs:
+        groups.setdefault(model_key(sweep_config.config), []).append(sweep_config)
+    buckets: List[List[SweepConfig]] = [[] for _ in range(max(1, min(workers, len(groups))))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(buckets, key=len).extend(group)
+    return [bucket for bucket in buckets if bucket]
+
+
+def run_sweep(configs: List[SweepConfig], output_dir: str, workers: int = 1,
+              batch_mode: bool = False, sessions_per_worker: int = 1,
+              pin_workers: bool = False) -> List[SweepResult]:
+    """
+    Runs all `configs` on `workers` processes, each running up to `sessions_per_worker` of them at
+    once (pinned to its own share of the cores, if `pin_workers`), writes the output of each one of
+    them into `output_dir/<name>.json`, and a summary of the sweep into `output_dir/sweep_summary.json`.
+    """
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+    buckets = assign_workers(configs, workers)
+    log.info(f"Running {len(configs)} configurations on {len(buckets)} workers")
+    worker_cores = [None] * len(buckets)
+    if pin_workers:
+        # Imported here, so the main process doesn't load the persons (and their dependencies).
+        from persons.inference_backend import split_cores
+        worker_cores = split_cores(len(buckets))
+        log.info(f"Pinning the workers to the cores {worker_cores}")
+
+    start = time.perf_counter()
+    results: List[SweepResult] = []
+    # Spawned workers don't inherit CUDA state from the parent process.
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager, \
+            ProcessPoolExecutor(max_workers=len(buckets), mp_context=context) as pool:
+        progress = manager.Queue()
+        futures = [pool.submit(_run_bucket, bucket, str(output_path), batch_mode, progress, sessions_per_worker,
+                               cores)
+                   for bucket, cores in zip(buckets, worker_cores)]
+        while len(results) < len(configs):
+            try:
+                result: SweepResult = progress.get(timeout=1)
+            except Empty:
+                if all(future.done() for future in futures):
+                    # A worker died without reporting all of its configurations.
+                    break
+                continue
+            results.append(result)
+            status = "done" if result.succeeded else f"failed ({result.error})"
+            log.info(f"[{len(results)}/{len(configs)}] {result.name} {status} in {result.seconds:.1f}s")
+        for future in futures:
+            if future.exception() is not None:
+                log.error(f"A sweep worker crashed: {future.exception()!r}")
+    elapsed = time.perf_counter() - start
+
+    summary = summarize(results, elapsed)
+    log.info(format_summary(summary))
+    with open(output_path / SUMMARY_FILE_NAME, "w") as file:
+        json.dump({"summary": summary, "results": [asdict(result) for result in results]}, file, indent=4)
+    return results
+
+
+def summarize(results: List[SweepResult], elapsed: float) -> Dict[str, Any]:
+    succeeded = [result for result in results if result.succeeded]
+    chat_entries = sum(result.chat_entries for result in succeeded)
+    return {
+        "configs": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "seconds": elapsed,
+        "configs_per_minute": 60 * len(succeeded) / elapsed if elapsed else 0.0,
+        "chat_entries": chat_entries,
+        "chat_entries_per_second": chat_entries / elapsed if elapsed else 0.0,
+    }
+
+
+def format_summary(summary: Dict[str, Any]) -> str:
+    return (f"Sweep done: {summary['succeeded']}/{summary['configs']} configurations succeeded "
+            f"({summary['failed']} failed) in {summary['seconds']:.1f}s, "
+            f"{summary['configs_per_minute']:.2f} configurations/min, "
+            f"{summary['chat_entries_per_second']:.2f} chat entries/s")
+
+
+def _run_bucket(bucket: List[SweepConfig], output_dir: str, batch_mode: bool, progress,
+                sessions_per_worker: int = 1, cores: Optional[tuple] = None) -> None:
+    """ Runs the configurations of a single worker, `sessions_per_worker` at a time, on `cores` (if any). """
+    if cores:
+        from persons.inference_backend import configure_threads
+        configure_threads(cpu_cores=cores)
+    if sessions_per_worker <= 1:
+        for sweep_config in bucket:
+            progress.put(_run_config(sweep_config, output_dir, batch_mode))
+        return
+    # Imported here, so the main process doesn't load the persons (and their dependencies).
+    from experiments.experiment import Experiment
+    # The process-wide settings are shared by the configurations running at once, so only the
+    # configurations with the same settings run together, after applying these settings once.
+    groups: Dict[tuple, List[SweepConfig]] = {}
+    for sweep_config in bucket:
+        groups.setdefault(process_settings(sweep_config.config), []).append(sweep_config)
+    if len(groups) > 1:
+        log.info(f"Running {len(bucket)} configurations in {len(groups)} groups with different model or "
+                 f"generation engine settings")
+    for group in groups.values():
+        Experiment.configure_process(group[0].config)
+        with ThreadPoolExecutor(max_workers=sessions_per_worker) as sessions:
+            for result in sessions.map(
+                    lambda sweep_config: _run_config(sweep_config, output_dir, batch_mode, configure_process=False),
+                    group):
+                progress.put(result)
+
+
+def process_settings(config: Dict[str, Any]) -> tuple:
+    """ Identifies the process-wide settings of a configuration (see `_PROCESS_KEYS`). """
+    return tuple(json.dumps(config.get(key), sort_keys=True) for key in _PROCESS_KEYS)
+
+
+def _run_config(sweep_config: SweepConfig, output_dir: str, batch_mode: bool,
+                configure_process: bool = True) -> SweepResult:
+    # Imported here, so the main process doesn't load the persons (and their dependencies).
+    from experiments.batch_experiment import BatchExperiment
+    from experiments.experiment import Experiment
+
+    start = time.perf_counter()
+    output_file = Path(output_dir) / f"{sweep_config.name}.json"
+    try:
+        experiment_cls = BatchExperiment if batch_mode else Experiment
+        experiment = experiment_cls.load_from_string(json.dumps(sweep_config.config), configure_process)
+        experiment_output = experiment.run()
+        with open(output_file, "w") as file:
+            json.dump(experiment_output, file, indent=4)
+        outputs = experiment_output if isinstance(experiment_output, list) else [experiment_output]
+        chat_entries = sum(len(output.chat_entry) for output in outputs)
+    except Exception as e:
+        log.exception(f"Configuration {sweep_config.name} failed")
+        return SweepResult(sweep_config.name, sweep_config.source, sweep_config.grid_values, None, False,
+                           time.perf_counter() - start, error=repr(e))
+    return SweepResult(sweep_config.name, sweep_config.source, sweep_config.grid_values, str(output_file),
+                       True, time.perf_counter() - start, chat_entries)
@@ -19,6 +19,13 @@ class Host(ABC):
         self.persons: List[Person|BatchedPerson] = persons
         self.current_person = self.persons[start_person_index]
 
+    def checkpoint_state(self) -> dict:
+        """ A JSON serializable state, from which `restore_checkpoint_state` continues the session. """
+        return {"current_person_index": self.persons.index(self.current_person)}
+
+    def restore_checkpoint_state(self, state: dict):
+        self.current_person = self.persons[state["current_person_index"]]
+
     @abstractmethod
     def get_curr_person_and_move_to_next(self) -> Person|BatchedPerson:
         raise NotImplementedError("This function not implemented")
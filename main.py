@@ -12,7 +12,11 @@ import json_fix
 
 from experiments.batch_experiment import BatchExperiment
 from experiments.experiment import Experiment
+from experiments.output_sink import JsonlOutputSink
+from experiments.sweep import load_sweep_configs, run_sweep
+from persons.model_registry import get_model_registry
 from experiments.loggers.logger import ConsoleHandler, CsvFileHandler, OurLogger
+from session_rooms.checkpoint import CheckpointLog
 
 
 def __init_logging_system(
@@ -63,7 +67,9 @@ def _arguments_parsing():
     parser.add_argument(
         "config",
         type=argparse.FileType(),
-        help="what config to run"
+        nargs="?",
+        default=None,
+        help="what config to run (the base config of the grid in sweep mode)"
     )
     parser.add_argument(
         "-o",
@@ -72,6 +78,30 @@ def _arguments_parsing():
         default=str(Path("./output_files/out.json")),
         help="Where to save the experiment output"
     )
+    parser.add_argument(
+        "--stream-output",
+        dest="stream_output",
+        type=str,
+        required=False,
+        default=None,
+        help="JSON lines file where each chat entry and survey answer is written as soon as it is "
+             "generated (one file per room in batch mode)"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        dest="checkpoint",
+        type=str,
+        required=False,
+        default=None,
+        help="JSON lines file where the progress of the session is appended after every turn "
+             "(without the models), so it can be continued with --resume"
+    )
+    parser.add_argument(
+        "--resume",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Continue the session recorded in the --checkpoint file instead of starting a new one"
+    )
     parser.add_argument(
         "--json",
         action=argparse.BooleanOptionalAction,
@@ -119,6 +149,48 @@ def _arguments_parsing():
         default=True,
         help="Prints the results in pretty json format with indentation"
     )
+    parser.add_argument(
+        "--sweep",
+        nargs="+",
+        default=None,
+        help="Sweep mode: config files, directories of configs or glob patterns to run"
+    )
+    parser.add_argument(
+        "--grid",
+        type=argparse.FileType(),
+        default=None,
+        help="Sweep mode: JSON file mapping dotted config paths (e.g. endType.max_num_msgs) to lists "
+             "of values. Each config is run once for every combination"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Sweep mode: number of worker processes. Configs using the same models run on the same worker"
+    )
+    parser.add_argument(
+        "--sessions-per-worker",
+        dest="sessions_per_worker",
+        type=int,
+        default=1,
+        help="Sweep mode: number of configs each worker runs concurrently. With the generation engine enabled, "
+             "their generations are batched together"
+    )
+    parser.add_argument(
+        "--pin-workers",
+        dest="pin_workers",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Sweep mode: pin each worker to its own share of the CPU cores (with one PyTorch thread per core), "
+             "so the models of the workers don't compete for the same cores"
+    )
+    parser.add_argument(
+        "--sweep-output-dir",
+        dest="sweep_output_dir",
+        type=str,
+        default=str(Path(".") / "output_files" / "sweep"),
+        help="Sweep mode: directory for the output of each config and the sweep summary"
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -136,6 +208,19 @@ if __name__ == '__main__':
         json_df_path=arguments.out_json,
         level=logging.DEBUG if arguments.verbose else logging.INFO
     )
+    if arguments.sweep or arguments.grid:
+        patterns = arguments.sweep or ([arguments.config.name] if arguments.config else [])
+        if not patterns:
+            logger.error("Sweep mode requires --sweep configs or a base config")
+            exit(-1)
+        grid = json.load(arguments.grid) if arguments.grid else None
+        sweep_configs = load_sweep_configs(patterns, grid)
+        results = run_sweep(sweep_configs, arguments.sweep_output_dir, arguments.workers,
+                            arguments.batch_mode, arguments.sessions_per_worker, arguments.pin_workers)
+        exit(0 if all(result.succeeded for result in results) else 1)
+    if arguments.config is None:
+        logger.error("No config given")
+        exit(-1)
     # conf_path = "./test/test_config.json"
     logger.info(f"open config from {arguments.config.name}")
     # with open(conf_path, 'r') as file:
@@ -149,12 +234,30 @@ if __name__ == '__main__':
     except Exception:
         logger.exception("Unable to load experiment")
         exit(-1)
+    if arguments.stream_output:
+        shards = exp.session_room.batch_size if arguments.batch_mode else 1
+        exp.session_room.output_sink = JsonlOutputSink(arguments.stream_output, shards=shards)
+    if arguments.resume and not arguments.checkpoint:
+        logger.error("--resume requires a --checkpoint file")
+        exit(-1)
+    if arguments.checkpoint:
+        resume = arguments.resume and Path(arguments.checkpoint).exists()
+        if resume:
+            logger.info(f"resuming from checkpoint {arguments.checkpoint}")
+            exp.session_room.restore_from_checkpoint(arguments.checkpoint)
+        exp.session_room.checkpoint = CheckpointLog(arguments.checkpoint, append=resume)
     logger.info("running experiment")
     experiment_output = None
     try:
         experiment_output = exp.run()
     except Exception:
         logger.exception("Unhandled exception while running experiment")
+    finally:
+        if exp.session_room.output_sink is not None:
+            exp.session_room.output_sink.close()
+        if exp.session_room.checkpoint is not None:
+            exp.session_room.checkpoint.close()
+    get_model_registry().log_report()
     if experiment_output:
         pp_dict = {"indent": 4} if arguments.pp else {}
         json.dump(experiment_output, arguments.output, **pp_dict)
@@ -0,0 +1,107 @@
+"""
+This file contains the assisted (speculative) decoding of the persons which run a local HuggingFace model.
+
+The answers of the persons are short and predictable, so a small draft model of the same family
+(sharing the tokenizer of the person's model) usually guesses most of their tokens. With assisted
+generation (`model.generate(assistant_model=...)`), the draft model proposes a few tokens, and the
+person's model checks all of them in a single forward pass, keeping the longest accepted prefix and
+the token after it. The answer is the same as without the draft model (for greedy decoding), in fewer
+forward passes of the large model.
+
+Whether it pays off depends on how often the guesses of the draft model are accepted, which varies
+between personas. `AssistedDecodingStats` keeps the acceptance rate of each person, and logs it every
+few generations. The proposed and accepted tokens are counted from the forward passes of both models
+during the generation: each forward pass of the draft model proposes one token, and each forward pass
+of the person's model accepts some of them and adds one token of its own.
+
+Assisted generation runs a single prompt at a time, so persons with a draft model don't join batched
+generations. Persons read the draft model from the "draft_model_path" key of their configuration
+("draft_model_name" for inner scheduler persons, whose draft model assists their generation model).
+"""
+from __future__ import annotations
+
+import logging
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Iterator
+
+log = logging.getLogger(__name__)
+
+# How many generations of a person pass between the logs of its statistics.
+LOG_INTERVAL = 10
+
+
+@dataclass
+class AssistedDecodingStats:
+    """ The statistics of the assisted generations of a single person. """
+    name: str
+    generations: int = 0
+    new_tokens: int = 0
+    # The forward passes of the person's model, and the tokens proposed by the draft model.
+    target_forwards: int = 0
+    draft_tokens: int = 0
+
+    @property
+    def accepted_tokens(self) -> int:
+        return max(self.new_tokens - self.target_forwards, 0)
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted_tokens / self.draft_tokens if self.draft_tokens else 0.0
+
+    @property
+    def tokens_per_forward(self) -> float:
+        """ The new tokens per forward pass of the person's model (1 without a draft model). """
+        return self.new_tokens / self.target_forwards if self.target_forwards else 0.0
+
+    def add(self, new_tokens: int, target_forwards: int, draft_tokens: int):
+        self.generations += 1
+        self.new_tokens += new_tokens
+        self.target_forwards += target_forwards
+        self.draft_tokens += draft_tokens
+        log.debug(f"Assisted generation of {self.name}: {new_tokens} tokens in {target_forwards} forward passes, "
+                  f"{draft_tokens} draft tokens")
+        if self.generations % LOG_INTERVAL == 0:
+            log.info(self)
+
+    def __str__(self) -> str:
+        return (f"Assisted decoding of {self.name}: {self.acceptance_rate:.1%} of {self.draft_tokens} draft tokens "
+                f"accepted, {self.tokens_per_forward:.2f} tokens per forward pass ({self.generations} generations)")
+
+
+@contextmanager
+def count_forwards(model: Any) -> Iterator[list[int]]:
+    """
+    Counts the forward passes of `model` made by the current thread, as the single item of the
+    yielded list. Other threads may use the (shared) model meanwhile.
+    """
+    count = [0]
+    thread = threading.get_ident()
+
+    def hook(module, inputs):
+        if threading.get_ident() == thread:
+            count[0] += 1
+
+    # Every forward pass of a causal LM embeds its input ids once, whatever wraps the model.
+    handle = model.get_input_embeddings().register_forward_pre_hook(hook)
+    try:
+        yield count
+    finally:
+        handle.remove()
+
+
+def assisted_generate(model: Any, draft_model: Any, stats: AssistedDecodingStats, input_ids: Any, **kwargs) -> Any:
+    """
+    `model.generate` for `input_ids` (a batch of a single prompt), assisted by `draft_model`, which
+    updates `stats`. The other keyword arguments are passed to `generate`.
+    """
+    # A lazy handle (see `persons.model_registry`) is resolved, as `generate` checks the type of its assistant.
+    draft_model = draft_model.resolve() if hasattr(draft_model, "resolve") else draft_model
+    if model.get_input_embeddings() is draft_model.get_input_embeddings():
+        raise ValueError("The draft model must be a different (smaller) model than the assisted model")
+    with count_forwards(model) as target_forwards, count_forwards(draft_model) as draft_forwards:
+        outputs = model.generate(input_ids=input_ids, assistant_model=draft_model, **kwargs)
+    sequences = outputs.sequences if hasattr(outputs, "sequences") else outputs
+    stats.add(sequences.shape[1] - input_ids.shape[1], target_forwards[0], draft_forwards[0])
+    return outputs
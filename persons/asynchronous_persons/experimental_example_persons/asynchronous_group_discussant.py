@@ -1,7 +1,8 @@
 import time
-from typing import Union, List
+from typing import Optional, Tuple, Union, List
 from persons.asynchronous_persons.inner_scheduler_asynchronous_person import \
-    InnerSchedulerAsynchronousPerson
+    InnerSchedulerAsynchronousPerson, LOGITS_DECISION
+from persons.prompt_builder import IncrementalPromptBuilder
 from session_rooms.session_room import ChatEntry
 import logging
 
@@ -29,6 +30,7 @@ class AsynchronousGroupDiscussant(InnerSchedulerAsynchronousPerson):
         self.in_context_learning = in_context_learning
         self.pass_turn_token = pass_turn_token
         self.use_turn_token = use_turn_token
+        self._prompt_builder = IncrementalPromptBuilder(self._render_chat_entry)
 
     def _get_prompt_template(self, model_name: str) -> str:  # TODO make static or extract to `person` utils
         model_name = model_name.lower()
@@ -60,22 +62,29 @@ class AsynchronousGroupDiscussant(InnerSchedulerAsynchronousPerson):
 
     def _create_prompt_skeleton(self, experiment_scenario: str, chat_list: List[ChatEntry],
                                 task: str) -> str:
-        prompt = f"Your name is {self.name}. {self.background_story}\n" \
-                 f"{experiment_scenario}\n{self.opinion}\n" \
-                 f"The chat room was opened for discussion at [{self.experiment_start_time}].\n"
+        prompt = self._prompt_builder.header(
+            experiment_scenario, lambda: self._render_header(experiment_scenario))
+        current_timestamp = time.strftime("%H:%M:%S")
+        prompt_end = f"The current time is [{current_timestamp}]. " + task
         if not chat_list:
             prompt += "No one has spoken yet.\n"
         else:
             prompt += "Here is the speaking history so far, including [timestamps]:\n"
-            for chat_entry in chat_list:
-                prompt += f"[{chat_entry.time}] {chat_entry.entity.name}: {chat_entry.answer}\n"
-        current_timestamp = time.strftime("%H:%M:%S")
-        prompt += f"The current time is [{current_timestamp}]. "
-        prompt += task
+            prompt = self._fit_context_window(self._prompt_builder, chat_list, prompt, prompt_end)
+        prompt += prompt_end
         new_output_prefix = f"[{current_timestamp}] {self.name}: "  # won't be used by all models
         return self._create_customized_model_prompt_skeleton(direct_prompt=prompt,
                                                              new_output_prefix=new_output_prefix)
 
+    def _render_header(self, experiment_scenario: str) -> str:
+        return f"Your name is {self.name}. {self.background_story}\n" \
+               f"{experiment_scenario}\n{self.opinion}\n" \
+               f"The chat room was opened for discussion at [{self.experiment_start_time}].\n"
+
+    @staticmethod
+    def _render_chat_entry(chat_entry: ChatEntry) -> str:
+        return f"[{chat_entry.time}] {chat_entry.entity.name}: {chat_entry.answer}\n"
+
     def create_context_for_scheduler(self, experiment_scenario: str, chat_list: List[ChatEntry]
                                      ) -> str:
         """
@@ -106,7 +115,10 @@ class AsynchronousGroupDiscussant(InnerSchedulerAsynchronousPerson):
         Decides whether to currently generate an answer, based on the context,
         using self.scheduling_model.
         """
-        output = self.scheduling_model.generate(context)
+        if self.decision_mode == LOGITS_DECISION:
+            return self._decide_by_logits(context, self.use_turn_token, self.pass_turn_token)
+        output = self.scheduling_model.generate(context, self._prefix_cache(self.scheduling_model),
+                                                self.stop_strings)
         # log.debug(f"Raw scheduling decision was: \n'''\n{output}\n'''\n")
         scheduling_decision = self._customized_model_post_process_output(output)
         return bool(scheduling_decision.strip()) and \
@@ -119,16 +131,26 @@ class AsynchronousGroupDiscussant(InnerSchedulerAsynchronousPerson):
         task = "Add a short message to the conversation!"
         return self._create_prompt_skeleton(experiment_scenario, chat_list, task)
 
+    def decision_inputs(self, experiment_scenario: str, chat_list: List[ChatEntry]
+                        ) -> Optional[Tuple[str, str, str]]:
+        if self.decision_mode != LOGITS_DECISION:
+            return None
+        context = self.create_context_for_scheduler(experiment_scenario, chat_list)
+        return context, self.use_turn_token, self.pass_turn_token
+
+    def generate_decided_answer(self, experiment_scenario: str, chat_list: List[ChatEntry]) -> ChatEntry:
+        prompt = self.create_prompt(experiment_scenario, chat_list)
+        output = self._generate(prompt)
+        answer = self._customized_model_post_process_output(output)
+        current_time = time.strftime("%H:%M:%S")
+        return ChatEntry(entity=self, prompt=prompt, answer=answer, time=current_time)
+
     def generate_answer(self, experiment_scenario: str, chat_list: List[ChatEntry]
                         ) -> Union[ChatEntry, None]:
         context = self.create_context_for_scheduler(experiment_scenario, chat_list)
         if self.should_generate_answer(context):
             log.info(f"Model chose to generate! ({self.name}'s turn)")
-            prompt = self.create_prompt(experiment_scenario, chat_list)
-            output = self.generation_model.generate(prompt)
-            answer = self._customized_model_post_process_output(output)
-            current_time = time.strftime("%H:%M:%S")
-            return ChatEntry(entity=self, prompt=prompt, answer=answer, time=current_time)
+            return self.generate_decided_answer(experiment_scenario, chat_list)
         else:
             log.info(f"Model chose not to generate... ({self.name}'s turn)")
             return None
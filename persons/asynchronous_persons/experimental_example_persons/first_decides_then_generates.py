@@ -1,7 +1,9 @@
 import time
-from typing import Union, List
+from typing import Optional, Tuple, Union, List
 from persons.asynchronous_persons.inner_scheduler_asynchronous_person import \
-    InnerSchedulerAsynchronousPerson
+    InnerSchedulerAsynchronousPerson, LOGITS_DECISION
+from persons.prompt_builder import IncrementalPromptBuilder
+from persons.stop_strings import DEFAULT_STOP_STRINGS
 from session_rooms.session_room import ChatEntry
 import logging
 
@@ -13,6 +15,8 @@ USE_TURN_TOKEN = "<speak>"
 
 class FirstDecidesThenGenerates(InnerSchedulerAsynchronousPerson):
     PERSON_TYPE = "first_decides_then_generates"
+    # Only the first line of the generated texts is kept.
+    DEFAULT_STOP_STRINGS = DEFAULT_STOP_STRINGS
 
     def __init__(self, background_story: str, name: str,
                  pass_turn_token: str = PASS_TURN_TOKEN,
@@ -20,25 +24,37 @@ class FirstDecidesThenGenerates(InnerSchedulerAsynchronousPerson):
         super().__init__(background_story=background_story, name=name, *args, **kwargs)
         self.pass_turn_token = pass_turn_token
         self.use_turn_token = use_turn_token
+        self._prompt_builder = IncrementalPromptBuilder(self._render_chat_entry)
 
     def _create_prompt_skeleton(self, experiment_scenario: str, chat_list: List[ChatEntry],
                                 task: str) -> str:
-        output = ("### Instruction: \n"
-                  f"Your name is {self.name}. \n"
-                  f"This is your background story: {self.background_story}.\n"
-                  f"The following is {experiment_scenario}. "
-                  f"Based on the following chat history [with timestamps], "
-                  f"{task}\n"
-                  f"The current time is: [{time.strftime('%H:%M:%S')}]\n\n"
-                  "### Input: (Chat History)\n")
+        output = self._prompt_builder.header(
+            experiment_scenario, lambda: self._render_header(experiment_scenario))
+        # The task (which differs between the scheduler and the generation prompts) and the current
+        # time are placed after the history, so the prompts of a turn and of the next turns share
+        # their prefix (see `persons.prefix_cache`).
+        tail = ("### Task:\n"
+                f"Based on the chat history above [with timestamps], {task}\n"
+                f"The current time is: [{time.strftime('%H:%M:%S')}]\n\n"
+                "### Response:")
         if not chat_list:
             output += "(No chat message was added yet)\n"
         else:
-            for chat_entry in chat_list:
-                output += f"[{chat_entry.time}] {chat_entry.entity.name}: {chat_entry.answer}\n"
-        output += "### Response:"
+            output = self._fit_context_window(self._prompt_builder, chat_list, output, tail)
+        output += tail
         return output
 
+    def _render_header(self, experiment_scenario: str) -> str:
+        return ("### Instruction: \n"
+                f"Your name is {self.name}. \n"
+                f"This is your background story: {self.background_story}.\n"
+                f"The following is {experiment_scenario}.\n\n"
+                "### Input: (Chat History)\n")
+
+    @staticmethod
+    def _render_chat_entry(chat_entry: ChatEntry) -> str:
+        return f"[{chat_entry.time}] {chat_entry.entity.name}: {chat_entry.answer}\n"
+
     def create_context_for_scheduler(self, experiment_scenario: str, chat_list: List[ChatEntry]
                                      ) -> str:
         """
@@ -69,7 +85,10 @@ class FirstDecidesThenGenerates(InnerSchedulerAsynchronousPerson):
         Decides whether to currently generate an answer, based on the context,
         using self.scheduling_model.
         """
-        scheduling_decision = self.scheduling_model.generate(context)
+        if self.decision_mode == LOGITS_DECISION:
+            return self._decide_by_logits(context, self.use_turn_token, self.pass_turn_token)
+        scheduling_decision = self.scheduling_model.generate(context, self._prefix_cache(self.scheduling_model),
+                                                             self.stop_strings)
         scheduling_decision = scheduling_decision.split("### Response:")[1]
         scheduling_decision = scheduling_decision.strip().split("</s>")[0].split("\n")[0]
         return bool(scheduling_decision.strip()) and \
@@ -82,21 +101,31 @@ class FirstDecidesThenGenerates(InnerSchedulerAsynchronousPerson):
         task = "add your message to the conversation. Try to keep your reply shorter than 30 words."
         return self._create_prompt_skeleton(experiment_scenario, chat_list, task)
 
+    def decision_inputs(self, experiment_scenario: str, chat_list: List[ChatEntry]
+                        ) -> Optional[Tuple[str, str, str]]:
+        if self.decision_mode != LOGITS_DECISION:
+            return None
+        context = self.create_context_for_scheduler(experiment_scenario, chat_list)
+        return context, self.use_turn_token, self.pass_turn_token
+
+    def generate_decided_answer(self, experiment_scenario: str, chat_list: List[ChatEntry]) -> ChatEntry:
+        prompt = self.create_prompt(experiment_scenario, chat_list)
+        answer = self._generate(prompt)
+        answer = answer.split("### Response:")[1]
+        answer = answer.strip().split("</s>")[0].split("\n")[0]
+        answer = answer.removeprefix(f"{self.name}: ")
+        time_and_name_prefix = f"] {self.name}: "
+        if time_and_name_prefix in answer:
+            answer = answer.split(time_and_name_prefix)[1]
+        current_time = time.strftime("%H:%M:%S")
+        return ChatEntry(entity=self, prompt=prompt, answer=answer, time=current_time)
+
     def generate_answer(self, experiment_scenario: str, chat_list: List[ChatEntry]
                         ) -> Union[ChatEntry, None]:
         context = self.create_context_for_scheduler(experiment_scenario, chat_list)
         if self.should_generate_answer(context):
             log.info("Model chose to generate!")
-            prompt = self.create_prompt(experiment_scenario, chat_list)
-            answer = self.generation_model.generate(prompt)
-            answer = answer.split("### Response:")[1]
-            answer = answer.strip().split("</s>")[0].split("\n")[0]
-            answer = answer.removeprefix(f"{self.name}: ")
-            time_and_name_prefix = f"] {self.name}: "
-            if time_and_name_prefix in answer:
-                answer = answer.split(time_and_name_prefix)[1]
-            current_time = time.strftime("%H:%M:%S")
-            return ChatEntry(entity=self, prompt=prompt, answer=answer, time=current_time)
+            return self.generate_decided_answer(experiment_scenario, chat_list)
         else:
             log.info("Model chose not to generate...")
             return None
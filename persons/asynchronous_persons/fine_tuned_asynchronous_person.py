@@ -1,6 +1,7 @@
 from typing import Union, List, TYPE_CHECKING
 from persons.asynchronous_persons.asynchronous_person import AsynchronousPerson
 from persons.asynchronous_persons.hugging_face_model import HuggingFaceModel
+from persons.inference_backend import get_backend
 from abc import ABC, abstractmethod
 from session_rooms.session_room import ChatEntry
 import logging
@@ -13,7 +14,16 @@ class FineTunedAsynchronousPerson(AsynchronousPerson, ABC):
     def __init__(self, model_path: str, background_story: str, name: str,
                  *args, **kwargs):
         super().__init__(background_story, name, *args, **kwargs)
-        self.generation_model = HuggingFaceModel(local_model_path=model_path)
+        # Persons fine-tuned as LoRA adapters over the same model share it (see `persons.lora_adapters`).
+        self.generation_model = HuggingFaceModel(local_model_path=model_path,
+                                                 adapter_path=kwargs.get("adapter_path"),
+                                                 backend=get_backend(kwargs.get("backend")))
+
+    @classmethod
+    def preload_models(cls, **kwargs):
+        if kwargs.get("model_path"):
+            HuggingFaceModel.preload(local_model_path=kwargs["model_path"], adapter_path=kwargs.get("adapter_path"),
+                                     backend=get_backend(kwargs.get("backend")))
 
     @abstractmethod
     def create_prompt(self, experiment_scenario: str, chat_list: List[ChatEntry]) -> str:
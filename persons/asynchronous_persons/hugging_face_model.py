@@ -3,12 +3,72 @@ import os
 import json
 import torch
 from transformers import AutoConfig, AutoModelForSeq2SeqLM, AutoTokenizer, AutoModelForCausalLM
-from typing import List, Callable
+from typing import List, Callable, Sequence
 import logging
 
+from persons.assisted_decoding import AssistedDecodingStats, assisted_generate
+from persons.generation_engine import get_generation_engine
+from persons.inference_backend import InferenceBackend
+from persons.lora_adapters import LoraAdapterModel, lora_model_spec
+from persons.model_planner import planned_model_spec
+from persons.model_registry import ModelKey, get_model_registry
+from persons.prefix_cache import PrefixCache, prefill_batch, to_legacy
+from persons.prompt_tokenizer import PromptTokenizer, left_pad
+from persons.stop_strings import row_stop_criteria, stopping_criteria
+
 log = logging.getLogger(__name__)
 
 
+def _default_device(backend: InferenceBackend = InferenceBackend()) -> torch.device:
+    return torch.device("cuda" if torch.cuda.is_available() and not backend.is_cpu else "cpu")
+
+
+def _place(model):
+    model.to(_default_device())
+    model.eval()
+    return model
+
+
+def _tokenizer_spec(model_path: str) -> tuple[ModelKey, Callable]:
+    return ModelKey(model_path, "tokenizer"), lambda: AutoTokenizer.from_pretrained(model_path)
+
+
+def _local_model_spec(local_model_path: str, lora: bool = False,
+                      backend: InferenceBackend = InferenceBackend()) -> tuple[ModelKey, Callable]:
+    if backend.is_cpu:
+        # The adapters wrap the linear layers of the model, which can't be quantized under them.
+        backend = backend.without_quantization() if lora else backend
+        key = backend.model_key(local_model_path, "seq2seq_lm")
+        load = lambda: backend.load(AutoModelForSeq2SeqLM.from_pretrained, local_model_path,
+                                    config=AutoConfig.from_pretrained(local_model_path))
+        return lora_model_spec(key, load) if lora else (key, load)
+    # Planned with the other models of the configuration (see `persons.model_planner`).
+    planned = planned_model_spec(local_model_path, "seq2seq_lm", AutoModelForSeq2SeqLM.from_pretrained, lora,
+                                 config=AutoConfig.from_pretrained(local_model_path))
+    if planned is not None:
+        return planned
+    key = ModelKey(local_model_path, "seq2seq_lm", dtype="float32", device=str(_default_device()))
+    load = lambda: _place(AutoModelForSeq2SeqLM.from_pretrained(
+        local_model_path, config=AutoConfig.from_pretrained(local_model_path)))
+    return lora_model_spec(key, load) if lora else (key, load)
+
+
+def _pretrained_model_spec(pretrained_model_name: str, lora: bool = False,
+                           backend: InferenceBackend = InferenceBackend()) -> tuple[ModelKey, Callable]:
+    if backend.is_cpu:
+        # bfloat16 is slow on most CPUs, so the CPU backend runs in float32 (or int8).
+        backend = backend.without_quantization() if lora else backend
+        key = backend.model_key(pretrained_model_name, "causal_lm")
+        load = lambda: backend.load(AutoModelForCausalLM.from_pretrained, pretrained_model_name)
+        return lora_model_spec(key, load) if lora else (key, load)
+    planned = planned_model_spec(pretrained_model_name, "causal_lm", AutoModelForCausalLM.from_pretrained, lora)
+    if planned is not None:
+        return planned
+    key = ModelKey(pretrained_model_name, "causal_lm", dtype="bfloat16", device=str(_default_device()))
+    load = lambda: _place(AutoModelForCausalLM.from_pretrained(pretrained_model_name, torch_dtype=torch.bfloat16))
+    return lora_model_spec(key, load) if lora else (key, load)
+
+
 class HuggingFaceModel:
     """
     A container for a trained model, either pretrained or locally fine-tuned.
@@ -18,11 +78,24 @@ class HuggingFaceModel:
     def __init__(self, local_model_path: str = None, pretrained_model_name: str = None,
                  special_tokens: List[str] = None, smart_truncation_func: Callable = None,
                  max_source_length: int = 1024, num_beams: int = 4,
-                 generate_without_special_tokens: bool = False):
+                 generate_without_special_tokens: bool = False, adapter_path: str = None,
+                 backend: InferenceBackend = InferenceBackend()):
+        """
+        :param smart_truncation_func: truncates inputs longer than `max_source_length` tokens (e.g.
+            `persons.context_window.truncate_to_last_tokens`). The persons fit their prompts into the context of
+            the model themselves, keeping the header of the prompt (see `persons.context_window.ContextWindow`).
+        :param adapter_path: a LoRA adapter over the model, which shares the model with the other
+            adapters over it (see `persons.lora_adapters`).
+        :param backend: where the model runs (see `persons.inference_backend`).
+        """
+        self.backend = backend
+        self.device = _default_device(backend)
+        # Load each model only once to save expensive memory (see `persons.model_registry`).
+        # The model is only waited for when it's first used, as it may still be loading.
+        registry = get_model_registry()
         if local_model_path:
-            config = AutoConfig.from_pretrained(local_model_path)
-            self.tokenizer = AutoTokenizer.from_pretrained(local_model_path)
-            self.model = AutoModelForSeq2SeqLM.from_pretrained(local_model_path, config=config)
+            self.tokenizer = registry.acquire(*_tokenizer_spec(local_model_path), owner=self)
+            self.model = registry.lazy(*_local_model_spec(local_model_path, bool(adapter_path), backend), owner=self)
             with open(os.path.join(local_model_path, 'config.json'), 'r') as f:
                 train_config = json.load(f)
                 self.model_name = train_config['_name_or_path']
@@ -34,48 +107,183 @@ class HuggingFaceModel:
                 self.special_token_ids = self._get_special_tokens_id(added_tokens)
         elif pretrained_model_name:
             self.model_name = pretrained_model_name
-            self.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name)
             if special_tokens:
+                # The added tokens change the tokenizer, so it isn't shared.
+                self.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name)
                 self.tokenizer.add_special_tokens({'additional_special_tokens': special_tokens})
                 self.special_token_ids = self._get_special_tokens_id(special_tokens)
             else:
+                self.tokenizer = registry.acquire(*_tokenizer_spec(pretrained_model_name), owner=self)
                 self.special_token_ids = []
             # self.model = AutoModelForSeq2SeqLM.from_pretrained(pretrained_model_name)
-            self.model = AutoModelForCausalLM.from_pretrained(pretrained_model_name,
-                                                              torch_dtype=torch.bfloat16)
+            self.model = registry.lazy(*_pretrained_model_spec(pretrained_model_name, bool(adapter_path), backend),
+                                       owner=self)
         else:
             raise ValueError("Missing either model_path or pretrained_model_name")
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model.to(self.device)
-        self.model.eval()
+        if adapter_path:
+            self.model = LoraAdapterModel(self.model, adapter_path)
+        # Caches the token ids of the prompt lines, which repeat between turns.
+        self.prompt_tokenizer = PromptTokenizer(self.tokenizer)
         self.smart_truncation_func = smart_truncation_func
         self.max_source_length = max_source_length
         self.num_beams = num_beams
         self.generate_without_special_tokens = generate_without_special_tokens
 
+    @staticmethod
+    def preload(local_model_path: str = None, pretrained_model_name: str = None, adapter_path: str = None,
+                backend: InferenceBackend = InferenceBackend()):
+        """ Starts loading the model (and tokenizer) of a `HuggingFaceModel` in the background. """
+        registry = get_model_registry()
+        if local_model_path:
+            registry.preload(*_tokenizer_spec(local_model_path))
+            registry.preload(*_local_model_spec(local_model_path, bool(adapter_path), backend))
+        elif pretrained_model_name:
+            registry.preload(*_tokenizer_spec(pretrained_model_name))
+            registry.preload(*_pretrained_model_spec(pretrained_model_name, bool(adapter_path), backend))
+
     def _get_special_tokens_id(self, added_tokens: List[str]) -> List[int]:
         return [x for x in self.tokenizer(' '.join(added_tokens)).input_ids
                 if self.tokenizer.decode(x) in added_tokens]
 
-    def generate(self, input_text: str) -> str:
-        inputs = self.tokenizer(input_text, return_tensors="pt")
-        inputs = {'input_ids': inputs.input_ids[0, :],
-                  'attention_mask': inputs.attention_mask[0, :]}
+    def _truncate(self, input_ids: List[int]) -> dict:
+        """ The (1-D) inputs of the model for `input_ids`, after the truncation of long inputs. """
+        input_ids = torch.tensor(input_ids, dtype=torch.long)
+        inputs = {'input_ids': input_ids,
+                  'attention_mask': torch.ones_like(input_ids)}
         # TODO move inputs to dataset to use moving it to the right device, example:
         # from datasets import Dataset
         # my_dict = {"a": [1, 2, 3]}
         # dataset = Dataset.from_dict(my_dict)
-        if self.smart_truncation_func:
+        if self.smart_truncation_func and self.max_source_length:
             inputs = self.smart_truncation_func(inputs, self.max_source_length,
                                                 self.special_token_ids, self.model_name)
+        return inputs
+
+    @property
+    def supports_prefix_cache(self) -> bool:
+        """
+        The cached keys and values of encoder-decoder models don't belong to their input, and beam
+        search expands its input into several beams.
+        """
+        return (not getattr(self.model.config, "is_encoder_decoder", False)
+                and getattr(self.model.generation_config, "num_beams", 1) == 1)
+
+    def generate(self, input_text: str, prefix_cache: PrefixCache = None,
+                 stop_strings: Sequence[str] = None, draft_model: HuggingFaceModel = None,
+                 assisted_stats: AssistedDecodingStats = None) -> str:
+        """
+        Generates the continuation of `input_text`. With a `prefix_cache` (owned by the caller, e.g.
+        a person), only the tokens after the prefix shared with its last input are prefilled.
+        With `stop_strings`, generation stops once the (stripped) continuation contains one of them.
+        With a `draft_model`, generation is assisted by it, and its statistics are added to
+        `assisted_stats` (see `persons.assisted_decoding`).
+        """
+        if not self.supports_prefix_cache:
+            prefix_cache = None
+        inputs = self._truncate(self.prompt_tokenizer.encode_text(input_text))
+        engine = get_generation_engine(self.model) if self.supports_prefix_cache and draft_model is None else None
+        if engine is not None:
+            # Generated in a continuous batch with the other users of the model (see `persons.generation_engine`).
+            input_ids = inputs['input_ids'].tolist()
+            generated = engine.generate(self.model, input_ids, max_new_tokens=100, prefix_cache=prefix_cache,
+                                        stop_criteria=row_stop_criteria(self.tokenizer, stop_strings,
+                                                                        skip_leading_whitespace=True))
+            return self.tokenizer.decode(input_ids + generated,
+                                         skip_special_tokens=self.generate_without_special_tokens)
         inputs = {'input_ids': torch.unsqueeze(inputs['input_ids'], 0),
                   'attention_mask': torch.unsqueeze(inputs['attention_mask'], 0)}
+        past_key_values = None
+        if prefix_cache is not None:
+            _, past_key_values = prefix_cache.lookup(inputs['input_ids'][0])
         inputs = {key: value.to(self.device) for key, value in inputs.items()}
+        generate_kwargs = dict(past_key_values=past_key_values,
+                               stopping_criteria=stopping_criteria(
+                                   self.tokenizer, stop_strings, inputs['input_ids'].shape[1],
+                                   skip_leading_whitespace=True),
+                               return_dict_in_generate=True,
+                               # max_length=self.max_source_length,
+                               # num_beams=self.num_beams
+                               max_new_tokens=100)
         with torch.inference_mode():
-            outputs = self.model.generate(**inputs,
-                                          # max_length=self.max_source_length,
-                                          # num_beams=self.num_beams
-                                          max_new_tokens=100
-                                          )
-        return self.tokenizer.decode(outputs[0],
+            if draft_model is not None:
+                outputs = assisted_generate(self.model, draft_model.model, assisted_stats, inputs['input_ids'],
+                                            attention_mask=inputs['attention_mask'], **generate_kwargs)
+            else:
+                outputs = self.model.generate(**inputs, **generate_kwargs)
+        if prefix_cache is not None:
+            prefix_cache.store(outputs.sequences[0], outputs.past_key_values)
+        return self.tokenizer.decode(outputs.sequences[0],
                                      skip_special_tokens=self.generate_without_special_tokens)
+
+    def choice_log_likelihoods(self, input_text: str, choices: List[str],
+                               prefix_cache: PrefixCache = None) -> List[float]:
+        """
+        Returns the log-likelihood of each one of `choices` as the continuation of `input_text`.
+        Instead of generating, it runs a single forward pass over the text and the prefix the
+        choices share, and then scores only the remaining tokens of each choice.
+        """
+        return self.batch_choice_log_likelihoods(
+            [input_text], [choices], None if prefix_cache is None else [prefix_cache])[0]
+
+    def batch_choice_log_likelihoods(self, input_texts: List[str], choices: List[List[str]],
+                                     prefix_caches: List[PrefixCache] = None) -> List[List[float]]:
+        """
+        Same as `choice_log_likelihoods`, for several texts (e.g. the contexts of several persons)
+        in a single padded batch. Every text has its own choices, and its own prefix cache (if any).
+        """
+        if getattr(self.model.config, "is_encoder_decoder", False):
+            raise NotImplementedError("Scoring choices requires a decoder-only model")
+        shared_ids, rests = [], []
+        for input_text, row_choices in zip(input_texts, choices):
+            sequences = [self.prompt_tokenizer.encode_text(input_text + choice) for choice in row_choices]
+            # Every choice keeps at least one token after the shared prefix, which is scored by its logits.
+            shared = min(len(sequence) for sequence in sequences) - 1
+            for i in range(shared):
+                if any(sequence[i] != sequences[0][i] for sequence in sequences):
+                    shared = i
+                    break
+            shared_ids.append(self._truncate(sequences[0][:shared])['input_ids'].tolist())
+            rests.append([sequence[shared:] for sequence in sequences])
+        lengths = torch.tensor([len(row_ids) for row_ids in shared_ids], device=self.device)
+
+        if prefix_caches is None:
+            prefix_caches = [PrefixCache() for _ in input_texts]
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else 0
+        with torch.inference_mode():
+            # Everything but the last shared token of each text is prefilled (reusing the prefix caches),
+            # so the batch computes only the last tokens, whose logits score the first choice tokens.
+            past_key_values = prefill_batch(self.model, prefix_caches, shared_ids)
+            input_ids, attention_mask = left_pad(shared_ids, pad_token_id)
+            input_ids, attention_mask = input_ids.to(self.device), attention_mask.to(self.device)
+            outputs = self.model(input_ids=input_ids[:, -1:], attention_mask=attention_mask,
+                                 position_ids=(lengths - 1).unsqueeze(-1),
+                                 past_key_values=past_key_values, use_cache=True)
+            past_key_values = to_legacy(outputs.past_key_values)
+            first_log_probs = torch.log_softmax(outputs.logits[:, -1].float(), dim=-1)
+            log_likelihoods = [[first_log_probs[row, rest[0]].item() for rest in row_rests]
+                               for row, row_rests in enumerate(rests)]
+
+            # The rest of the choice tokens are scored choice by choice, for all the texts at once.
+            for choice in range(max(len(row_rests) for row_rests in rests)):
+                rows = [row for row, row_rests in enumerate(rests)
+                        if choice < len(row_rests) and len(row_rests[choice]) > 1]
+                if not rows:
+                    continue
+                width = max(len(rests[row][choice]) - 1 for row in rows)
+                choice_ids = torch.full((len(rests), width), pad_token_id, dtype=torch.long)
+                choice_mask = torch.zeros((len(rests), width), dtype=torch.long)
+                for row in rows:
+                    tokens = rests[row][choice][:-1]
+                    choice_ids[row, :len(tokens)] = torch.tensor(tokens, dtype=torch.long)
+                    choice_mask[row, :len(tokens)] = 1
+                choice_mask = choice_mask.to(self.device)
+                choice_outputs = self.model(
+                    input_ids=choice_ids.to(self.device),
+                    attention_mask=torch.cat([attention_mask, choice_mask], dim=-1),
+                    position_ids=lengths.unsqueeze(-1) + torch.arange(width, device=self.device),
+                    past_key_values=past_key_values, use_cache=True)
+                log_probs = torch.log_softmax(choice_outputs.logits.float(), dim=-1)
+                for row in rows:
+                    targets = rests[row][choice][1:]
+                    log_likelihoods[row][choice] += log_probs[row, torch.arange(len(targets)), targets].sum().item()
+        return log_likelihoods
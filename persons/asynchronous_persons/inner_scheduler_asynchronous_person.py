@@ -1,39 +1,60 @@
-from typing import Union, List
+from typing import Dict, Optional, Sequence, Tuple, Union, List
 from persons.asynchronous_persons.asynchronous_person import AsynchronousPerson
 from abc import ABC, abstractmethod
 from persons.asynchronous_persons.hugging_face_model import HuggingFaceModel
+from persons.assisted_decoding import AssistedDecodingStats
+from persons.context_window import ContextWindow
+from persons.inference_backend import InferenceBackend, get_backend
+from persons.prefix_cache import PrefixCache
+from persons.prompt_builder import IncrementalPromptBuilder
+from persons.stop_strings import get_stop_strings
 from session_rooms.session_room import ChatEntry
 import logging
-from functools import cache
+import weakref
+
+import torch
 
 log = logging.getLogger(__name__)
 
 DEFAULT_MODEL_NAME = "microsoft/Phi-3-mini-4k-instruct"
+# How the inner scheduler decides whether to speak:
+# generating a reply and looking for the turn tokens in it,
+GENERATE_DECISION = "generate"
+# or comparing the likelihood of the use-turn and the pass-turn tokens after the context.
+LOGITS_DECISION = "logits"
+
 
+# The models shared by the persons which use them, so each model is wrapped (and its prompt lines are cached)
+# once. The weights themselves are shared by all the persons through `persons.model_registry`.
+_shared_hugging_face_models = weakref.WeakValueDictionary()
 
-# _shared_hugging_face_models = {}
-# def get_shared_model(model_name: str) -> HuggingFaceModel:
-#     if model_name not in _shared_hugging_face_models:
-#         _shared_hugging_face_models[model_name] = init_hugging_face_model(model_name)
-#     return _shared_hugging_face_models[model_name]
-@cache
-def get_shared_model(model_name: str) -> HuggingFaceModel:
-    return init_hugging_face_model(model_name)
 
+def get_shared_model(model_name: str, backend: InferenceBackend = InferenceBackend()) -> HuggingFaceModel:
+    model = _shared_hugging_face_models.get((model_name, backend))
+    if model is None:
+        model = _shared_hugging_face_models[model_name, backend] = init_hugging_face_model(model_name,
+                                                                                            backend=backend)
+    return model
 
-def init_hugging_face_model(model_name: str, is_pretrained: bool = True) -> HuggingFaceModel:
+
+def init_hugging_face_model(model_name: str, is_pretrained: bool = True,
+                            backend: InferenceBackend = InferenceBackend()) -> HuggingFaceModel:
     """
     Argument `is_pretrained` is currently only used as default, for simplicity reasons.
     If needed, the code can be easily modified to get an "is_pretrained" argument
     for the generation model and/or the inner scheduler model from the initial configuration.
     """
     if is_pretrained:
-        return HuggingFaceModel(pretrained_model_name=model_name)
+        return HuggingFaceModel(pretrained_model_name=model_name, backend=backend)
     else:
-        return HuggingFaceModel(local_model_path=model_name)
+        return HuggingFaceModel(local_model_path=model_name, backend=backend)
 
 
 class InnerSchedulerAsynchronousPerson(AsynchronousPerson, ABC):
+    # The stop strings of the generated texts, unless configured otherwise (see `persons.stop_strings`).
+    # Only persons which keep the first line of the generated texts stop at a newline.
+    DEFAULT_STOP_STRINGS = None
+
     def __init__(self, background_story: str, name: str,
                  generation_model_name: str = DEFAULT_MODEL_NAME,
                  scheduling_model_name: str = DEFAULT_MODEL_NAME, *args, **kwargs):
@@ -42,14 +63,95 @@ class InnerSchedulerAsynchronousPerson(AsynchronousPerson, ABC):
         self.is_scheduling_model_shared = kwargs.get("is_scheduling_model_shared", True)
         self.generation_model_name = generation_model_name
         self.scheduling_model_name = scheduling_model_name
+        # Where the models run, e.g. on the CPU of hosts without a GPU (see `persons.inference_backend`).
+        self.backend = get_backend(kwargs.get("backend"))
         if self.is_generation_model_shared:
-            self.generation_model = get_shared_model(self.generation_model_name)
+            self.generation_model = get_shared_model(self.generation_model_name, self.backend)
         else:
-            self.generation_model = init_hugging_face_model(self.generation_model_name)
+            self.generation_model = init_hugging_face_model(self.generation_model_name, backend=self.backend)
         if self.is_scheduling_model_shared:
-            self.scheduling_model = get_shared_model(self.scheduling_model_name)
+            self.scheduling_model = get_shared_model(self.scheduling_model_name, self.backend)
         else:
-            self.scheduling_model = init_hugging_face_model(self.scheduling_model_name)
+            self.scheduling_model = init_hugging_face_model(self.scheduling_model_name, backend=self.backend)
+        # A small model of the same family as the generation model, which drafts its answers
+        # (see `persons.assisted_decoding`).
+        draft_model_name = kwargs.get("draft_model_name")
+        self.draft_model = get_shared_model(draft_model_name, self.backend) if draft_model_name else None
+        self.assisted_stats = AssistedDecodingStats(name) if draft_model_name else None
+        self.context_window = ContextWindow.from_config(
+            kwargs.get("context_window"), self.generation_model.tokenizer, self.generation_model.model)
+        # The keys and values of the last prompt of this person, for each model it uses. By default the
+        # scheduling and the generation models are the same shared model, so both calls of a turn use
+        # the same cache: the shared history is prefilled once, and each call only adds its own task.
+        self.use_prefix_cache = kwargs.get("prefix_cache", True)
+        self._prefix_caches: Dict[int, PrefixCache] = {}
+        self.stop_strings = get_stop_strings(kwargs.get("stop_strings"), self.DEFAULT_STOP_STRINGS)
+        self.decision_mode = kwargs.get("decision_mode", GENERATE_DECISION)
+        if self.decision_mode not in (GENERATE_DECISION, LOGITS_DECISION):
+            raise ValueError(f"Unknown decision mode: {self.decision_mode}")
+        self.decision_threshold = kwargs.get("decision_threshold", 0.5)
+        self.decision_temperature = kwargs.get("decision_temperature", 1.0)
+        # The probability of speaking of the last logits decision, for logging.
+        self.last_speak_probability: Optional[float] = None
+
+    @classmethod
+    def preload_models(cls, **kwargs):
+        backend = get_backend(kwargs.get("backend"))
+        for model_name in {kwargs.get("generation_model_name", DEFAULT_MODEL_NAME),
+                           kwargs.get("scheduling_model_name", DEFAULT_MODEL_NAME), kwargs.get("draft_model_name")}:
+            if model_name:
+                HuggingFaceModel.preload(pretrained_model_name=model_name, backend=backend)
+
+    def shared_models(self):
+        # Persons whose models aren't shared still load the same weights from the registry.
+        models = [self.generation_model, self.scheduling_model, self.draft_model]
+        return tuple(key for model in models if model is not None
+                     for key in (model.model.model_key, id(model.tokenizer)))
+
+    def _prefix_cache(self, model: HuggingFaceModel) -> Optional[PrefixCache]:
+        """ The prefix cache of this person's prompts for `model` (see `HuggingFaceModel.generate`). """
+        if not self.use_prefix_cache:
+            return None
+        return self._prefix_caches.setdefault(id(model), PrefixCache())
+
+    def _generate(self, prompt: str) -> str:
+        """ Generates the continuation of `prompt` with the generation model (assisted by the draft model, if any). """
+        return self.generation_model.generate(prompt, self._prefix_cache(self.generation_model), self.stop_strings,
+                                              self.draft_model, self.assisted_stats)
+
+    def _fit_context_window(self, prompt_builder: IncrementalPromptBuilder, chat_list: List[ChatEntry],
+                            header: str, tail: str = "") -> str:
+        """
+        Returns `header` followed by the rendered history, trimmed to the context window of the
+        generation model (`tail` is the rest of the prompt, which is added by the caller).
+        """
+        if self.context_window is None:
+            return header + prompt_builder.text(chat_list)
+        return "".join(self.context_window.fit(prompt_builder, chat_list, header, tail))
+
+    def speak_probability(self, context: str, use_turn_text: str, pass_turn_text: str) -> float:
+        """
+        The probability that the scheduling model continues `context` with `use_turn_text` rather
+        than with `pass_turn_text`, from a single forward pass (see `LOGITS_DECISION`).
+        """
+        log_likelihoods = self.scheduling_model.choice_log_likelihoods(
+            context, [use_turn_text, pass_turn_text], self._prefix_cache(self.scheduling_model))
+        return self._set_speak_probability(log_likelihoods)
+
+    def _set_speak_probability(self, log_likelihoods: Sequence[float]) -> float:
+        """ Sets the probability of speaking from the log-likelihoods of the use-turn and pass-turn texts. """
+        log_likelihoods = torch.tensor(log_likelihoods)
+        self.last_speak_probability = torch.softmax(log_likelihoods / self.decision_temperature, dim=0)[0].item()
+        log.info(f"{self.name} wants to speak with probability {self.last_speak_probability:.3f}")
+        return self.last_speak_probability
+
+    def wants_to_speak(self) -> bool:
+        """ Whether the last logits decision (e.g. of a batch, see `batch_speak_probabilities`) was to speak. """
+        return self.last_speak_probability is not None and \
+            self.last_speak_probability >= self.decision_threshold
+
+    def _decide_by_logits(self, context: str, use_turn_text: str, pass_turn_text: str) -> bool:
+        return self.speak_probability(context, use_turn_text, pass_turn_text) >= self.decision_threshold
 
     @abstractmethod
     def create_context_for_scheduler(self, experiment_scenario: str, chat_list: List[ChatEntry]
@@ -74,12 +176,59 @@ class InnerSchedulerAsynchronousPerson(AsynchronousPerson, ABC):
         once the inner scheduler has decided it should"""
         raise NotImplementedError()
 
+    def decision_inputs(self, experiment_scenario: str, chat_list: List[ChatEntry]
+                        ) -> Optional[Tuple[str, str, str]]:
+        """
+        The context of a logits decision and the use-turn and pass-turn texts that are compared
+        after it, or None if this person doesn't decide by logits before generating its answer
+        (then its decision can't be batched with the decisions of other persons).
+        """
+        return None
+
+    def generate_decided_answer(self, experiment_scenario: str, chat_list: List[ChatEntry]) -> ChatEntry:
+        """ Generates the answer of this person, once the inner scheduler has decided it should. """
+        prompt = self.create_prompt(experiment_scenario, chat_list)
+        answer = self._generate(prompt)
+        return ChatEntry(entity=self, prompt=prompt, answer=answer)
+
     def generate_answer(self, experiment_scenario: str, chat_list: List[ChatEntry]
                         ) -> Union[ChatEntry, None]:
         context = self.create_context_for_scheduler(experiment_scenario, chat_list)
         if self.should_generate_answer(context):
-            prompt = self.create_prompt(experiment_scenario, chat_list)
-            answer = self.generation_model.generate(prompt)
-            return ChatEntry(entity=self, prompt=prompt, answer=answer)
+            return self.generate_decided_answer(experiment_scenario, chat_list)
         else:
             return None
+
+
+def batch_speak_probabilities(persons: Sequence[InnerSchedulerAsynchronousPerson], experiment_scenario: str,
+                              chat_list: List[ChatEntry],
+                              decision_inputs: Sequence[Optional[Tuple[str, str, str]]] = None
+                              ) -> List[Optional[float]]:
+    """
+    Decides whether each one of `persons` wants to speak, as `speak_probability` does, with a single
+    padded batch per scheduling model instead of a forward pass per person. Returns the probability
+    of speaking of every person (also set in its `last_speak_probability`), or None for the persons
+    whose decision can't be batched (see `decision_inputs`). The `decision_inputs` of the persons
+    are computed here, unless the caller already has them.
+    """
+    if decision_inputs is None:
+        decision_inputs = [person.decision_inputs(experiment_scenario, chat_list) for person in persons]
+    probabilities: List[Optional[float]] = [None] * len(persons)
+    groups: Dict[int, List[Tuple[int, Tuple[str, str, str]]]] = {}
+    for i, (person, inputs) in enumerate(zip(persons, decision_inputs)):
+        if inputs is not None:
+            groups.setdefault(id(person.scheduling_model), []).append((i, inputs))
+
+    for group in groups.values():
+        scheduling_model = persons[group[0][0]].scheduling_model
+        prefix_caches = [persons[i]._prefix_cache(scheduling_model) for i, _ in group]
+        # Persons without a prefix cache still need one for the batch, which is dropped afterwards.
+        prefix_caches = [PrefixCache() if cache is None else cache for cache in prefix_caches]
+        log_likelihoods = scheduling_model.batch_choice_log_likelihoods(
+            [context for _, (context, _, _) in group],
+            [[use_turn_text, pass_turn_text] for _, (_, use_turn_text, pass_turn_text) in group],
+            prefix_caches)
+        log.debug(f"Decided for {len(group)} persons in a single batch of {scheduling_model.model_name}")
+        for (i, _), row_log_likelihoods in zip(group, log_likelihoods):
+            probabilities[i] = persons[i]._set_speak_probability(row_log_likelihoods)
+    return probabilities
@@ -48,7 +48,8 @@ class InnerSchedulerMafiaPlayer(InnerSchedulerAsynchronousPerson):
         """
         if not context:
             return True  # No player has played yet, so first player can start
-        scheduling_decision = self.scheduling_model.generate(context)
+        scheduling_decision = self.scheduling_model.generate(context, self._prefix_cache(self.scheduling_model),
+                                                             self.stop_strings)
         return bool(scheduling_decision.strip()) and \
             (self.generation_model.generate_without_special_tokens
              or self.pass_turn_token not in scheduling_decision)
@@ -0,0 +1,83 @@
+"""
+This file contains the autotuner of the micro-batch size of batched persons.
+
+A batch person generates the answers of all its rooms together, so a batch which doesn't fit into
+the memory of the device crashes the session (usually after minutes of model loading). The largest
+batch isn't always the fastest either, once the device is saturated.
+
+`autotune_micro_batch_size` measures the throughput of a short synthetic generation for candidate
+micro-batch sizes at startup, and chooses the fastest one which fits into memory. During the session,
+a micro-batch which runs out of memory is halved and generated again (see `is_out_of_memory`).
+"""
+from __future__ import annotations
+
+import logging
+import time
+from typing import Any
+
+import torch
+
+from persons.model_registry import free_memory
+
+log = logging.getLogger(__name__)
+
+# The synthetic generation, which only needs to be long enough for a stable measurement.
+DEFAULT_AUTOTUNE_PROMPT_TOKENS = 512
+DEFAULT_AUTOTUNE_NEW_TOKENS = 16
+
+
+def is_out_of_memory(error: BaseException) -> bool:
+    """ Whether `error` was raised as the device ran out of memory. """
+    if isinstance(error, getattr(torch.cuda, "OutOfMemoryError", ())):
+        return True
+    return isinstance(error, RuntimeError) and "out of memory" in str(error).lower()
+
+
+def candidate_sizes(max_batch_size: int) -> list[int]:
+    """ The powers of 2 up to `max_batch_size`, and `max_batch_size` itself. """
+    sizes = []
+    size = 1
+    while size < max_batch_size:
+        sizes.append(size)
+        size *= 2
+    return sizes + [max_batch_size]
+
+
+def autotune_micro_batch_size(model: Any, pad_token_id: int, max_batch_size: int,
+                              prompt_tokens: int = DEFAULT_AUTOTUNE_PROMPT_TOKENS,
+                              new_tokens: int = DEFAULT_AUTOTUNE_NEW_TOKENS) -> int:
+    """
+    Measures the throughput of generating `new_tokens` tokens after prompts of `prompt_tokens` tokens
+    for every candidate micro-batch size (up to `max_batch_size` rows), and returns the fastest size
+    which fits into memory, or 1 if even a single row doesn't fit (shorter prompts may still fit, and
+    the generation of a single row which runs out of memory raises its error).
+    """
+    vocab_size = model.get_input_embeddings().num_embeddings
+    best_size, best_tokens_per_second = None, 0.0
+    for size in candidate_sizes(max_batch_size):
+        input_ids = torch.randint(vocab_size, (size, prompt_tokens), device=model.device)
+        try:
+            start = time.perf_counter()
+            with torch.inference_mode():
+                model.generate(input_ids=input_ids, attention_mask=torch.ones_like(input_ids),
+                               do_sample=False, min_new_tokens=new_tokens, max_new_tokens=new_tokens,
+                               pad_token_id=pad_token_id)
+            elapsed = time.perf_counter() - start
+        except RuntimeError as error:
+            if not is_out_of_memory(error):
+                raise
+            log.info(f"Micro-batch size {size} is out of memory")
+            break
+        finally:
+            del input_ids
+            free_memory()
+        tokens_per_second = size * new_tokens / elapsed
+        log.info(f"Micro-batch size {size}: {size / elapsed:.2f} rows/sec, {tokens_per_second:.1f} tokens/sec")
+        if tokens_per_second > best_tokens_per_second:
+            best_size, best_tokens_per_second = size, tokens_per_second
+    if best_size is None:
+        log.error(f"A single row of {prompt_tokens} tokens is out of memory, using micro-batches of 1 row")
+        return 1
+    log.info(f"Chosen micro-batch size {best_size} ({best_tokens_per_second:.1f} tokens/sec), set "
+             f"\"micro_batch_size\": {best_size} in the person configuration to reuse it")
+    return best_size
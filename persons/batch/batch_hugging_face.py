@@ -4,6 +4,23 @@ This file contains a Person implementation for loading HuggingFace models.
 The main arguments are:
     * model_path: The path to the model to load.
     * prompt_type: The type of prompt to use. "mistral_instruct" / "llama_instruct".
+    * context_window: How to fit long histories into the context of the model
+        (see `persons.context_window`).
+    * stop_strings: The strings which end the kept part of an answer, so generation stops once
+        every answer in the batch is complete (see `persons.stop_strings`).
+    * micro_batch_tokens: The most tokens (padded prompts and new tokens) in a single call to
+        `generate`. The prompts are sorted by length and split into micro-batches under this budget,
+        so short prompts aren't padded to the longest one (None for a single batch).
+    * micro_batch_size: The most rows in a single call to `generate`, or "auto" to choose the fastest
+        size that fits into memory at startup (see `persons.batch.batch_autotuner`). A micro-batch
+        which runs out of memory is halved and generated again.
+    * adapter_paths: The LoRA adapters over the model, one per person of the batch (None for the
+        model itself). The persons share a single copy of the model, and generate in a single batch
+        with the adapter of each row (see `persons.lora_adapters`).
+    * backend: Where the model runs, "auto" (8-bit quantized on the GPUs) or "cpu" (dynamically
+        int8 quantized on the CPU, for hosts without a GPU, see `persons.inference_backend`).
+    * prefix_cache: Whether to keep the attention keys and values of the last prompt of each
+        person, so the next prompt only prefills its new tokens (see `persons.prefix_cache`).
     * background_story: The background story of the person.
     * name: The name of the person.
 
@@ -14,43 +31,73 @@ Important: This class loads the model locally and might require high system reso
 from __future__ import annotations
 
 import gc
-from typing import Callable, TYPE_CHECKING
+import logging
+from typing import Callable, Sequence, TYPE_CHECKING, Union
 
 import torch
 from termcolor import colored
 from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, GenerationConfig
 
+from persons.batch.batch_autotuner import autotune_micro_batch_size, is_out_of_memory
 from persons.batch.batch_person import BatchedPerson, InBatchPerson
-from session_rooms.ChatEntry import BatchChatList, ChatEntry
+from persons.context_window import ContextWindow
+from persons.generation_engine import get_generation_engine
+from persons.inference_backend import InferenceBackend, get_backend
+from persons.lora_adapters import LoraAdapterModel, batch_model, lora_model_spec
+from persons.model_planner import planned_model_spec
+from persons.model_registry import ModelKey, free_memory, get_model_registry
+from persons.prefix_cache import PrefixCache, prefill_batch
+from persons.prompt_builder import IncrementalPromptBuilder
+from persons.prompt_tokenizer import PromptTokenizer, left_pad, length_buckets
+from persons.stop_strings import get_stop_strings, row_stop_criteria, stopping_criteria
+from session_rooms.ChatEntry import BatchChatList, ChatEntry, LazyPrompt
 
 if TYPE_CHECKING:
     pass
-# Load each model only once to save expensive memory.
-_hf_cache = {}
 
+log = logging.getLogger(__name__)
 
-def cache_or_init(key: str, init_func: Callable):
-    """
-    Returns the model from the cache if available.
-    Otherwise, initializes it with the given init_func.
-    """
-    if key not in _hf_cache:
-        print(colored(f"loading {key}", "blue"))
-        _hf_cache[key] = init_func()
-    return _hf_cache[key]
+def clear_cache():
+    """ Clears the cache of all loaded models which aren't used by any person (see `persons.model_registry`). """
+    get_model_registry().clear(only_unreferenced=True)
 
 
-def clear_cache():
-    """ Clears the cache of all loaded models. """
-    for model in _hf_cache.values(): del model
-    _hf_cache.clear()
-    gc.collect()
-    torch.cuda.empty_cache()
+def _tokenizer_spec(tokenizer_weights: str) -> tuple[ModelKey, Callable]:
+    # Use_fast=False? https://huggingface.co/openlm-research/open_llama_13b
+    return ModelKey(tokenizer_weights, "tokenizer"), lambda: AutoTokenizer.from_pretrained(tokenizer_weights)
+
+
+def _model_spec(model_weights: str, lora: bool = False,
+                backend: InferenceBackend = InferenceBackend()) -> tuple[ModelKey, Callable]:
+    if backend.is_cpu:
+        # bitsandbytes needs CUDA, and the adapters wrap the linear layers, which can't be quantized under them.
+        backend = backend.without_quantization() if lora else backend
+        key = backend.model_key(model_weights, "causal_lm")
+        load = lambda: backend.load(AutoModelForCausalLM.from_pretrained, model_weights)
+        return lora_model_spec(key, load) if lora else (key, load)
+    # The precision of the model is planned with the other models of the configuration (see `persons.model_planner`).
+    planned = planned_model_spec(model_weights, "causal_lm", AutoModelForCausalLM.from_pretrained, lora)
+    if planned is not None:
+        return planned
+    key = ModelKey(model_weights, "causal_lm", dtype="bfloat16", quantization="8bit", device="auto")
+    load = lambda: AutoModelForCausalLM.from_pretrained(
+        model_weights, device_map="auto", quantization_config=BitsAndBytesConfig(
+            load_in_8bit=True, bnb_8bit_compute_dtype=torch.bfloat16))
+    return lora_model_spec(key, load) if lora else (key, load)
 
 
 class PersonHuggingFace(BatchedPerson):
     PERSON_TYPE = "PersonHuggingFace"
 
+    @classmethod
+    def preload_models(cls, **kwargs):
+        model_path = kwargs.get("model_path")
+        if model_path:
+            registry = get_model_registry()
+            registry.preload(*_tokenizer_spec(model_path))
+            registry.preload(*_model_spec(model_path, bool(kwargs.get("adapter_paths")),
+                                          get_backend(kwargs.get("backend"))))
+
     def __init__(self, background_stories: list[str], names: list[str], tag: str = None, *args, **kwargs):
         super().__init__(background_stories, names, tag)
         # TODO change assertion to raise, since this input validation stuff
@@ -64,41 +111,56 @@ class PersonHuggingFace(BatchedPerson):
             raise ValueError("prompt type should not tbe none")
 
         self.confirmation_bias = kwargs["confirmation_bias"] if "confirmation_bias" in kwargs else None
+        # One prompt builder per person in the batch, as each one of them renders its own history.
+        self._prompt_builders = [IncrementalPromptBuilder(self._chat_entry_renderer(person))
+                                 for person in self.persons]
+        # Separate builders for rendering the lazy prompts of past entries.
+        self._lazy_prompt_builders = [IncrementalPromptBuilder(self._chat_entry_renderer(person))
+                                      for person in self.persons]
 
         tokenizer_weights = model_path
         model_weights = model_path
-        adapters_weights = ""
-
-        self.tokenizer = cache_or_init(
-            key=f"{tokenizer_weights}_tokenizer",
-            # Use_fast=False? https://huggingface.co/openlm-research/open_llama_13b
-            init_func=lambda: AutoTokenizer.from_pretrained(tokenizer_weights))
-        # TODO: add flag to control quanitization.
-        self.model = cache_or_init(
-            key=f"{model_weights}_model",
-            init_func=lambda: AutoModelForCausalLM.from_pretrained(
-                model_weights, device_map="auto", quantization_config=BitsAndBytesConfig(
-                    load_in_8bit=True, bnb_8bit_compute_dtype=torch.bfloat16)))
+        adapter_paths = kwargs.get("adapter_paths")
+        if adapter_paths and len(adapter_paths) != self.batch_count:
+            raise ValueError("adapter_paths should have an adapter (or null) for each person of the batch")
+
+        self.backend = get_backend(kwargs.get("backend"))
+
+        # Load each model only once to save expensive memory (see `persons.model_registry`).
+        # The model is used (and changed) right away, so it's acquired eagerly, but it was usually
+        # preloaded with the other models of the configuration (see `preload_models`).
+        registry = get_model_registry()
+        self.tokenizer = registry.acquire(*_tokenizer_spec(tokenizer_weights), owner=self)
+        self.model = registry.acquire(*_model_spec(model_weights, bool(adapter_paths), self.backend), owner=self)
+        # The model of each person, with its own LoRA adapter.
+        self._person_models = ([LoraAdapterModel(self.model, adapter_path) for adapter_path in adapter_paths]
+                               if adapter_paths else None)
         # Padding is needed as we infer all the batch at once.
         self.model.config.pad_token_id = self.tokenizer.pad_token_id = self.tokenizer.unk_token_id
         self.tokenizer.padding_side = 'left'
+        self.prompt_tokenizer = PromptTokenizer(self.tokenizer)
+        self._prefix_caches = ([PrefixCache() for _ in self.persons]
+                               if kwargs.get("prefix_cache", True) else None)
+        self.context_window = ContextWindow.from_config(kwargs.get("context_window"), self.tokenizer, self.model)
+        self.stop_strings = get_stop_strings(kwargs.get("stop_strings"))
+        # The most (padded prompt and new) tokens generated at once, or None for a single batch.
+        self.micro_batch_tokens = kwargs.get("micro_batch_tokens")
+        # The most rows generated at once ("auto" to measure the fastest one), or None for all of them.
+        # It's halved whenever a micro-batch runs out of memory.
+        self.micro_batch_size = kwargs.get("micro_batch_size")
+        if self.micro_batch_size == "auto":
+            self.micro_batch_size = autotune_micro_batch_size(self.model, self.tokenizer.pad_token_id,
+                                                              self.batch_count)
         # self.model.tie_weights()? - https://paperswithcode.com/method/weight-tying
 
-        if adapters_weights:
-            # If there are separate adapter weights add them to the underlying model.
-            self.model = cache_or_init(
-                key=f"{adapters_weights}_adapters",
-                init_func=lambda: AutoTokenizer.from_pretrained(
-                    adapters_weights, self.model))
-
     #
     def generate_answer(self, experiment_scenario: str, chat_lists: BatchChatList, do_sample: bool = True,*args,**kwargs):
         assert len(chat_lists) == len(self.persons), (
             f"batch size {len(chat_lists)} of chat and persons {len(self.persons)} must match"
         )
 
-        prompts: list[str] = [self.create_prompt(experiment_scenario, chat_list, person)
-                              for chat_list, person in zip(chat_lists, self.persons)]
+        prompts = [self.create_prompt_ids(experiment_scenario, chat_list, person)
+                   for chat_list, person in zip(chat_lists, self.persons)]
         config = GenerationConfig(
             # TODO - consider using repetition_penalty.
             do_sample=do_sample,
@@ -109,37 +171,106 @@ class PersonHuggingFace(BatchedPerson):
             max_new_tokens=70,
             pad_token_id=self.model.config.pad_token_id,
         )
-        answers = self.evaluate(config, prompts, use_cuda=torch.cuda.is_available())
-        return [ChatEntry(entity=person, prompt=prompt, answer=answer)
-                for prompt, answer, person in zip(prompts, answers, self.persons)]
+        answers = self.evaluate(config, prompts, use_cuda=torch.cuda.is_available() and not self.backend.is_cpu,
+                                prefix_caches=self._prefix_caches)
+        return [ChatEntry(entity=person, answer=answer,
+                          prompt=LazyPrompt(self._render_prompt, chat_list, experiment_scenario, person))
+                for chat_list, answer, person in zip(chat_lists, answers, self.persons)]
 
-    def evaluate(self, generation_config: GenerationConfig, prompts: list[str],
-                 use_cuda, max_new_tokens=70):
-        input_ids = self.tokenizer(prompts, return_tensors="pt", padding=True).input_ids
+    def evaluate(self, generation_config: GenerationConfig, prompts: list[Union[str, Sequence[int]]],
+                 use_cuda, max_new_tokens=70, prefix_caches: list[PrefixCache] = None):
+        """
+        Generates the answers to `prompts`, given as texts or as token ids (see `create_prompt_ids`).
+        With `prefix_caches` (one per prompt), only the tokens after the prefix each prompt shares with
+        the last prompt of its row are prefilled.
+        The prompts are generated in micro-batches of similar lengths (see `length_buckets`), which are
+        halved when they run out of memory, and the answers are returned in the order of the prompts.
+        """
+        sequences = [self.tokenizer.encode(prompt) if isinstance(prompt, str) else prompt for prompt in prompts]
+        engine = get_generation_engine(self.model)
+        if engine is not None:
+            # Generated in a continuous batch with the other users of the model (see `persons.generation_engine`),
+            # so each answer is done once it's complete, instead of waiting for the longest one.
+            futures = [engine.submit(self.model if self._person_models is None else self._person_models[i], sequence,
+                                     generation_config, max_new_tokens,
+                                     row_stop_criteria(self.tokenizer, self.stop_strings, skip_leading_whitespace=True),
+                                     None if prefix_caches is None else prefix_caches[i])
+                       for i, sequence in enumerate(sequences)]
+            return [self._post_process_output(self.tokenizer.decode([*sequence, *future.result()]))
+                    for sequence, future in zip(sequences, futures)]
+        buckets = length_buckets([len(sequence) for sequence in sequences], max_new_tokens,
+                                 self.micro_batch_tokens)
+        if len(buckets) > 1:
+            log.debug(f"Generating {len(sequences)} prompts in micro-batches of sizes "
+                      f"{[len(bucket) for bucket in buckets]}")
+        pending = [chunk for bucket in buckets for chunk in self._split_micro_batch(bucket)]
+        answers = [None] * len(sequences)
+        while pending:
+            chunk = pending.pop(0)
+            if self.micro_batch_size and len(chunk) > self.micro_batch_size:
+                # Split before the size was halved.
+                pending[:0] = self._split_micro_batch(chunk)
+                continue
+            try:
+                chunk_answers = self._evaluate_micro_batch(
+                    generation_config, [sequences[i] for i in chunk], use_cuda, max_new_tokens,
+                    None if prefix_caches is None else [prefix_caches[i] for i in chunk],
+                    None if self._person_models is None else [self._person_models[i] for i in chunk])
+            except RuntimeError as error:
+                if not is_out_of_memory(error) or len(chunk) == 1:
+                    raise
+                self.micro_batch_size = (len(chunk) + 1) // 2
+                log.warning(f"A micro-batch of {len(chunk)} rows ran out of memory, "
+                            f"retrying with micro-batches of {self.micro_batch_size} rows")
+                free_memory()
+                pending[:0] = self._split_micro_batch(chunk)
+                continue
+            for i, answer in zip(chunk, chunk_answers):
+                answers[i] = answer
+        return answers
+
+    def _split_micro_batch(self, indices: list[int]) -> list[list[int]]:
+        if not self.micro_batch_size:
+            return [indices]
+        return [indices[i:i + self.micro_batch_size] for i in range(0, len(indices), self.micro_batch_size)]
+
+    def _evaluate_micro_batch(self, generation_config: GenerationConfig, sequences: list[Sequence[int]],
+                              use_cuda, max_new_tokens: int, prefix_caches: list[PrefixCache] = None,
+                              models: list = None) -> list[str]:
+        models = models or [self.model] * len(sequences)
+        past_key_values = None if prefix_caches is None else prefill_batch(models, prefix_caches, sequences)
+        input_ids, attention_mask = left_pad(sequences, self.tokenizer.pad_token_id)
         if use_cuda:
-            input_ids = input_ids.cuda()
-
-        generation_output = self.model.generate(
-            input_ids=input_ids,
-            generation_config=generation_config,
-            return_dict_in_generate=True,
-            output_scores=True,
-            max_new_tokens=max_new_tokens,
-            pad_token_id=self.tokenizer.pad_token_id,
-        )
+            input_ids, attention_mask = input_ids.cuda(), attention_mask.cuda()
+
+        with torch.inference_mode():
+            generation_output = batch_model(models).generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                generation_config=generation_config,
+                # The answers are stripped before their first line is kept.
+                stopping_criteria=stopping_criteria(self.tokenizer, self.stop_strings, input_ids.shape[1],
+                                                    skip_leading_whitespace=True),
+                return_dict_in_generate=True,
+                output_scores=True,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
         # Clear expensive GPU memory.
-        del input_ids
+        del input_ids, attention_mask, past_key_values
         gc.collect()
 
         outputs = [self.tokenizer.decode(seq) for seq in generation_output.sequences]
         # print(colored(prompts[0], "blue"))
+        return [self._post_process_output(output) for output in outputs]
 
+    def _post_process_output(self, output: str) -> str:
         # The model returns the new tokens concatenated to the input prompt.
         # Only take the new tokens which is after "### Response:":
         # Also, strip the part which is after the  EOS token ("</s>").
         _, end_seq = self.get_stard_and_end_seq()
-        return [output.split(end_seq)[1].strip().split("</s>")[0].split("\n")[0].strip()
-                for output in outputs]
+        return output.split(end_seq)[1].strip().split("</s>")[0].split("\n")[0].strip()
 
     def create_prompt(self, experiment_scenario: str, chat_list: list[ChatEntry],
                       self_person: InBatchPerson) -> str:
@@ -147,6 +278,30 @@ class PersonHuggingFace(BatchedPerson):
             return self.create_instruct_prompt(experiment_scenario, chat_list, self_person)
         assert False, f"Unknown prompt type: {self.prompt_type}"
 
+    def create_prompt_ids(self, experiment_scenario: str, chat_list: list[ChatEntry],
+                          self_person: InBatchPerson) -> list[int]:
+        """
+        The token ids of `create_prompt`, assembled from the cached ids of its parts, so only the
+        new chat entries are tokenized.
+        """
+        start_seq, end_seq = self.get_stard_and_end_seq()
+        prompt_builder = self._get_prompt_builder(self_person)
+        header = prompt_builder.header(
+            experiment_scenario,
+            lambda: self._render_instruct_header(experiment_scenario, self_person, start_seq))
+        if len(chat_list) > 0:
+            header_ids, history_ids, end_ids = self.prompt_tokenizer.prompt_parts_ids(
+                prompt_builder, chat_list, header, end_seq, self.context_window)
+            # The prompt strips the newline which ends the history (see `_assemble_instruct_prompt`).
+            newline_ids = self.prompt_tokenizer.encode_fixed("\n")
+            last_segment = prompt_builder.segments(chat_list)[-1]
+            if (not last_segment[-2:-1].isspace() and len(history_ids) > len(newline_ids)
+                    and tuple(history_ids[-len(newline_ids):]) == newline_ids
+                    and tuple(header_ids) == self.prompt_tokenizer.encode_fixed(header, add_special_tokens=True)):
+                return [*header_ids, *history_ids[:-len(newline_ids)], *end_ids]
+        # Otherwise, the prompt is stripped elsewhere, and it's tokenized as a whole.
+        return self.tokenizer.encode(self.create_prompt(experiment_scenario, chat_list, self_person))
+
     def get_stard_and_end_seq(self):
         if self.prompt_type == "mistral_instruct":
             return "[INST] ", " [/INST] Me:"
@@ -163,6 +318,43 @@ class PersonHuggingFace(BatchedPerson):
         - LLaMa prompt format: ### Instruction: ... ### Response: <ai_response>
         """
         start_seq, end_seq = self.get_stard_and_end_seq()
+        prompt_builder = self._get_prompt_builder(self_person)
+        output = prompt_builder.header(
+            experiment_scenario,
+            lambda: self._render_instruct_header(experiment_scenario, self_person, start_seq))
+        return self._fit_instruct_prompt(prompt_builder, chat_list, output, end_seq)
+
+    def _render_prompt(self, chat_list: list[ChatEntry], experiment_scenario: str,
+                       self_person: InBatchPerson) -> str:
+        """ Same as `create_prompt`, using the builders of the lazy prompts. """
+        start_seq, end_seq = self.get_stard_and_end_seq()
+        output = self._render_instruct_header(experiment_scenario, self_person, start_seq)
+        prompt_builder = self._get_prompt_builder(self_person, self._lazy_prompt_builders)
+        return self._fit_instruct_prompt(prompt_builder, chat_list, output, end_seq)
+
+    def _fit_instruct_prompt(self, prompt_builder: IncrementalPromptBuilder, chat_list: list[ChatEntry],
+                             header: str, end_seq: str) -> str:
+        if len(chat_list) == 0:
+            return self._assemble_instruct_prompt(header, None, end_seq)
+        if self.context_window is None:
+            return self._assemble_instruct_prompt(header, prompt_builder.text(chat_list), end_seq)
+        return self._assemble_instruct_prompt(
+            *self.context_window.fit(prompt_builder, chat_list, header, end_seq), end_seq)
+
+    @staticmethod
+    def _assemble_instruct_prompt(header: str, history: str | None, end_seq: str) -> str:
+        output = header
+        if history is not None:
+            output += history
+        else:
+            output += "You are the one who starts the debate.\n\n"
+
+        output = output.strip()
+        output += end_seq
+        return output
+
+    def _render_instruct_header(self, experiment_scenario: str, self_person: InBatchPerson,
+                                start_seq: str) -> str:
         output = f"{start_seq}"
         output += (f"Your name is {self_person.name}. Your background narrative is: {self_person.background_story}.\n\n"
                    f"Complete your next reply in the following {experiment_scenario}.\n"
@@ -172,15 +364,21 @@ class PersonHuggingFace(BatchedPerson):
             output += ("Remember, you are role-playing as a real person. You have a strong confirmation bias. "
                        "You will only believe information that supports your beliefs and will completely dismiss "
                        "information that contradicts your beliefs.\n")
+        return output
 
-        if len(chat_list) > 0:
-            for chat_entry in chat_list:
-                cur_person = chat_entry.entity
-                current_name = "Me" if cur_person is self_person else cur_person.name
-                output += f"{current_name}: {chat_entry.answer}\n"
-        else:
-            output += "You are the one who starts the debate.\n\n"
+    def _get_prompt_builder(self, self_person: InBatchPerson,
+                            prompt_builders: list[IncrementalPromptBuilder] = None) -> IncrementalPromptBuilder:
+        prompt_builders = self._prompt_builders if prompt_builders is None else prompt_builders
+        for person, prompt_builder in zip(self.persons, prompt_builders):
+            if person is self_person:
+                return prompt_builder
+        # Not one of our persons, so nothing can be cached for it.
+        return IncrementalPromptBuilder(self._chat_entry_renderer(self_person))
 
-        output = output.strip()
-        output += end_seq
-        return output
+    @staticmethod
+    def _chat_entry_renderer(self_person: InBatchPerson) -> Callable[[ChatEntry], str]:
+        def render_chat_entry(chat_entry: ChatEntry) -> str:
+            cur_person = chat_entry.entity
+            current_name = "Me" if cur_person is self_person else cur_person.name
+            return f"{current_name}: {chat_entry.answer}\n"
+        return render_chat_entry
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+import asyncio
 import dataclasses
+import functools
 from typing import TYPE_CHECKING
 from abc import ABC, abstractmethod
 
@@ -36,10 +38,25 @@ class BatchedPerson(ABC):
         if len(background_stories) != len(names):
             raise ValueError("Each batch person must have the same number of stories and names")
 
+    @classmethod
+    def preload_models(cls, **kwargs):
+        """ Same as `Person.preload_models`. """
+        pass
+
     @property
     def batch_count(self) -> int:
         return len(self.background_stories)
 
+    def checkpoint_state(self):
+        """
+        A JSON serializable state of the batch (without its model), from which
+        `restore_checkpoint_state` continues the session. Stateless batches return None.
+        """
+        return None
+
+    def restore_checkpoint_state(self, state):
+        pass
+
     @abstractmethod
     def generate_answer(
             self, experiment_scenario: str, chat_lists: BatchChatList,*args,**kwargs) -> list[ChatEntry]:
@@ -48,3 +65,13 @@ class BatchedPerson(ABC):
         of the chat lists in `chat_lists`.
         """
         raise NotImplementedError()
+
+    async def agenerate_answer(
+            self, experiment_scenario: str, chat_lists: BatchChatList, *args, **kwargs) -> list[ChatEntry]:
+        """
+        Coroutine version of `generate_answer`.
+        By default, runs `generate_answer` in the default executor of the running event loop.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(self.generate_answer, experiment_scenario, chat_lists, *args, **kwargs))
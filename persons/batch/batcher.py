@@ -23,6 +23,13 @@ class AutoBatchPerson(BatchedPerson):
             person_class(background_story=person_info[0], name=person_info[1], **{**kwargs, **p_kwargs, })
             for person_info in zip(self.background_stories, self.names)]
 
+    def checkpoint_state(self) -> list:
+        return [person.checkpoint_state() for person in self.persons_instances]
+
+    def restore_checkpoint_state(self, state: list):
+        for person, person_state in zip(self.persons_instances, state):
+            person.restore_checkpoint_state(person_state)
+
     def generate_answer(self, experiment_scenario: str, chat_lists: BatchChatList, *args, **kwargs) -> list[ChatEntry]:
         chat_entries = []
         for (person, chat_list) in zip(self.persons_instances, chat_lists):
@@ -0,0 +1,240 @@
+"""
+This file contains the context window of the persons which run a local HuggingFace model.
+
+The prompt of a person renders the whole chat history, so long sessions overflow the context of
+the model (e.g. 4k tokens for the default `microsoft/Phi-3-mini-4k-instruct`), and the attention
+cost keeps growing with the history. A `ContextWindow` fits the prompt into a token budget,
+using a pluggable `ContextWindowPolicy`:
+    - "recent_turns": keeps the header of the prompt and the most recent turns (the default).
+    - "pinned_window": keeps the header, the first turns and a sliding window of the recent turns.
+    - "last_tokens": keeps only the last tokens of the prompt (the header may be dropped).
+
+The token ids of every chat entry are encoded once and cached (see `persons.prompt_tokenizer`), so
+trimming never tokenizes the whole history again.
+
+Persons read the window from the "context_window" key of their configuration:
+    - missing: the default policy, with the context length of the model as the budget.
+    - false: no window, the whole history is always used.
+    - a policy name, or a dict: {"policy": "pinned_window", "max_tokens": 2048, "pinned_turns": 2}
+"""
+from __future__ import annotations
+
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Optional, Sequence, Type, TYPE_CHECKING, Union
+
+from persons.prompt_tokenizer import PromptTokenizer, concat_ids
+
+if TYPE_CHECKING:
+    from persons.prompt_builder import IncrementalPromptBuilder
+    from session_rooms.ChatEntry import ChatEntry
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POLICY = "recent_turns"
+# Tokens of the context kept free for the generated answer.
+DEFAULT_RESERVED_TOKENS = 100
+# Tokenizers without a known context length report a huge `model_max_length`.
+_MAX_KNOWN_CONTEXT = 1_000_000
+# Special tokens (e.g. BOS) added by the tokenizer, which don't appear in the text.
+_SPECIAL_TOKENS_SLACK = 2
+
+
+class ContextWindowPolicy(ABC):
+    """ Chooses which turns of the history are kept when the prompt is longer than the budget. """
+    NAME = None
+    # Whether the header of the prompt (instructions, background story) is always kept. Otherwise,
+    # the header is treated as the oldest part of the history.
+    KEEP_HEADER = True
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    @abstractmethod
+    def select(self, sizes: Sequence[int], budget: int) -> list[int]:
+        """
+        Returns the (ordered) indices of the parts to keep, given the token count of each part
+        and the number of tokens available for all of them.
+        """
+        raise NotImplementedError()
+
+
+def _select_recent(sizes: Sequence[int], budget: int, start: int = 0) -> list[int]:
+    """ The indices of the most recent parts (not before `start`) that fit into `budget`. """
+    first = len(sizes)
+    while first > start and sizes[first - 1] <= budget:
+        first -= 1
+        budget -= sizes[first]
+    return list(range(first, len(sizes)))
+
+
+class RecentTurnsPolicy(ContextWindowPolicy):
+    NAME = "recent_turns"
+
+    def select(self, sizes: Sequence[int], budget: int) -> list[int]:
+        return _select_recent(sizes, budget)
+
+
+class LastTokensPolicy(RecentTurnsPolicy):
+    """ Keeps the last tokens of the prompt. The oldest kept turn may be cut in the middle. """
+    NAME = "last_tokens"
+    KEEP_HEADER = False
+
+
+class PinnedWindowPolicy(ContextWindowPolicy):
+    """ Keeps the first `pinned_turns` turns (e.g. the opening of a debate) and the most recent ones. """
+    NAME = "pinned_window"
+
+    def __init__(self, pinned_turns: int = 2, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pinned_turns = pinned_turns
+
+    def select(self, sizes: Sequence[int], budget: int) -> list[int]:
+        pinned = []
+        for i in range(min(self.pinned_turns, len(sizes))):
+            if sizes[i] > budget:
+                break
+            pinned.append(i)
+            budget -= sizes[i]
+        return pinned + _select_recent(sizes, budget, start=len(pinned))
+
+
+def get_context_window_policy(name: str) -> Optional[Type[ContextWindowPolicy]]:
+    return {
+        RecentTurnsPolicy.NAME: RecentTurnsPolicy,
+        LastTokensPolicy.NAME: LastTokensPolicy,
+        PinnedWindowPolicy.NAME: PinnedWindowPolicy,
+    }.get(name)
+
+
+def get_model_context_length(model: Any = None, tokenizer: Any = None) -> Optional[int]:
+    """ The context length of the model (in tokens), or None if it's unknown. """
+    config = getattr(model, "config", None)
+    for key in ("max_position_embeddings", "n_positions", "max_sequence_length"):
+        value = getattr(config, key, None)
+        if isinstance(value, int) and value > 0:
+            return value
+    value = getattr(tokenizer, "model_max_length", None)
+    if isinstance(value, int) and 0 < value < _MAX_KNOWN_CONTEXT:
+        return value
+    return None
+
+
+class ContextWindow:
+    """
+    Fits the prompts of a person into `max_tokens` tokens, according to `policy`.
+
+    :param tokenizer: the tokenizer of the model the prompts are fed into.
+    """
+
+    def __init__(self, tokenizer: Any, max_tokens: int, policy: ContextWindowPolicy):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.policy = policy
+        self.prompt_tokenizer = PromptTokenizer(tokenizer)
+
+    @classmethod
+    def from_config(cls, config: Union[None, bool, str, dict], tokenizer: Any, model: Any = None,
+                    reserved_tokens: int = DEFAULT_RESERVED_TOKENS) -> Optional[ContextWindow]:
+        """ Creates the window described by the "context_window" configuration of a person. """
+        if config is False:
+            return None
+        if config is None or config is True:
+            config = {}
+        elif isinstance(config, str):
+            config = {"policy": config}
+        config = dict(config)
+        policy_name = config.pop("policy", DEFAULT_POLICY)
+        policy_cls = get_context_window_policy(policy_name)
+        if policy_cls is None:
+            raise ValueError(f"Unknown context window policy: {policy_name}")
+        max_tokens = config.pop("max_tokens", None)
+        if max_tokens is None:
+            context_length = get_model_context_length(model, tokenizer)
+            if context_length is None:
+                log.warning("The context length of the model is unknown, the whole history is used")
+                return None
+            max_tokens = context_length - reserved_tokens
+        return cls(tokenizer, max_tokens, policy_cls(**config))
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False).input_ids)
+
+    def fit(self, prompt_builder: IncrementalPromptBuilder, chat_list: Sequence[ChatEntry],
+            header: str, tail: str = "") -> tuple[str, str]:
+        """
+        Returns the header and the rendered history to put in a prompt of the form
+        `header + history + tail`, such that the prompt fits into the window.
+        When the whole prompt fits, they are the given header and the full history.
+        """
+        history = prompt_builder.text(chat_list)
+        # Every token is at least one byte, so short prompts are never tokenized.
+        text_bytes = len(header.encode()) + len(history.encode()) + len(tail.encode())
+        if text_bytes + _SPECIAL_TOKENS_SLACK <= self.max_tokens:
+            return header, history
+        header_ids = self.prompt_tokenizer.encode_fixed(header, add_special_tokens=True)
+        selection = self._select(prompt_builder, chat_list, header_ids, self.prompt_tokenizer.encode_fixed(tail))
+        if selection is None:
+            return header, history
+
+        keep_header, keep, partial = selection
+        segments = prompt_builder.segments(chat_list)
+        history = "".join(segments[i] for i in keep)
+        if partial is not None:
+            history = self.tokenizer.decode(partial) + history
+        return (header if keep_header else ""), history
+
+    def fit_ids(self, prompt_builder: IncrementalPromptBuilder, chat_list: Sequence[ChatEntry],
+                header_ids: Sequence[int], tail_ids: Sequence[int]) -> tuple[Sequence[int], Sequence[int]]:
+        """ Same as `fit`, with the token ids of the prompt parts (`header_ids` with the special tokens). """
+        selection = self._select(prompt_builder, chat_list, header_ids, tail_ids)
+        if selection is None:
+            return header_ids, prompt_builder.flat_token_ids(chat_list, self.prompt_tokenizer.encode_entry)
+
+        keep_header, keep, partial = selection
+        segments_ids = prompt_builder.token_ids(chat_list, self.prompt_tokenizer.encode_entry)
+        history_ids = concat_ids([partial or (), *(segments_ids[i] for i in keep)])
+        return (header_ids if keep_header else self.prompt_tokenizer.special_ids()), history_ids
+
+    def _select(self, prompt_builder: IncrementalPromptBuilder, chat_list: Sequence[ChatEntry],
+                header_ids: Sequence[int], tail_ids: Sequence[int]
+                ) -> Optional[tuple[bool, list[int], Optional[Sequence[int]]]]:
+        """
+        Chooses the parts of the prompt to keep. Returns None when the whole prompt fits. Otherwise,
+        returns whether the header is kept, the indices of the kept chat entries, and the ids of the
+        end of the part before them which fill the rest of the budget (if any).
+        """
+        sizes = prompt_builder.token_sizes(chat_list, self.prompt_tokenizer.encode_entry)
+        if len(header_ids) + sum(sizes) + len(tail_ids) <= self.max_tokens:
+            return None
+
+        if self.policy.KEEP_HEADER:
+            keep = self.policy.select(sizes, self.max_tokens - len(header_ids) - len(tail_ids))
+            log.debug(f"Context window keeps {len(keep)} of {len(sizes)} chat entries")
+            return True, keep, None
+
+        # The special tokens are added even when the header is dropped.
+        special_count = len(self.prompt_tokenizer.special_ids())
+        segments_ids = prompt_builder.token_ids(chat_list, self.prompt_tokenizer.encode_entry)
+        parts_ids = [header_ids[special_count:], *segments_ids]
+        part_sizes = [len(header_ids) - special_count, *sizes]
+        budget = self.max_tokens - len(tail_ids) - special_count
+        keep = self.policy.select(part_sizes, budget)
+        budget -= sum(part_sizes[i] for i in keep)
+        # The rest of the budget is filled with the end of the part before the kept ones.
+        first = keep[0] if keep else len(parts_ids)
+        partial = parts_ids[first - 1][-budget:] if first > 0 and budget > 0 else None
+        log.debug(f"Context window keeps {len(keep)} of {len(parts_ids)} prompt parts")
+        return 0 in keep, [i - 1 for i in keep if i > 0], partial
+
+
+def truncate_to_last_tokens(inputs: dict, max_source_length: int, special_token_ids: list[int],
+                            model_name: str) -> dict:
+    """
+    A `smart_truncation_func` of `HuggingFaceModel`: keeps the last `max_source_length` tokens
+    of an already tokenized input.
+    """
+    if inputs["input_ids"].shape[-1] <= max_source_length:
+        return inputs
+    log.debug(f"Truncating the input of {model_name} to its last {max_source_length} tokens")
+    return {key: value[-max_source_length:] for key, value in inputs.items()}
@@ -18,6 +18,12 @@ class FakePerson(Person):
         self.things_to_say = kwargs.get("things_to_say")
         self.things_to_say_idx = 0
 
+    def checkpoint_state(self) -> dict:
+        return {"things_to_say_idx": self.things_to_say_idx}
+
+    def restore_checkpoint_state(self, state: dict):
+        self.things_to_say_idx = state["things_to_say_idx"]
+
     def generate_answer(self, *args,**kwargs):
         if self.things_to_say_idx >= len(self.things_to_say):
             raise IndexError()
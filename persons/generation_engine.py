@@ -0,0 +1,300 @@
+"""
+This file contains the generation engine, which batches the generations of every person of the
+process that runs the same local model, across sessions and threads.
+
+Without it, each person calls `model.generate` on its own, so concurrent sessions (e.g. the
+experiments of a sweep worker, see `experiments.sweep`, or the persons of an asynchronous session)
+never share a forward pass, and a batch of the batch session room waits for its longest answer.
+
+There is a single engine per model, with a queue of requests. Callers (in any thread) submit the
+token ids of a prompt and wait for its future. The engine runs continuous (iteration-level)
+batching on a background thread: between two decoding steps, the new requests are prefilled (with
+the prefix cache of their person, see `persons.prefix_cache`) and join the batch, and the finished
+rows leave it. The rows keep the keys and values of their tokens in a single left padded batch, so
+every step computes a single token for all the concurrent requests of the model. Rows of different
+LoRA adapters over the same model share the engine (see `persons.lora_adapters`), and batch persons
+submit each one of their rows instead of generating their micro-batches.
+
+The engine samples with the temperature, top-k and top-p of the generation configuration of each
+request (or greedily, without `do_sample`), and stops a row on EOS, on its stop strings
+(see `persons.stop_strings`) or after `max_new_tokens` tokens.
+
+The engine is enabled by the "generation_engine" key of the configuration:
+{"max_batch_size": 32}, the most rows decoded together.
+"""
+from __future__ import annotations
+
+import logging
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Hashable, Optional, Sequence
+
+import torch
+from transformers import GenerationConfig
+
+from persons.lora_adapters import LoraAdapterModel, batch_model
+from persons.prefix_cache import PastKeyValues, PrefixCache, to_legacy
+from persons.stop_strings import StopStringsCriteria
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_BATCH_SIZE = 32
+# How long an idle engine keeps its thread before it exits.
+_IDLE_SECONDS = 1.0
+
+
+@dataclass
+class _Request:
+    model: Any
+    input_ids: list[int]
+    generation_config: GenerationConfig
+    max_new_tokens: int
+    stop_criteria: Optional[StopStringsCriteria]
+    prefix_cache: Optional[PrefixCache]
+    eos_token_ids: list[int] = field(default_factory=list)
+    future: Future = field(default_factory=Future)
+
+
+@dataclass
+class _Row:
+    request: _Request
+    # The tokens whose keys and values are in the batch (the last generated token isn't fed yet).
+    length: int
+    generated: list[int] = field(default_factory=list)
+
+
+class GenerationEngine:
+    """ Generates the requests submitted for a single model, in a continuous batch of up to `max_batch_size` rows. """
+
+    def __init__(self, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE):
+        self.max_batch_size = max_batch_size
+        self._pending: list[_Request] = []
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        # The batch: its rows, the keys and values of their tokens, and which of them aren't padding.
+        self._rows: list[_Row] = []
+        self._past_key_values: Optional[PastKeyValues] = None
+        self._attention_mask: Optional[torch.Tensor] = None
+        self.requests = 0
+        self.generated_tokens = 0
+        self.steps = 0
+        self.busy_seconds = 0.0
+
+    def submit(self, model: Any, input_ids: Sequence[int], generation_config: GenerationConfig = None,
+               max_new_tokens: int = None, stop_criteria: StopStringsCriteria = None,
+               prefix_cache: PrefixCache = None) -> Future:
+        """
+        Submits the generation of a continuation of `input_ids` by `model` (the model of the engine, or
+        a LoRA adapter over it). Returns a future of the generated token ids, without the prompt.
+        The keys and values of the prompt and the answer are kept in `prefix_cache` (if any).
+        """
+        generation_config = generation_config or model.generation_config
+        # As in `generate`, the EOS of the model applies unless the generation configuration sets its own.
+        eos_token_id = generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = model.generation_config.eos_token_id
+        eos_token_ids = eos_token_id if isinstance(eos_token_id, list) else [eos_token_id]
+        request = _Request(model, list(input_ids), generation_config,
+                           max_new_tokens or generation_config.max_new_tokens or 20, stop_criteria, prefix_cache,
+                           [token_id for token_id in eos_token_ids if token_id is not None])
+        with self._condition:
+            self._pending.append(request)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="generation_engine", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return request.future
+
+    def generate(self, *args, **kwargs) -> list[int]:
+        """ Same as `submit`, waiting for the generated token ids. """
+        return self.submit(*args, **kwargs).result()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._rows and not self._pending:
+                    self._condition.wait(_IDLE_SECONDS)
+                    if not self._pending:
+                        self._thread = None
+                        self.log_stats()
+                        return
+                admitted = self._pending[:self.max_batch_size - len(self._rows)]
+                del self._pending[:len(admitted)]
+            start = time.perf_counter()
+            try:
+                for request in admitted:
+                    self._admit(request)
+                if self._rows:
+                    self._step()
+            except Exception as error:
+                log.exception("The generation engine failed")
+                for request in admitted + [row.request for row in self._rows]:
+                    if not request.future.done():
+                        request.future.set_exception(error)
+                self._rows, self._past_key_values, self._attention_mask = [], None, None
+            self.busy_seconds += time.perf_counter() - start
+
+    def _admit(self, request: _Request):
+        """ Prefills the prompt of `request`, generates its first token, and adds it to the batch. """
+        self.requests += 1
+        model = request.model
+        input_ids = torch.tensor(request.input_ids, dtype=torch.long)
+        prefix_cache = PrefixCache() if request.prefix_cache is None else request.prefix_cache
+        with torch.inference_mode():
+            # Everything but the last token, reusing the cached prefix.
+            prefix_cache.prefill(model, input_ids)
+            outputs = model(input_ids=input_ids[-1:].unsqueeze(0).to(model.device),
+                            position_ids=torch.tensor([[len(input_ids) - 1]], device=model.device),
+                            past_key_values=prefix_cache.past_key_values if len(prefix_cache) else None,
+                            use_cache=True)
+        past_key_values = to_legacy(outputs.past_key_values)
+        row = _Row(request, len(input_ids))
+        if self._append(row, outputs.logits[0, -1]):
+            self._finish(row, past_key_values)
+            return
+        attention_mask = torch.ones((1, row.length), dtype=torch.long, device=model.device)
+        if not self._rows:
+            self._rows, self._past_key_values, self._attention_mask = [row], past_key_values, attention_mask
+            return
+        # The batch and the new row are left padded to the same length.
+        length = max(self._attention_mask.shape[1], row.length)
+        self._past_key_values = tuple(
+            (torch.cat([_left_pad(key, length), _left_pad(new_key, length)]),
+             torch.cat([_left_pad(value, length), _left_pad(new_value, length)]))
+            for (key, value), (new_key, new_value) in zip(self._past_key_values, past_key_values))
+        self._attention_mask = torch.cat([_left_pad_mask(self._attention_mask, length),
+                                          _left_pad_mask(attention_mask, length)])
+        self._rows.append(row)
+
+    def _step(self):
+        """ Generates the next token of every row of the batch, and removes the finished rows. """
+        rows = self._rows
+        device = self._attention_mask.device
+        attention_mask = torch.cat([self._attention_mask, torch.ones((len(rows), 1), dtype=torch.long,
+                                                                    device=device)], dim=-1)
+        with torch.inference_mode():
+            outputs = batch_model([row.request.model for row in rows])(
+                input_ids=torch.tensor([[row.generated[-1]] for row in rows], device=device),
+                attention_mask=attention_mask,
+                position_ids=torch.tensor([[row.length] for row in rows], device=device),
+                past_key_values=self._past_key_values, use_cache=True)
+        self._past_key_values = to_legacy(outputs.past_key_values)
+        self._attention_mask = attention_mask
+        self.steps += 1
+        kept = []
+        for index, row in enumerate(rows):
+            row.length += 1
+            if self._append(row, outputs.logits[index, -1]):
+                self._finish(row, tuple((key[index:index + 1, :, -row.length:], value[index:index + 1, :, -row.length:])
+                                        for key, value in self._past_key_values))
+            else:
+                kept.append(index)
+        if len(kept) < len(rows):
+            self._keep(kept)
+
+    def _keep(self, indices: list[int]):
+        self._rows = [self._rows[index] for index in indices]
+        if not self._rows:
+            self._past_key_values, self._attention_mask = None, None
+            return
+        # The padding columns of all the remaining rows are dropped.
+        padding = self._attention_mask.shape[1] - max(row.length for row in self._rows)
+        self._past_key_values = tuple((key[indices, :, padding:], value[indices, :, padding:])
+                                      for key, value in self._past_key_values)
+        self._attention_mask = self._attention_mask[indices, padding:]
+
+    def _append(self, row: _Row, logits: torch.Tensor) -> bool:
+        """ Appends the next token of `row`, sampled from `logits`, and returns whether the row is finished. """
+        request = row.request
+        token = _next_token(logits, request.generation_config)
+        row.generated.append(token)
+        self.generated_tokens += 1
+        return (len(row.generated) >= request.max_new_tokens or token in request.eos_token_ids or
+                (request.stop_criteria is not None and
+                 request.stop_criteria.is_finished(torch.tensor(row.generated))))
+
+    @staticmethod
+    def _finish(row: _Row, past_key_values: PastKeyValues):
+        request = row.request
+        if request.prefix_cache is not None:
+            request.prefix_cache.store(torch.tensor(request.input_ids + row.generated), past_key_values)
+        request.future.set_result(row.generated)
+
+    def log_stats(self):
+        if self.requests:
+            log.info(f"Generation engine: {self.requests} requests, {self.generated_tokens} tokens in "
+                     f"{self.steps} batched steps ({self.generated_tokens / max(self.busy_seconds, 1e-9):.1f} "
+                     f"tokens/sec)")
+
+
+def _left_pad(tensor: torch.Tensor, length: int) -> torch.Tensor:
+    return torch.nn.functional.pad(tensor, (0, 0, length - tensor.shape[2], 0))
+
+
+def _left_pad_mask(attention_mask: torch.Tensor, length: int) -> torch.Tensor:
+    return torch.nn.functional.pad(attention_mask, (length - attention_mask.shape[1], 0))
+
+
+def _next_token(logits: torch.Tensor, generation_config: GenerationConfig) -> int:
+    """ Samples the next token from `logits` as `model.generate` does with `generation_config`. """
+    if not generation_config.do_sample:
+        return int(logits.argmax())
+    logits = logits.float() / (generation_config.temperature or 1.0)
+    top_k = generation_config.top_k
+    if top_k:
+        threshold = torch.topk(logits, min(top_k, logits.shape[-1])).values[-1]
+        logits = logits.masked_fill(logits < threshold, float("-inf"))
+    top_p = generation_config.top_p
+    if top_p is not None and top_p < 1.0:
+        sorted_logits, indices = logits.sort()
+        # The least likely tokens outside the top-p mass are removed.
+        removed = sorted_logits.softmax(-1).cumsum(-1) <= 1 - top_p
+        logits = logits.masked_fill(removed.scatter(0, indices, removed), float("-inf"))
+    return int(torch.multinomial(logits.softmax(-1), 1))
+
+
+def _engine_key(model: Any) -> Hashable:
+    # All the adapters over a shared model, and all the lazy handles to a model, share its engine.
+    if isinstance(model, LoraAdapterModel):
+        model = model.shared
+    model_key = getattr(model, "model_key", None)
+    return id(model) if model_key is None else model_key
+
+
+_engines = weakref.WeakValueDictionary()
+_engines_lock = threading.Lock()
+_max_batch_size: Optional[int] = None
+
+
+def get_generation_engine(model: Any) -> Optional[GenerationEngine]:
+    """
+    The engine of `model` (shared by all its users), or None if the engine isn't enabled, or
+    doesn't support the model (e.g. encoder-decoder models).
+    """
+    if _max_batch_size is None or getattr(model.config, "is_encoder_decoder", False):
+        return None
+    with _engines_lock:
+        key = _engine_key(model)
+        engine = _engines.get(key)
+        if engine is None:
+            engine = _engines[key] = GenerationEngine(_max_batch_size)
+        return engine
+
+
+def configure_generation_engine(config: Optional[dict]):
+    """
+    Enables the engine with the "generation_engine" configuration (e.g. {"max_batch_size": 32}), or
+    disables it without one, so the engine of one configuration doesn't apply to the next configurations
+    run by the process.
+    """
+    global _max_batch_size
+    if config is None or config is False:
+        _max_batch_size = None
+        return
+    _max_batch_size = (config if isinstance(config, dict) else {}).get("max_batch_size", DEFAULT_MAX_BATCH_SIZE)
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.max_batch_size = _max_batch_size
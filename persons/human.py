@@ -6,6 +6,7 @@ from session_rooms.ChatEntry import ChatEntry
 
 class Human(Person):
     PERSON_TYPE = "human"
+    INTERACTIVE = True
 
     def __init__(self, background_story: str = None, name: str = None, *args, **kwargs):
         super().__init__(background_story, name, *args, **kwargs)
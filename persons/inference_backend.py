@@ -0,0 +1,164 @@
+"""
+This file contains the inference backends of the persons which run a local HuggingFace model.
+
+By default ("auto"), each person type loads its model as it always did: on the GPUs (with
+`device_map="auto"`), in its own dtype and quantization (e.g. bitsandbytes 8-bit for batch persons),
+which is slow, or fails, on hosts without a GPU.
+
+The "cpu" backend loads the model in float32 on the CPU, and quantizes the weights of its linear
+layers to int8 dynamically (the activations are quantized on the fly, so no calibration is needed),
+which makes the matrix multiplications of decoding faster, and their weights 4 times smaller.
+The threads of PyTorch are process-wide settings: the intra-op threads (which split a single
+operator), the inter-op threads (which run independent operators), and the CPU cores which the
+process is pinned to, so several processes sharing a host (e.g. the workers of a sweep, see
+`experiments.sweep`) don't compete for the same cores.
+
+Persons read their backend from the "backend" key of their configuration: "auto", "cpu", or
+{"device": "cpu", "quantization": "dynamic_int8", "threads": 4, "interop_threads": 1, "cpu_cores": [0, 1, 2, 3]},
+where "quantization" may be null (float32), and "cpu_cores" are the cores the process is pinned to.
+The backend of each model, and the thread settings, are reported in the log.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from dataclasses import dataclass, replace
+from typing import Any, Callable, Optional, Sequence, Union
+
+import torch
+
+from persons.model_registry import ModelKey
+
+log = logging.getLogger(__name__)
+
+AUTO_BACKEND = "auto"
+CPU_BACKEND = "cpu"
+DYNAMIC_INT8 = "dynamic_int8"
+
+
+@dataclass(frozen=True)
+class InferenceBackend:
+    """ Where and how a model runs. """
+    device: str = AUTO_BACKEND
+    quantization: Optional[str] = None
+    # The process-wide thread settings, None to keep the defaults of PyTorch.
+    threads: Optional[int] = None
+    interop_threads: Optional[int] = None
+    cpu_cores: Optional[tuple[int, ...]] = None
+
+    @classmethod
+    def from_config(cls, config: Union[None, str, dict]) -> InferenceBackend:
+        if config is None or config == AUTO_BACKEND:
+            return cls()
+        if config == CPU_BACKEND:
+            config = {"device": CPU_BACKEND}
+        if not isinstance(config, dict) or config.get("device", AUTO_BACKEND) not in (AUTO_BACKEND, CPU_BACKEND):
+            raise ValueError(f"Unknown backend: {config}")
+        device = config.get("device", AUTO_BACKEND)
+        quantization = config.get("quantization", DYNAMIC_INT8 if device == CPU_BACKEND else None)
+        if quantization not in (None, DYNAMIC_INT8) or (quantization and device != CPU_BACKEND):
+            raise ValueError(f"Unknown quantization of the {device} backend: {quantization}")
+        cpu_cores = config.get("cpu_cores")
+        return cls(device, quantization, config.get("threads"), config.get("interop_threads"),
+                   None if cpu_cores is None else tuple(cpu_cores))
+
+    @property
+    def is_cpu(self) -> bool:
+        return self.device == CPU_BACKEND
+
+    def without_quantization(self) -> InferenceBackend:
+        return replace(self, quantization=None)
+
+    def model_key(self, path: str, kind: str) -> ModelKey:
+        """ The registry key of a model loaded on this (CPU) backend. """
+        return ModelKey(path, kind, dtype="float32", quantization=self.quantization, device=CPU_BACKEND)
+
+    def load(self, load: Callable[..., Any], path: str, **kwargs) -> Any:
+        """ Loads the model at `path` on this (CPU) backend, with `load` (e.g. `from_pretrained`). """
+        model = load(path, torch_dtype=torch.float32, low_cpu_mem_usage=True, **kwargs)
+        model.eval()
+        if self.quantization == DYNAMIC_INT8:
+            # Imported here, as the quantization modules are only needed by this backend.
+            from torch.ao.quantization import quantize_dynamic
+            model = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        log.info(f"Prepared {path} for the {self.device} backend ({self.quantization or 'float32'}, "
+                 f"{torch.get_num_threads()} threads)")
+        return model
+
+    def configure(self):
+        """ Applies the process-wide thread settings of this backend (see `configure_threads`). """
+        if self.threads or self.interop_threads or self.cpu_cores:
+            configure_threads(self.threads, self.interop_threads, self.cpu_cores)
+
+
+_threads_lock = threading.Lock()
+# The settings applied so far, as they are shared by all the backends of the process.
+_applied: dict[str, Any] = {}
+
+
+def configure_threads(threads: int = None, interop_threads: int = None, cpu_cores: Sequence[int] = None):
+    """
+    Pins the process to `cpu_cores`, and sets the intra-op and inter-op threads of PyTorch (by
+    default, one intra-op thread per pinned core).
+    """
+    with _threads_lock:
+        if cpu_cores:
+            cpu_cores = tuple(cpu_cores)
+            _apply("cpu_cores", cpu_cores, lambda: pin_process(cpu_cores))
+            threads = threads or len(cpu_cores)
+        if threads:
+            _apply("threads", threads, lambda: torch.set_num_threads(threads))
+        if interop_threads:
+            _apply("interop_threads", interop_threads, lambda: torch.set_num_interop_threads(interop_threads))
+
+
+def _apply(name: str, value: Any, apply: Callable[[], Any]):
+    if name in _applied:
+        if _applied[name] != value:
+            log.warning(f"The {name} of the process are already set to {_applied[name]}, ignoring {value}")
+        return
+    try:
+        apply()
+    except RuntimeError as error:
+        # e.g. the inter-op threads can't change once PyTorch has used them.
+        log.warning(f"Unable to set the {name} of the process to {value}: {error}")
+        return
+    _applied[name] = value
+    log.info(f"CPU backend: set the {name} of the process to {value}")
+
+
+def pin_process(cores: Sequence[int]):
+    """
+    Pins every thread of the process to `cores`. Threads created later inherit the cores of the
+    thread which creates them (`os.sched_setaffinity` only pins the calling thread on Linux).
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        raise RuntimeError("Pinning to cores isn't supported on this platform")
+    task_dir = "/proc/self/task"
+    thread_ids = [int(thread_id) for thread_id in os.listdir(task_dir)] if os.path.isdir(task_dir) else [0]
+    for thread_id in thread_ids:
+        try:
+            os.sched_setaffinity(thread_id, cores)
+        except ProcessLookupError:
+            # The thread exited meanwhile.
+            pass
+
+
+def split_cores(parts: int) -> list[Optional[tuple[int, ...]]]:
+    """
+    The available cores of the process, split into `parts` disjoint sets of neighbouring cores, or
+    None for each part if there are fewer cores than parts.
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    if len(cores) < parts:
+        return [None] * parts
+    size = len(cores) // parts
+    return [tuple(cores[i * size:(i + 1) * size]) for i in range(parts)]
+
+
+def get_backend(config: Union[None, str, dict]) -> InferenceBackend:
+    """ The backend of a "backend" configuration, with its thread settings applied to the process. """
+    backend = InferenceBackend.from_config(config)
+    backend.configure()
+    return backend
@@ -0,0 +1,162 @@
+"""
+This file contains the multi-LoRA backend, which serves many persons fine-tuned as LoRA adapters
+over a single copy of their base model.
+
+The base model is loaded once through the model registry (see `persons.model_registry`) as a
+`MultiLoraModel`, and the adapter of every person is loaded into it under its own name, so 10
+personas cost one base model and 10 small adapters. A person holds a `LoraAdapterModel`, which runs
+the shared model with its adapter. Rows of different adapters generate together: peft applies the
+adapter of each row in the same forward pass (its `adapter_names` argument), so persons that differ
+only by their adapter answer in a single batch (see `batch_model`).
+
+Persons read the adapter from the "adapter_path" key of their configuration: a directory saved by
+peft, whose base model is their "model_path". Persons without an adapter load the plain base model,
+which isn't shared with the persons that have adapters.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from typing import Any, Callable, Optional, Sequence, Union
+
+from persons.model_registry import ModelKey
+
+log = logging.getLogger(__name__)
+
+ADAPTER_CONFIG_FILE = "adapter_config.json"
+# The name peft gives to the rows of a batch which run the base model without an adapter.
+BASE_ADAPTER_NAME = "__base__"
+
+
+def adapter_base_model(path: str) -> Optional[str]:
+    """ The base model of the LoRA adapter saved at `path`, or None if it isn't an adapter. """
+    config_path = os.path.join(path, ADAPTER_CONFIG_FILE)
+    if not os.path.isfile(config_path):
+        return None
+    with open(config_path, 'r') as f:
+        return json.load(f).get("base_model_name_or_path")
+
+
+def lora_model_spec(base_key: ModelKey, load_base: Callable[[], Any]) -> tuple[ModelKey, Callable]:
+    """ The registry key and loader of the `MultiLoraModel` sharing the base model of `base_key`. """
+    return base_key._replace(kind=f"{base_key.kind}_lora"), lambda: MultiLoraModel(load_base())
+
+
+def _batch_size(kwargs: dict) -> int:
+    inputs = kwargs.get("input_ids")
+    if inputs is None:
+        inputs = kwargs["inputs_embeds"]
+    return inputs.shape[0]
+
+
+class MultiLoraModel:
+    """
+    A base model shared by the LoRA adapters loaded into it. Used directly, it runs the base model
+    (e.g. to autotune the micro-batch size); its other attributes are those of the base model.
+    """
+
+    def __init__(self, base_model: Any):
+        self.base_model = base_model
+        self.peft_model = None
+        # The name of every loaded adapter, by its path.
+        self.adapter_names: dict[str, str] = {}
+        # peft passes the adapters of the rows to the layers by hooks on the shared modules, so only
+        # one forward pass (or generation) runs at a time.
+        self.lock = threading.RLock()
+
+    def load_adapter(self, adapter_path: str) -> str:
+        """ Returns the name of the adapter saved at `adapter_path`, loading it if needed. """
+        with self.lock:
+            name = self.adapter_names.get(adapter_path)
+            if name is not None:
+                return name
+            # Imported here, as only persons with adapters need peft.
+            from peft import PeftModel
+            name = f"adapter_{len(self.adapter_names)}"
+            if self.peft_model is None:
+                self.peft_model = PeftModel.from_pretrained(self.base_model, adapter_path, adapter_name=name)
+                self.peft_model.eval()
+            else:
+                self.peft_model.load_adapter(adapter_path, adapter_name=name)
+            self.adapter_names[adapter_path] = name
+            log.info(f"Loaded LoRA adapter {adapter_path} over {self.base_model.name_or_path}")
+            return name
+
+    def run(self, method: Optional[str], adapter_names: Sequence[str], *args, **kwargs) -> Any:
+        """ Calls the model (or its `method`), applying `adapter_names[i]` to the i-th row. """
+        with self.lock:
+            if self.peft_model is None:
+                model = self.base_model
+            else:
+                model = self.peft_model
+                kwargs["adapter_names"] = list(adapter_names)
+            return (model if method is None else getattr(model, method))(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        return self.run(None, [BASE_ADAPTER_NAME] * _batch_size(kwargs), *args, **kwargs)
+
+    def generate(self, *args, **kwargs):
+        return self.run("generate", [BASE_ADAPTER_NAME] * _batch_size(kwargs), *args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__") or name in ("base_model", "peft_model", "adapter_names", "lock"):
+            raise AttributeError(name)
+        return getattr(self.base_model, name)
+
+
+class LoraAdapterModel:
+    """
+    The shared model of a `MultiLoraModel` (or a lazy handle to it), which applies the adapter of
+    `adapter_paths` to every row, or `adapter_paths[i]` to the i-th row (None for the base model).
+    Its other attributes are those of the base model.
+    """
+
+    def __init__(self, shared: Any, adapter_paths: Union[None, str, Sequence[Optional[str]]]):
+        self.shared = shared
+        self.adapter_paths = adapter_paths
+        self.model_key: Optional[ModelKey] = getattr(shared, "model_key", None)
+
+    def _adapter_names(self, kwargs: dict) -> list[str]:
+        if self.adapter_paths is None or isinstance(self.adapter_paths, str):
+            return [self._adapter_name(self.adapter_paths)] * _batch_size(kwargs)
+        return [self._adapter_name(adapter_path) for adapter_path in self.adapter_paths]
+
+    def _adapter_name(self, adapter_path: Optional[str]) -> str:
+        return BASE_ADAPTER_NAME if adapter_path is None else self.shared.load_adapter(adapter_path)
+
+    def __call__(self, *args, **kwargs):
+        return self.shared.run(None, self._adapter_names(kwargs), *args, **kwargs)
+
+    def generate(self, *args, **kwargs):
+        return self.shared.run("generate", self._adapter_names(kwargs), *args, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__") or name in ("shared", "adapter_paths", "model_key"):
+            raise AttributeError(name)
+        return getattr(self.shared, name)
+
+    def __repr__(self) -> str:
+        return f"LoraAdapterModel({self.adapter_paths} over {self.shared!r})"
+
+
+def _same_model(model: Any, other: Any) -> bool:
+    model, other = [m.shared if isinstance(m, LoraAdapterModel) else m for m in (model, other)]
+    # Persons may hold separate lazy handles to the same model of the registry.
+    model_key = getattr(model, "model_key", None)
+    return model is other or (model_key is not None and model_key == getattr(other, "model_key", None))
+
+
+def batch_model(models: Sequence[Any]) -> Any:
+    """
+    The model which generates a batch whose i-th row belongs to `models[i]`: the shared model with
+    the adapter of every row for LoRA adapters of the same base model, otherwise the (single) model
+    of the rows.
+    """
+    if any(not _same_model(model, models[0]) for model in models):
+        raise ValueError("The rows of a batch must share a single model")
+    if all(isinstance(model, LoraAdapterModel) and
+           (model.adapter_paths is None or isinstance(model.adapter_paths, str)) for model in models):
+        return LoraAdapterModel(models[0].shared, [model.adapter_paths for model in models])
+    return models[0]
@@ -0,0 +1,347 @@
+"""
+This file contains the planner of the precision and placement of the models of a configuration.
+
+Without it, every person type loads its model in its own way (e.g. float32 for the persons of
+`persons.person_hugging_face`, 8-bit for batch persons and bfloat16 for `HuggingFaceModel`), on
+the devices chosen by `device_map="auto"`, so configurations with several models (e.g. separate
+generation and scheduling models) run out of memory once their models are loaded one after another.
+
+The planner knows all the models of the configuration before any of them loads: the experiment
+runs the `preload_models` of the persons twice, and the first (dry) run only collects the models
+which would be loaded (see `planned_model_spec`). The size of each model is estimated from the
+shapes in its safetensors checkpoint (or from its configuration), with a margin for the attention
+cache and the activations. Then every model starts at the best precision of the device (16-bit on
+GPUs, float32 on CPUs), and the largest model is quantized one step further (8-bit, then 4-bit
+with bitsandbytes on GPUs, dynamic int8 on CPUs, see `persons.inference_backend`) until all the
+models fit into the budget. Models which don't fit even then are split between the GPUs and the
+CPU. Each model gets its share of every GPU (`max_memory`), so models loaded later don't find the
+GPUs already full. The plan and its estimated footprint are logged, and the second run loads the
+models as planned.
+
+Persons whose "backend" is "cpu" keep their own settings. The planner is enabled by the "plan" key
+of the "models" configuration: true, or {"gpu_memory_gb": 24, "cpu_memory_gb": 64, "overhead": 0.2},
+the memory of each GPU and of the CPU (the free memory by default) and the margin of the models. The
+"memory_budget_gb" of the models bounds the total footprint of the plan as well.
+"""
+from __future__ import annotations
+
+import glob
+import importlib.util
+import json
+import logging
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterator, NamedTuple, Optional
+
+import torch
+
+from persons.inference_backend import CPU_BACKEND, DYNAMIC_INT8, InferenceBackend
+from persons.lora_adapters import lora_model_spec
+from persons.model_registry import ModelKey, get_model_registry
+
+log = logging.getLogger(__name__)
+
+_BYTES_PER_GB = 1024 ** 3
+DEFAULT_OVERHEAD = 0.2
+# The share of the free memory of each device that the plan may use.
+_FREE_MEMORY_SHARE = 0.9
+OFFLOAD = "offload"
+# The bytes of a weight at each precision.
+_PRECISION_BYTES = {"float32": 4, "bfloat16": 2, "float16": 2, "8bit": 1, "4bit": 0.5, DYNAMIC_INT8: 1}
+
+
+class ModelRequest(NamedTuple):
+    """ A model that a person of the configuration loads. """
+    path: str
+    # The kind of the model, as in `persons.model_registry.ModelKey`.
+    kind: str
+    lora: bool = False
+
+
+@dataclass
+class ModelPlacement:
+    """ The precision and placement of a single model. """
+    precision: str
+    # "cuda", "cpu", or "offload" (split between the GPUs and the CPU).
+    device: str
+    estimated_bytes: int
+    # The most memory of the model on each device, as `max_memory` of `from_pretrained`.
+    max_memory: Optional[dict] = field(default=None, compare=False)
+
+    def model_key(self, path: str, kind: str) -> ModelKey:
+        is_quantized = self.precision in ("8bit", "4bit", DYNAMIC_INT8)
+        return ModelKey(path, kind, dtype=None if is_quantized else self.precision,
+                        quantization=self.precision if is_quantized else None, device=self.device)
+
+    def load(self, load: Callable[..., Any], path: str, **kwargs) -> Any:
+        """ Loads the model at `path` with `load` (e.g. `AutoModelForCausalLM.from_pretrained`) as planned. """
+        if self.device == CPU_BACKEND:
+            backend = InferenceBackend(CPU_BACKEND, DYNAMIC_INT8 if self.precision == DYNAMIC_INT8 else None)
+            return backend.load(load, path, **kwargs)
+        if self.precision in ("8bit", "4bit"):
+            # Imported here, as only GPU hosts (with bitsandbytes) quantize to 8 or 4 bits.
+            from transformers import BitsAndBytesConfig
+            kwargs["quantization_config"] = (
+                BitsAndBytesConfig(load_in_8bit=True) if self.precision == "8bit" else
+                BitsAndBytesConfig(load_in_4bit=True, bnb_4bit_use_double_quant=True, bnb_4bit_quant_type="nf4",
+                                   bnb_4bit_compute_dtype=torch.bfloat16))
+        else:
+            kwargs["torch_dtype"] = getattr(torch, self.precision)
+        model = load(path, device_map="auto", max_memory=self.max_memory, **kwargs)
+        model.eval()
+        return model
+
+    def __str__(self) -> str:
+        return f"{self.precision} on {self.device}, {self.estimated_bytes / _BYTES_PER_GB:.2f} GB"
+
+
+@dataclass
+class _Parameters:
+    total: int
+    # The parameters of the input embeddings, which dynamic quantization keeps in float32.
+    embeddings: int
+
+
+def _safetensors_parameters(path: str) -> Optional[_Parameters]:
+    """ The parameters in the safetensors checkpoint of the local model at `path`, read from the headers only. """
+    files = glob.glob(os.path.join(path, "*.safetensors"))
+    if not files:
+        return None
+    total = embeddings = 0
+    for file_path in files:
+        with open(file_path, "rb") as f:
+            header = json.loads(f.read(struct.unpack("<Q", f.read(8))[0]))
+        for name, tensor in header.items():
+            if name == "__metadata__":
+                continue
+            count = 1
+            for dimension in tensor["shape"]:
+                count *= dimension
+            total += count
+            if "embed" in name:
+                embeddings += count
+    return _Parameters(total, embeddings)
+
+
+def _config_parameters(path: str) -> Optional[_Parameters]:
+    """ The parameters of a transformer with the configuration of the model at `path`, roughly. """
+    # Imported here, as the planner itself doesn't depend on `transformers`.
+    from transformers import AutoConfig
+    try:
+        # As the persons load their models, with their custom code (e.g. Phi-3 on older versions of `transformers`).
+        config = AutoConfig.from_pretrained(path, trust_remote_code=True)
+    except (OSError, ValueError) as error:
+        log.error(f"Unable to read the configuration of {path}: {error}")
+        return None
+    hidden = getattr(config, "hidden_size", None) or getattr(config, "d_model", None)
+    layers = getattr(config, "num_hidden_layers", None) or getattr(config, "num_layers", None)
+    if not hidden or not layers:
+        log.error(f"The configuration of {path} has no hidden size or number of layers")
+        return None
+    intermediate = (getattr(config, "intermediate_size", None) or getattr(config, "d_ff", None)
+                    or 4 * hidden)
+    embeddings = config.vocab_size * hidden
+    # The attention projections, and the (gated, for most recent models) feed-forward layers.
+    layer = 4 * hidden * hidden + 3 * hidden * intermediate
+    if getattr(config, "is_encoder_decoder", False):
+        # The decoder layers also attend to the encoder.
+        layers += getattr(config, "num_decoder_layers", None) or layers
+        layer += 2 * hidden * hidden
+    output_embeddings = 0 if getattr(config, "tie_word_embeddings", True) else embeddings
+    return _Parameters(layers * layer + embeddings + output_embeddings, embeddings)
+
+
+def estimate_parameters(path: str) -> Optional[_Parameters]:
+    parameters = _safetensors_parameters(path) if os.path.isdir(path) else None
+    return parameters or _config_parameters(path)
+
+
+def _weights_bytes(parameters: _Parameters, precision: str) -> int:
+    if precision == DYNAMIC_INT8:
+        # Only the linear layers are quantized.
+        return int(parameters.total + 3 * parameters.embeddings)
+    return int(parameters.total * _PRECISION_BYTES[precision])
+
+
+@dataclass
+class _PlanConfig:
+    # The memory of each GPU and of the CPU, None for their free memory.
+    gpu_memory: Optional[int] = None
+    cpu_memory: Optional[int] = None
+    total_memory: Optional[int] = None
+    overhead: float = DEFAULT_OVERHEAD
+
+
+def _gpu_budgets(config: _PlanConfig) -> list[int]:
+    if not torch.cuda.is_available():
+        return []
+    return [config.gpu_memory or int(torch.cuda.mem_get_info(device)[0] * _FREE_MEMORY_SHARE)
+            for device in range(torch.cuda.device_count())]
+
+
+def _cpu_budget(config: _PlanConfig) -> Optional[int]:
+    if config.cpu_memory:
+        return config.cpu_memory
+    try:
+        return int(os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") * _FREE_MEMORY_SHARE)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _precisions(request: ModelRequest, on_gpu: bool) -> list[str]:
+    """ The precisions a model may take, from the best to the smallest. """
+    if not on_gpu:
+        # The adapters wrap the linear layers, which can't be dynamically quantized under them.
+        return ["float32"] if request.lora else ["float32", DYNAMIC_INT8]
+    precisions = ["bfloat16" if torch.cuda.is_bf16_supported() else "float16"]
+    if importlib.util.find_spec("bitsandbytes") is not None:
+        precisions += ["8bit", "4bit"]
+    return precisions
+
+
+def plan_placements(requests: list[ModelRequest], config: _PlanConfig) -> dict[ModelRequest, ModelPlacement]:
+    """ The precision and placement of every one of `requests`, such that all of them fit into the budget. """
+    requests = list(dict.fromkeys(requests))
+    parameters = {request: estimate_parameters(request.path) for request in requests}
+    unknown = [request for request in requests if parameters[request] is None]
+    if unknown:
+        log.error(f"Unable to estimate the size of {[request.path for request in unknown]} (see above), so they "
+                  f"are loaded without a plan, and may not fit into the budget with the planned models")
+    requests = [request for request in requests if parameters[request] is not None]
+    gpu_budgets = _gpu_budgets(config)
+    on_gpu = bool(gpu_budgets)
+    budget = sum(gpu_budgets) if on_gpu else _cpu_budget(config)
+    if config.total_memory is not None:
+        budget = config.total_memory if budget is None else min(budget, config.total_memory)
+    precisions = {request: _precisions(request, on_gpu) for request in requests}
+    levels = {request: 0 for request in requests}
+
+    def footprint(request: ModelRequest, level: int = None) -> int:
+        precision = precisions[request][levels[request] if level is None else level]
+        return int(_weights_bytes(parameters[request], precision) * (1 + config.overhead))
+
+    # The largest model which can still be quantized further is quantized, until all of them fit.
+    while budget is not None and sum(footprint(request) for request in requests) > budget:
+        smaller = [request for request in requests if levels[request] + 1 < len(precisions[request])]
+        if not smaller:
+            break
+        largest = max(smaller, key=lambda request: footprint(request) - footprint(request, levels[request] + 1))
+        levels[largest] += 1
+    total = sum(footprint(request) for request in requests)
+    fits = budget is None or total <= budget
+    if not on_gpu:
+        if not fits:
+            log.warning(f"The models take {total / _BYTES_PER_GB:.2f} GB, more than the budget of "
+                        f"{budget / _BYTES_PER_GB:.2f} GB")
+        return {request: ModelPlacement(precisions[request][levels[request]], CPU_BACKEND, footprint(request))
+                for request in requests}
+    if fits:
+        # Every model gets its share of every GPU, so the models loaded first don't fill them.
+        return {request: ModelPlacement(precisions[request][levels[request]], "cuda", footprint(request),
+                                        _max_memory(footprint(request) / total, gpu_budgets, config))
+                for request in requests}
+    # Even the smallest precisions don't fit, so the 16-bit models are split between the GPUs and the CPU.
+    levels = {request: 0 for request in requests}
+    total = sum(footprint(request) for request in requests)
+    cpu_budget = _cpu_budget(config)
+    offloaded = total - sum(gpu_budgets)
+    if cpu_budget is not None and offloaded > cpu_budget:
+        log.warning(f"The models take {total / _BYTES_PER_GB:.2f} GB, more than the GPUs and the CPU together")
+    return {request: ModelPlacement(precisions[request][0], OFFLOAD, footprint(request),
+                                    _max_memory(footprint(request) / total, gpu_budgets, config,
+                                                cpu=offloaded * footprint(request) / total))
+            for request in requests}
+
+
+def _max_memory(share: float, gpu_budgets: list[int], config: _PlanConfig, cpu: float = 0) -> dict:
+    # The weights take the memory of the model without its margin.
+    max_memory = {device: int(share * budget / (1 + config.overhead)) for device, budget in enumerate(gpu_budgets)}
+    if cpu:
+        max_memory["cpu"] = int(cpu / (1 + config.overhead))
+    return max_memory
+
+
+_config: Optional[_PlanConfig] = None
+_placements: dict[ModelRequest, ModelPlacement] = {}
+_placements_lock = threading.Lock()
+# The models requested by the dry run of the current thread, if it's collecting them.
+_collecting = threading.local()
+
+
+def planned_model_spec(path: str, kind: str, load: Callable[..., Any], lora: bool = False,
+                       **kwargs) -> Optional[tuple[ModelKey, Callable]]:
+    """
+    The spec of the model of `path` as planned, loaded with `load` (e.g. `from_pretrained`, with the
+    other keyword arguments), or None if it isn't planned (then it's loaded with its default spec).
+    """
+    request = ModelRequest(path, kind, lora)
+    requests = getattr(_collecting, "requests", None)
+    if requests is not None:
+        requests.append(request)
+        return None
+    with _placements_lock:
+        placement = _placements.get(request)
+    if placement is None:
+        return None
+    key = placement.model_key(path, kind)
+    load_planned = lambda: placement.load(load, path, **kwargs)
+    return lora_model_spec(key, load_planned) if lora else (key, load_planned)
+
+
+@contextmanager
+def _collect_requests() -> Iterator[list[ModelRequest]]:
+    _collecting.requests = []
+    try:
+        with get_model_registry().dry_run():
+            yield _collecting.requests
+    finally:
+        del _collecting.requests
+
+
+def plan_and_preload(preload: Callable[[], Any]):
+    """
+    Runs `preload`, which preloads the models of the persons of a configuration (see
+    `Person.preload_models`), with the models planned to fit into the budget (if the planner is enabled).
+    """
+    if _config is not None:
+        with _collect_requests() as requests:
+            preload()
+        placements = plan_placements(requests, _config)
+        with _placements_lock:
+            _placements.update(placements)
+        log_plan(placements)
+    preload()
+
+
+def log_plan(placements: dict[ModelRequest, ModelPlacement]):
+    if not placements:
+        return
+    total = sum(placement.estimated_bytes for placement in placements.values())
+    lines = [f"{request.kind} {request.path}{' (LoRA base)' if request.lora else ''}: {placement}"
+             for request, placement in placements.items()]
+    log.info(f"Model plan (estimated {total / _BYTES_PER_GB:.2f} GB):\n" + "\n".join(lines))
+
+
+def configure_model_planner(config: Optional[dict]):
+    """
+    Enables the planner with the "models" configuration (e.g. {"plan": {"gpu_memory_gb": 24}}), or
+    disables it if the configuration has no plan, as the plan of one configuration shouldn't apply to the
+    next configurations run by the process.
+    """
+    global _config
+    plan = (config or {}).get("plan")
+    if plan is None or plan is False:
+        _config = None
+        return
+    plan = plan if isinstance(plan, dict) else {}
+    memory_budget_gb = config.get("memory_budget_gb")
+    _config = _PlanConfig(
+        gpu_memory=_bytes(plan.get("gpu_memory_gb")), cpu_memory=_bytes(plan.get("cpu_memory_gb")),
+        total_memory=_bytes(memory_budget_gb), overhead=plan.get("overhead", DEFAULT_OVERHEAD))
+
+
+def _bytes(gigabytes: Optional[float]) -> Optional[int]:
+    return None if gigabytes is None else int(gigabytes * _BYTES_PER_GB)
@@ -0,0 +1,316 @@
+"""
+This file contains the process-wide registry of the models (and tokenizers) loaded by the persons.
+
+Every person type which runs a local model loads it through the registry, keyed by the model path,
+the kind of object (e.g. a tokenizer or a causal LM), its dtype, quantization and device. So persons
+of different types which use the same checkpoint with the same settings share a single copy of it,
+and a sweep which runs many configurations in one process loads each model once.
+
+The registry counts the persons (or other owners) referencing each model, and releases a reference
+when its owner is garbage collected. Models without references stay resident, as the next
+configuration will likely use them again, until the resident models exceed the memory budget. Then
+the least recently used models without references are evicted.
+
+Loading is done by a pool of background threads. Before the persons are created, the experiment
+starts loading every model named in the configuration (see `Person.preload_models`), so distinct
+models load in parallel (`from_pretrained` memory-maps safetensors checkpoints). Persons hold a
+`LazyModel` handle, which waits for its model only when it's first used, so creating the persons
+doesn't block on loading.
+
+The budget is read from the "models" key of the configuration: {"memory_budget_gb": 40}, and the
+number of models loaded in parallel from {"preload_workers": 4}.
+"""
+from __future__ import annotations
+
+import gc
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, NamedTuple, Optional
+
+import torch
+
+log = logging.getLogger(__name__)
+
+_BYTES_PER_GB = 1024 ** 3
+DEFAULT_PRELOAD_WORKERS = 4
+
+
+class ModelKey(NamedTuple):
+    """ What makes two loaded models interchangeable. """
+    path: str
+    # The kind of loaded object, e.g. "tokenizer", "causal_lm" or "seq2seq_lm".
+    kind: str
+    dtype: Optional[str] = None
+    quantization: Optional[str] = None
+    device: Optional[str] = None
+
+
+@dataclass
+class _Entry:
+    value: Any
+    size: int
+    references: int = 0
+
+
+def model_size(value: Any) -> int:
+    """ The memory taken by the parameters and buffers of a model (0 for tokenizers). """
+    if hasattr(value, "get_memory_footprint"):
+        return value.get_memory_footprint() + _packed_size(value)
+    if isinstance(value, torch.nn.Module):
+        tensors = list(value.parameters()) + list(value.buffers())
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors) + _packed_size(value)
+    return 0
+
+
+def _packed_size(model: Any) -> int:
+    # The weights of dynamically quantized linear layers (see `persons.inference_backend`) are packed
+    # outside of the parameters.
+    size = 0
+    for module in model.modules():
+        if hasattr(module, "_packed_params") and callable(getattr(module, "weight", None)):
+            tensors = [module.weight(), module.bias()]
+            size += sum(tensor.numel() * tensor.element_size() for tensor in tensors if tensor is not None)
+    return size
+
+
+class ModelRegistry:
+    """
+    Loads every model once, and evicts the least recently used unreferenced models once the
+    resident models take more than `memory_budget` bytes (None for no budget).
+    """
+
+    def __init__(self, memory_budget: Optional[int] = None, preload_workers: int = DEFAULT_PRELOAD_WORKERS):
+        self.memory_budget = memory_budget
+        # Ordered from the least to the most recently used.
+        self._entries: OrderedDict[ModelKey, _Entry] = OrderedDict()
+        # The models which are being loaded.
+        self._loading: dict[ModelKey, Future] = {}
+        self._lock = threading.RLock()
+        self._preload_workers = preload_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # Whether the preloads of a thread are skipped (see `dry_run`).
+        self._dry_run = threading.local()
+
+    def preload(self, key: ModelKey, load: Callable[[], Any]):
+        """ Starts loading the model of `key` with `load` in the background, unless it's resident. """
+        if getattr(self._dry_run, "active", False):
+            return
+        with self._lock:
+            if key not in self._entries:
+                self._loading_future(key, load)
+
+    @contextmanager
+    def dry_run(self) -> Iterator[None]:
+        """ Skips the preloads of the current thread, while the models are planned (see `persons.model_planner`). """
+        self._dry_run.active = True
+        try:
+            yield
+        finally:
+            self._dry_run.active = False
+
+    def acquire(self, key: ModelKey, load: Callable[[], Any], owner: Any = None) -> Any:
+        """
+        Returns the model of `key`, loading it with `load` if it isn't resident (or waiting for its
+        preloading). The reference is released when `owner` is garbage collected (or by calling `release`).
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            future = None if entry is not None else self._loading_future(key, load)
+        if future is not None:
+            # Waits without the lock, so other models keep loading (and being acquired).
+            value = future.result()
+        with self._lock:
+            if entry is None:
+                entry = self._entries.get(key)
+            if entry is None:
+                # Evicted right after it was loaded, before it had any reference.
+                entry = self._entries[key] = _Entry(value, model_size(value))
+            self._entries.move_to_end(key)
+            entry.references += 1
+            if owner is not None:
+                weakref.finalize(owner, self.release, key)
+            self._evict_over_budget()
+            return entry.value
+
+    def lazy(self, key: ModelKey, load: Callable[[], Any], owner: Any = None,
+             config_kwargs: Optional[dict] = None) -> LazyModel:
+        """
+        A handle to the model of `key`, which is acquired only when it's first used. Its configuration is
+        read with `config_kwargs` (e.g. the `trust_remote_code` of `load`) until then.
+        """
+        return LazyModel(self, key, load, owner, config_kwargs)
+
+    def _loading_future(self, key: ModelKey, load: Callable[[], Any]) -> Future:
+        future = self._loading.get(key)
+        if future is None:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self._preload_workers, thread_name_prefix="model_loader")
+            future = self._loading[key] = self._executor.submit(self._load, key, load)
+        return future
+
+    def _load(self, key: ModelKey, load: Callable[[], Any]) -> Any:
+        log.debug(f"loading {key.kind} {key.path}")
+        try:
+            value = load()
+        finally:
+            with self._lock:
+                self._loading.pop(key, None)
+        with self._lock:
+            entry = self._entries[key] = _Entry(value, model_size(value))
+            log.info(f"Loaded {key.kind} {key.path} ({entry.size / _BYTES_PER_GB:.2f} GB)")
+        return value
+
+    def release(self, key: ModelKey):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.references > 0:
+                entry.references -= 1
+
+    @property
+    def resident_size(self) -> int:
+        return sum(entry.size for entry in self._entries.values())
+
+    def set_preload_workers(self, preload_workers: int):
+        with self._lock:
+            if preload_workers == self._preload_workers:
+                return
+            self._preload_workers = preload_workers
+            if self._executor is not None:
+                # The models which are being loaded keep loading.
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    def set_memory_budget(self, memory_budget: Optional[int]):
+        with self._lock:
+            self.memory_budget = memory_budget
+            self._evict_over_budget()
+
+    def _evict_over_budget(self):
+        if self.memory_budget is None:
+            return
+        # Tokenizers take no budget, so evicting them frees nothing.
+        for key in [key for key, entry in self._entries.items() if entry.references == 0 and entry.size]:
+            if self.resident_size <= self.memory_budget:
+                break
+            self._evict(key)
+        if self.resident_size > self.memory_budget:
+            log.warning(f"The models in use take {self.resident_size / _BYTES_PER_GB:.2f} GB, "
+                        f"more than the budget of {self.memory_budget / _BYTES_PER_GB:.2f} GB")
+
+    def _evict(self, key: ModelKey):
+        entry = self._entries.pop(key)
+        log.info(f"Evicted {key.kind} {key.path} ({entry.size / _BYTES_PER_GB:.2f} GB)")
+        del entry
+        free_memory()
+
+    def clear(self, only_unreferenced: bool = False):
+        """ Evicts every resident model (that isn't referenced, if `only_unreferenced`). """
+        with self._lock:
+            for key in list(self._entries):
+                if not only_unreferenced or self._entries[key].references == 0:
+                    self._evict(key)
+
+    def report(self) -> list[dict]:
+        """ The resident models, from the least to the most recently used. """
+        with self._lock:
+            return [{**key._asdict(), "size_gb": round(entry.size / _BYTES_PER_GB, 3),
+                     "references": entry.references}
+                    for key, entry in self._entries.items()]
+
+    def log_report(self):
+        lines = [f"{row['kind']} {row['path']} ({row['dtype']}, {row['quantization']}, {row['device']}): "
+                 f"{row['size_gb']} GB, {row['references']} references" for row in self.report()]
+        log.info(f"Resident models ({self.resident_size / _BYTES_PER_GB:.2f} GB):\n" + "\n".join(lines))
+
+
+class LazyModel:
+    """
+    A handle to a model of the registry, which waits for the model (and references it) only when
+    one of its attributes is first used. The configuration of the model is read without loading it.
+    """
+
+    def __init__(self, registry: ModelRegistry, key: ModelKey, load: Callable[[], Any], owner: Any = None,
+                 config_kwargs: Optional[dict] = None):
+        self.model_key = key
+        self._registry = registry
+        self._load = load
+        self._config_kwargs = config_kwargs or {}
+        self._owner = None if owner is None else weakref.ref(owner)
+        self._model = None
+        self._config = None
+        self._lock = threading.Lock()
+
+    def resolve(self) -> Any:
+        """ The model, loading it if needed. """
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    owner = None if self._owner is None else self._owner()
+                    self._model = self._registry.acquire(self.model_key, self._load, owner or self)
+        return self._model
+
+    @property
+    def is_resolved(self) -> bool:
+        return self._model is not None
+
+    @property
+    def config(self) -> Any:
+        if self._model is not None:
+            return self._model.config
+        if self._config is None:
+            # Imported here, as the registry itself doesn't depend on `transformers`.
+            from transformers import AutoConfig
+            self._config = AutoConfig.from_pretrained(self.model_key.path, **self._config_kwargs)
+        return self._config
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("__") or name in ("_model", "_config", "_config_kwargs", "_owner", "_registry", "_load",
+                                             "_lock"):
+            raise AttributeError(name)
+        return getattr(self.resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+    def __reduce__(self):
+        # Pickled (e.g. with a saved session) as the model itself.
+        return _identity, (self.resolve(),)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.is_resolved else "not loaded"
+        return f"LazyModel({self.model_key.kind} {self.model_key.path}, {state})"
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+def free_memory():
+    """ Releases the memory of the tensors which were dropped (e.g. an evicted model, or a failed generation). """
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+_registry = ModelRegistry()
+
+
+def get_model_registry() -> ModelRegistry:
+    return _registry
+
+
+def configure_model_registry(config: Optional[dict]):
+    """
+    Applies the "models" configuration (e.g. {"memory_budget_gb": 40}) to the registry. The settings
+    which the configuration doesn't declare are reset to their defaults, so the settings of a configuration
+    don't leak into the next configurations run by the process (e.g. by a worker of a sweep).
+    """
+    config = config or {}
+    _registry.set_preload_workers(config.get("preload_workers", DEFAULT_PRELOAD_WORKERS))
+    memory_budget_gb = config.get("memory_budget_gb")
+    _registry.set_memory_budget(None if memory_budget_gb is None else int(memory_budget_gb * _BYTES_PER_GB))
@@ -1,9 +1,10 @@
 from __future__ import annotations
 
+import asyncio
 import copy
 import logging
 from abc import ABC, abstractmethod
-from typing import Any, Tuple, List, Union
+from typing import Any, Hashable, Tuple, List, Optional, Union
 
 # protect cyclic imports caused from typing
 from typing import TYPE_CHECKING
@@ -16,6 +17,8 @@ log = logging.getLogger(__name__)
 
 class Person(ABC):
     PERSON_TYPE = None
+    # Interactive persons (e.g. humans) must not be asked concurrently with other persons.
+    INTERACTIVE = False
 
     def __init__(self, background_story: str, name: str, *args, **kwargs):
         self.background_story: str = background_story
@@ -31,6 +34,59 @@ class Person(ABC):
         """
         raise NotImplementedError()
 
+    async def agenerate_answer(self, experiment_scenario: str, chat_list: List[ChatEntry]
+                               ) -> Union[ChatEntry, None]:
+        """
+        Coroutine version of `generate_answer`.
+        By default, runs `generate_answer` in the default executor of the running event loop, so
+        it doesn't block the loop. Persons with a native asynchronous API should override it.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.generate_answer, experiment_scenario, chat_list)
+
+    @classmethod
+    def preload_models(cls, **kwargs):
+        """
+        Starts loading the models that a person created with `kwargs` will use in the background
+        (see `persons.model_registry`), before the persons are created. Persons without local models
+        don't load anything.
+        """
+        pass
+
+    def batch_generation_key(self) -> Optional[Hashable]:
+        """
+        Persons returning the same (not None) key can generate their answers to the same chat
+        together, using `generate_batch_answers`. Returns None when the person can't be batched.
+        """
+        return None
+
+    def shared_models(self) -> Tuple[Hashable, ...]:
+        """
+        Identifies the models (and tokenizers) this person generates with, which other persons may
+        use as well (e.g. through `persons.model_registry`). Models aren't thread-safe, so persons
+        sharing any of them never generate concurrently. Persons without local models return ().
+        """
+        return ()
+
+    @classmethod
+    def generate_batch_answers(cls, persons: List[Person], experiment_scenario: str,
+                               chat_list: List[ChatEntry]) -> List[Union[ChatEntry, None]]:
+        """
+        Generates the answers of all `persons` (which share the same `batch_generation_key`)
+        to the same chat. By default, each person answers separately.
+        """
+        return [person.generate_answer(experiment_scenario, chat_list) for person in persons]
+
+    def checkpoint_state(self) -> Any:
+        """
+        A JSON serializable state of the person (without its model), from which
+        `restore_checkpoint_state` continues the session. Stateless persons return None.
+        """
+        return None
+
+    def restore_checkpoint_state(self, state: Any):
+        pass
+
     def __deepcopy__(self, memodict={}):
         log.debug("We don't allow deep copies of person")
         return copy.copy(self)
@@ -6,13 +6,10 @@ import openai
 from typing import Dict, List, Tuple, Any
 
 from persons.person import Person
+from persons.prompt_builder import IncrementalPromptBuilder
+from session_rooms.ChatEntry import ChatEntry
 from session_rooms.session_room import System
 
-# protect cyclic imports caused from typing
-from typing import TYPE_CHECKING
-if TYPE_CHECKING:
-    from session_rooms.ChatEntry import ChatEntry
-
 
 
 class Person3_5(Person):
@@ -21,6 +18,7 @@ class Person3_5(Person):
 
     def __init__(self, background_story: str, name: str, *args, **kwargs):
         super().__init__(background_story, name)
+        self._prompt_builder = IncrementalPromptBuilder(self._render_chat_entry)
         # Set up your OpenAI API credentials
         openai.api_key = os.environ.get("OPENAI_API_KEY")
         openai.organization = os.environ.get("OPENAI_ORG_ID")
@@ -29,13 +27,24 @@ class Person3_5(Person):
 
     def generate_answer(self, experiment_scenario: str, chat_list: List[ChatEntry]):
         generated_prompt: List[Dict[str, str]] = self.create_prompt(experiment_scenario, chat_list)
-        full_response = openai.ChatCompletion.create(
+        full_response = openai.ChatCompletion.create(**self._create_request(generated_prompt))
+        return self._parse_response(generated_prompt, full_response)
+
+    async def agenerate_answer(self, experiment_scenario: str, chat_list: List[ChatEntry]):
+        generated_prompt: List[Dict[str, str]] = self.create_prompt(experiment_scenario, chat_list)
+        full_response = await openai.ChatCompletion.acreate(**self._create_request(generated_prompt))
+        return self._parse_response(generated_prompt, full_response)
+
+    def _create_request(self, generated_prompt: List[Dict[str, str]]) -> Dict[str, Any]:
+        return dict(
             model=self.model_name,  # Specify the chat model
             messages=generated_prompt,  # List of messages representing conversation history
             max_tokens=50,  # Limit the response length to 100 tokens
             n=1,  # Generate a single response
             temperature=0.6,  # Control the randomness of the output
         )
+
+    def _parse_response(self, generated_prompt: List[Dict[str, str]], full_response) -> ChatEntry:
         # Retrieve the generated response
         output_text: str = full_response.choices[0].message['content']
         parsed_answer = output_text
@@ -56,31 +65,39 @@ class Person3_5(Person):
               messages from multiple persons, by concatenating the format "{name}: {content}\n".
         """
         
-        name_message = {"role": "system", "content": f"Your name is {self.name}."}
-        scenario_message = {"role": "system", "content": f"The scenario is the following:"
-                                                         f" {experiment_scenario}"}
-        system_message = {"role": "system", "content": f"This is your background story:"
-                                                       f" {self.background_story}"}
-        conversation = [name_message, scenario_message, system_message]
+        conversation = list(self._prompt_builder.header(
+            experiment_scenario, lambda: self._render_header(experiment_scenario)))
 
         other_users_prompt = ""
-        for chat_entry in chat_list:
-            if isinstance(chat_entry.entity, System): # System message
+        for role, content in self._prompt_builder.segments(chat_list):
+            if role == "user":  # Other user message
                 if other_users_prompt:
-                    conversation.append({"role": "user", "content": other_users_prompt})
-                conversation.append({"role": "system", "content": chat_entry.answer})
-                other_users_prompt = ""
-            elif chat_entry.entity is self:  # My previous message
+                    other_users_prompt += "\n"
+                other_users_prompt += content
+            else:  # System message or my previous message
                 if other_users_prompt:
                     conversation.append({"role": "user", "content": other_users_prompt})
-                conversation.append({"role": "assistant", "content": chat_entry.answer})
+                conversation.append({"role": role, "content": content})
                 other_users_prompt = ""
-            else: # Other user message
-                if other_users_prompt:
-                    other_users_prompt += "\n"
-                other_users_prompt += f"{chat_entry.entity.name}: {chat_entry.answer}"
 
         if other_users_prompt:
             conversation.append({"role": "user", "content": other_users_prompt})
 
         return conversation
+
+    def _render_header(self, experiment_scenario: str) -> Tuple[Dict[str, str], ...]:
+        name_message = {"role": "system", "content": f"Your name is {self.name}."}
+        scenario_message = {"role": "system", "content": f"The scenario is the following:"
+                                                         f" {experiment_scenario}"}
+        system_message = {"role": "system", "content": f"This is your background story:"
+                                                       f" {self.background_story}"}
+        return name_message, scenario_message, system_message
+
+    def _render_chat_entry(self, chat_entry: ChatEntry) -> Tuple[str, str]:
+        """ Returns the role and the content of the message the chat entry is part of. """
+        if isinstance(chat_entry.entity, System):  # System message
+            return "system", chat_entry.answer
+        elif chat_entry.entity is self:  # My previous message
+            return "assistant", chat_entry.answer
+        else:  # Other user message
+            return "user", f"{chat_entry.entity.name}: {chat_entry.answer}"
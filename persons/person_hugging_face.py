@@ -19,7 +19,7 @@ from __future__ import annotations
 
 import copy
 import logging
-from typing import Callable
+from typing import Callable, Sequence, Union
 
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig, BitsAndBytesConfig
@@ -28,25 +28,63 @@ import gc
 
 # Protect cyclic imports caused from typing
 
+from persons.assisted_decoding import AssistedDecodingStats, assisted_generate
+from persons.context_window import ContextWindow
+from persons.generation_engine import get_generation_engine
+from persons.inference_backend import InferenceBackend, get_backend
+from persons.lora_adapters import LoraAdapterModel, batch_model, lora_model_spec
+from persons.model_planner import planned_model_spec
+from persons.model_registry import ModelKey, get_model_registry
 from persons.person import Person
+from persons.prefix_cache import PrefixCache, prefill_batch
+from persons.prompt_builder import IncrementalPromptBuilder
+from persons.prompt_tokenizer import PromptTokenizer, left_pad
+from persons.stop_strings import get_stop_strings, row_stop_criteria, stopping_criteria
 from session_rooms.session_room import ChatEntry
+from session_rooms.ChatEntry import LazyPrompt
 
 
 log = logging.getLogger(__name__)
 
-# Load each model only once to save expensive memory.
-_hf_cache = {}
+_RESPONSE_PREFIX = "### Response:\nMe:"
+_DEFAULT_MODEL_PATH = "microsoft/Phi-3-mini-4k-instruct"
+# The models are loaded with their custom code (e.g. Phi-3 on older versions of `transformers`), so
+# their configuration is read with it as well.
+_CONFIG_KWARGS = {"trust_remote_code": True}
 
 
-def cache_or_init(key: str, init_func: Callable):
+def _tokenizer_spec(tokenizer_weights: str) -> tuple[ModelKey, Callable]:
+    # Use_fast=False? https://huggingface.co/openlm-research/open_llama_13b
+    return ModelKey(tokenizer_weights, "tokenizer"), lambda: AutoTokenizer.from_pretrained(tokenizer_weights)
+
+
+def _model_spec(model_weights: str, lora: bool = False,
+                backend: InferenceBackend = InferenceBackend()) -> tuple[ModelKey, Callable]:
     """
-    Returns the model from the cache if available.
-    Otherwise, initializes it with the given init_func.
+    The spec of the model on `backend` (see `persons.inference_backend`), or of the model shared by
+    LoRA adapters over it (see `persons.lora_adapters`), as planned (see `persons.model_planner`).
     """
-    if key not in _hf_cache:
-        logging.debug(f"loading {key}")
-        _hf_cache[key] = init_func()
-    return _hf_cache[key]
+    if backend.is_cpu:
+        # The adapters wrap the linear layers of the model, which can't be quantized under them.
+        backend = backend.without_quantization() if lora else backend
+        key = backend.model_key(model_weights, "causal_lm")
+        load = lambda: backend.load(AutoModelForCausalLM.from_pretrained, model_weights, trust_remote_code=True)
+        return lora_model_spec(key, load) if lora else (key, load)
+    planned = planned_model_spec(model_weights, "causal_lm", AutoModelForCausalLM.from_pretrained, lora,
+                                 trust_remote_code=True)
+    if planned is not None:
+        return planned
+    key = ModelKey(model_weights, "causal_lm", dtype="float32", device="auto")
+    load = lambda: AutoModelForCausalLM.from_pretrained(
+        model_weights, device_map="auto",
+        # quantization_config=BitsAndBytesConfig(
+        #     load_in_4bit=True,
+        #     bnb_4bit_use_double_quant=True,
+        #     bnb_4bit_quant_type="nf4",
+        #     bnb_4bit_compute_dtype=torch.bfloat16),
+        trust_remote_code=True  # TODO - maybe remove, new addition to check bugs
+    )
+    return lora_model_spec(key, load) if lora else (key, load)
 
 
 class PersonHuggingFace(Person):
@@ -55,39 +93,89 @@ class PersonHuggingFace(Person):
     def __init__(self, background_story: str, name: str, *args, **kwargs):
         """ Loads the model into GPU / Memory. This might take a few minutes. """
         super().__init__(background_story, name)
-        model_path = kwargs.get("model_path", "microsoft/Phi-3-mini-4k-instruct")  # 13B.
+        self._prompt_builder = IncrementalPromptBuilder(self._render_chat_entry)
+        # A separate builder for rendering the lazy prompts of past entries, so it doesn't
+        # invalidate the cache of the next prompt.
+        self._lazy_prompt_builder = IncrementalPromptBuilder(self._render_chat_entry)
+        model_path = kwargs.get("model_path", _DEFAULT_MODEL_PATH)  # 13B.
         tokenizer_weights = model_path
         model_weights = model_path
-        adapters_weights = ""
-
-        self.tokenizer = cache_or_init(
-            key=f"{tokenizer_weights}_tokenizer",
-            # Use_fast=False? https://huggingface.co/openlm-research/open_llama_13b
-            init_func=lambda: AutoTokenizer.from_pretrained(tokenizer_weights))
-        self.model = cache_or_init(
-            key=f"{model_weights}_model",
-            init_func=lambda: AutoModelForCausalLM.from_pretrained(
-                model_weights, device_map="auto",
-                # quantization_config=BitsAndBytesConfig(
-                #     load_in_4bit=True,
-                #     bnb_4bit_use_double_quant=True,
-                #     bnb_4bit_quant_type="nf4",
-                #     bnb_4bit_compute_dtype=torch.bfloat16),
-                trust_remote_code=True  # TODO - maybe remove, new addition to check bugs
-            ))
+        # A LoRA adapter over the model, which shares the model with the other adapters over it.
+        adapter_path = kwargs.get("adapter_path")
+        # Where the model runs, e.g. on the CPU of hosts without a GPU (see `persons.inference_backend`).
+        self.backend = get_backend(kwargs.get("backend"))
+
+        # Load each model only once to save expensive memory (see `persons.model_registry`).
+        # The model is only waited for when it's first used, as it may still be loading.
+        registry = get_model_registry()
+        self.tokenizer = registry.acquire(*_tokenizer_spec(tokenizer_weights), owner=self)
+        self.model = registry.lazy(*_model_spec(model_weights, bool(adapter_path), self.backend), owner=self,
+                                   config_kwargs=_CONFIG_KWARGS)
+        if adapter_path:
+            self.model = LoraAdapterModel(self.model, adapter_path)
+        self.prompt_tokenizer = PromptTokenizer(self.tokenizer)
+        # The attention keys and values of the last prompt, so the next one only prefills its new tokens.
+        self.prefix_cache = PrefixCache() if kwargs.get("prefix_cache", True) else None
+        self.context_window = ContextWindow.from_config(kwargs.get("context_window"), self.tokenizer, self.model)
+        # Only the first line of the answer is kept, so generation stops once it's complete.
+        self.stop_strings = get_stop_strings(kwargs.get("stop_strings"))
+        # A small model of the same family, which drafts the answers (see `persons.assisted_decoding`).
+        draft_model_path = kwargs.get("draft_model_path")
+        self.draft_model = (registry.lazy(*_model_spec(draft_model_path, backend=self.backend), owner=self,
+                                          config_kwargs=_CONFIG_KWARGS)
+                            if draft_model_path else None)
+        self.assisted_stats = AssistedDecodingStats(name) if draft_model_path else None
         log.debug("finish loading model before breaking point! yay!")
         # self.model.tie_weights()? - https://paperswithcode.com/method/weight-tying
 
-        if adapters_weights:
-            # If there are separate adapter weights add them to the underlying model.
-            self.model = cache_or_init(
-                key=f"{adapters_weights}_adapters",
-                init_func=lambda: AutoTokenizer.from_pretrained(
-                    adapters_weights, self.model))
+    @classmethod
+    def preload_models(cls, **kwargs):
+        model_path = kwargs.get("model_path", _DEFAULT_MODEL_PATH)
+        backend = get_backend(kwargs.get("backend"))
+        registry = get_model_registry()
+        registry.preload(*_tokenizer_spec(model_path))
+        registry.preload(*_model_spec(model_path, bool(kwargs.get("adapter_path")), backend))
+        if kwargs.get("draft_model_path"):
+            registry.preload(*_model_spec(kwargs["draft_model_path"], backend=backend))
 
     def generate_answer(self, experiment_scenario: str, chat_list: list[ChatEntry]):
-        prompt: str = self.create_prompt(experiment_scenario, chat_list)
-        config = GenerationConfig(
+        input_ids = self.create_prompt_ids(experiment_scenario, chat_list)
+        config = self._create_generation_config()
+        answer = self.evaluate(config, input_ids, use_cuda=torch.cuda.is_available() and not self.backend.is_cpu,
+                               prefix_cache=self.prefix_cache)
+        return ChatEntry(entity=self, prompt=self._lazy_prompt(experiment_scenario, chat_list), answer=answer)
+
+    def batch_generation_key(self):
+        """
+        Persons that share the same model and tokenizer can generate in a single batch, including
+        persons with different LoRA adapters over the same model. Assisted generation runs a single
+        prompt at a time, so persons with a draft model generate alone.
+        """
+        if self.draft_model is not None:
+            return None
+        return type(self), self.model.model_key, id(self.tokenizer)
+
+    def shared_models(self):
+        models = (self.model.model_key, id(self.tokenizer))
+        return models if self.draft_model is None else models + (self.draft_model.model_key,)
+
+    @classmethod
+    def generate_batch_answers(cls, persons: list[PersonHuggingFace], experiment_scenario: str,
+                               chat_list: list[ChatEntry]) -> list[ChatEntry]:
+        prompts = [person.create_prompt_ids(experiment_scenario, chat_list) for person in persons]
+        config = cls._create_generation_config()
+        prefix_caches = [person.prefix_cache for person in persons]
+        use_cuda = torch.cuda.is_available() and not persons[0].backend.is_cpu
+        answers = persons[0].evaluate_batch(config, prompts, use_cuda=use_cuda,
+                                            prefix_caches=None if None in prefix_caches else prefix_caches,
+                                            models=[person.model for person in persons])
+        return [ChatEntry(entity=person, prompt=person._lazy_prompt(experiment_scenario, chat_list),
+                          answer=answer)
+                for person, answer in zip(persons, answers)]
+
+    @staticmethod
+    def _create_generation_config() -> GenerationConfig:
+        return GenerationConfig(
             # TODO - consider using repetition_penalty.
             do_sample=True,
             temperature=1.0,
@@ -96,30 +184,99 @@ class PersonHuggingFace(Person):
             use_cache=True,  # True for speedup, False only if reaching memory limit.
             max_new_tokens=100
         )
-        answer = self.evaluate(config, prompt, use_cuda=torch.cuda.is_available())
-        return ChatEntry(entity=self, prompt=prompt, answer=answer)
 
-    def evaluate(self, generation_config: GenerationConfig, prompt: str,
-                 use_cuda, max_new_tokens=50):
-        input_ids = self.tokenizer.encode(prompt, return_tensors="pt")
+    def evaluate(self, generation_config: GenerationConfig, prompt: Union[str, Sequence[int]],
+                 use_cuda, max_new_tokens=50, prefix_cache: PrefixCache = None):
+        """
+        Generates the answer to `prompt`, given as text or as token ids (see `create_prompt_ids`).
+        With a `prefix_cache`, only the tokens after the prefix shared with its last prompt are prefilled.
+        """
+        if isinstance(prompt, str):
+            prompt = self.tokenizer.encode(prompt)
+        engine = get_generation_engine(self.model) if self.draft_model is None else None
+        if engine is not None:
+            # Generated in a continuous batch with the other users of the model (see `persons.generation_engine`).
+            criteria = row_stop_criteria(self.tokenizer, self.stop_strings, skip_leading_whitespace=True)
+            generated = engine.generate(self.model, prompt, generation_config, max_new_tokens, criteria, prefix_cache)
+            return self._post_process_output(self.tokenizer.decode([*prompt, *generated]))
+        input_ids = torch.tensor([prompt], dtype=torch.long)
+        past_key_values = None
+        if prefix_cache is not None:
+            _, past_key_values = prefix_cache.lookup(input_ids[0])
         if use_cuda:
             input_ids = input_ids.cuda()
 
-        generation_output = self.model.generate(
-            input_ids=input_ids,
+        generate_kwargs = dict(
+            past_key_values=past_key_values,
             generation_config=generation_config,
+            stopping_criteria=stopping_criteria(self.tokenizer, self.stop_strings, input_ids.shape[1],
+                                                skip_leading_whitespace=True),
             return_dict_in_generate=True,
-            output_scores=True,
             max_new_tokens=max_new_tokens
         )
+        with torch.inference_mode():
+            if self.draft_model is not None:
+                generation_output = assisted_generate(self.model, self.draft_model, self.assisted_stats, input_ids,
+                                                      **generate_kwargs)
+            else:
+                generation_output = self.model.generate(input_ids=input_ids, **generate_kwargs)
+        if prefix_cache is not None:
+            prefix_cache.store(generation_output.sequences[0], generation_output.past_key_values)
         # Clear expensive GPU memory.
-        del input_ids
+        del input_ids, past_key_values
         gc.collect()
 
         assert len(generation_output.sequences) == 1  # TODO: when can be more than 1?
         output = self.tokenizer.decode(generation_output.sequences[0])
         # print(colored(output, "red"))
+        return self._post_process_output(output)
+
+    def evaluate_batch(self, generation_config: GenerationConfig, prompts: list[Union[str, Sequence[int]]],
+                       use_cuda, max_new_tokens=50, prefix_caches: list[PrefixCache] = None,
+                       models: list = None) -> list[str]:
+        """
+        Same as `evaluate`, for several prompts in a single (left padded) batch, with a prefix
+        cache for each one of them (if any). `models` are the models of the prompts (e.g. with their
+        own LoRA adapters), the model of this person by default.
+        """
+        models = models or [self.model] * len(prompts)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        sequences = [self.tokenizer.encode(prompt) if isinstance(prompt, str) else prompt for prompt in prompts]
+        engine = get_generation_engine(self.model)
+        if engine is not None:
+            futures = [engine.submit(model, sequence, generation_config, max_new_tokens,
+                                     row_stop_criteria(self.tokenizer, self.stop_strings, skip_leading_whitespace=True),
+                                     None if prefix_caches is None else prefix_caches[i])
+                       for i, (model, sequence) in enumerate(zip(models, sequences))]
+            return [self._post_process_output(self.tokenizer.decode([*sequence, *future.result()]))
+                    for sequence, future in zip(sequences, futures)]
+        past_key_values = None if prefix_caches is None else prefill_batch(models, prefix_caches, sequences)
+        input_ids, attention_mask = left_pad(sequences, self.tokenizer.pad_token_id)
+        if use_cuda:
+            input_ids, attention_mask = input_ids.cuda(), attention_mask.cuda()
+
+        with torch.inference_mode():
+            generation_output = batch_model(models).generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                past_key_values=past_key_values,
+                generation_config=generation_config,
+                stopping_criteria=stopping_criteria(self.tokenizer, self.stop_strings, input_ids.shape[1],
+                                                    skip_leading_whitespace=True),
+                return_dict_in_generate=True,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        # Clear expensive GPU memory.
+        del input_ids, attention_mask, past_key_values
+        gc.collect()
 
+        return [self._post_process_output(self.tokenizer.decode(sequence))
+                for sequence in generation_output.sequences]
+
+    @staticmethod
+    def _post_process_output(output: str) -> str:
         # The model returns the new tokens concatenated to the input prompt.
         # Only take the new tokens which is after "### Response:":
         # Also, strip the part which is after the  EOS token ("</s>").
@@ -131,18 +288,50 @@ class PersonHuggingFace(Person):
         """ 
         Creates a prompt with the past conversation formatted as a string.
         """
-        output = ("### Instruction: \n"
-                  f"Your name is {self.name}. \n"
-                  f"This is your background story: {self.background_story}.\n"
-                  f"The following is a {experiment_scenario}. "
-                  "Complete your next reply (starting with 'Me:'). "
-                  "Try to keep your reply shorter than 30 words.\n\n"
-                  "### Input:\n")
-
-        for chat_entry in chat_list:
-            cur_name = chat_entry.entity.name
-            current_name = "Me" if cur_name == self.name else cur_name
-            output += f"{current_name}: {chat_entry.answer}\n"
-
-        output += "### Response:\nMe:"
-        return output
+        header = self._prompt_builder.header(
+            experiment_scenario, lambda: self._render_header(experiment_scenario))
+        return self._assemble_prompt(*self._fit_context_window(self._prompt_builder, chat_list, header))
+
+    def create_prompt_ids(self, experiment_scenario: str, chat_list: list[ChatEntry]) -> list[int]:
+        """
+        The token ids of `create_prompt`, assembled from the cached ids of its parts, so only the
+        new chat entries are tokenized.
+        """
+        header = self._prompt_builder.header(
+            experiment_scenario, lambda: self._render_header(experiment_scenario))
+        return self.prompt_tokenizer.prompt_ids(
+            self._prompt_builder, chat_list, header, _RESPONSE_PREFIX, self.context_window)
+
+    def _lazy_prompt(self, experiment_scenario: str, chat_list: list[ChatEntry]) -> LazyPrompt:
+        """ The prompt kept in the `ChatEntry`, which is rendered again only when it's read. """
+        return LazyPrompt(self._render_prompt, chat_list, experiment_scenario)
+
+    def _render_prompt(self, chat_list: list[ChatEntry], experiment_scenario: str) -> str:
+        """ Same as `create_prompt`, using the builder of the lazy prompts. """
+        header = self._render_header(experiment_scenario)
+        return self._assemble_prompt(*self._fit_context_window(self._lazy_prompt_builder, chat_list, header))
+
+    def _fit_context_window(self, prompt_builder: IncrementalPromptBuilder, chat_list: list[ChatEntry],
+                            header: str) -> tuple[str, str]:
+        """ Returns the header and the history of the prompt, trimmed to the context window. """
+        if self.context_window is None:
+            return header, prompt_builder.text(chat_list)
+        return self.context_window.fit(prompt_builder, chat_list, header, _RESPONSE_PREFIX)
+
+    @staticmethod
+    def _assemble_prompt(header: str, history: str) -> str:
+        return header + history + _RESPONSE_PREFIX
+
+    def _render_header(self, experiment_scenario: str) -> str:
+        return ("### Instruction: \n"
+                f"Your name is {self.name}. \n"
+                f"This is your background story: {self.background_story}.\n"
+                f"The following is a {experiment_scenario}. "
+                "Complete your next reply (starting with 'Me:'). "
+                "Try to keep your reply shorter than 30 words.\n\n"
+                "### Input:\n")
+
+    def _render_chat_entry(self, chat_entry: ChatEntry) -> str:
+        cur_name = chat_entry.entity.name
+        current_name = "Me" if cur_name == self.name else cur_name
+        return f"{current_name}: {chat_entry.answer}\n"
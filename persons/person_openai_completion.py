@@ -9,12 +9,8 @@ import os
 import openai
 
 from persons.person import Person
-
-# Protect cyclic imports caused from typing
-from typing import TYPE_CHECKING
-
-if TYPE_CHECKING:
-    from session_rooms.ChatEntry import ChatEntry
+from persons.prompt_builder import IncrementalPromptBuilder
+from session_rooms.ChatEntry import ChatEntry
 
 
 
@@ -24,6 +20,7 @@ class PersonOpenAiCompletion(Person):
 
     def __init__(self, background_story: str, name: str, *args, **kwargs):
         super().__init__(background_story, name)
+        self._prompt_builder = IncrementalPromptBuilder(self._render_chat_entry)
         # Set up your OpenAI API credentials.
         openai.api_key = os.environ.get("OPENAI_API_KEY", "")
         openai.organization = os.environ.get("OPENAI_ORG_ID")  # TODO remove default?
@@ -33,7 +30,16 @@ class PersonOpenAiCompletion(Person):
 
     def generate_answer(self, experiment_scenario: str, chat_list: List[ChatEntry]):
         generated_prompt: str = self.create_prompt(experiment_scenario, chat_list)
-        full_response = openai.Completion.create(
+        full_response = openai.Completion.create(**self._create_request(generated_prompt))
+        return self._parse_response(generated_prompt, full_response)
+
+    async def agenerate_answer(self, experiment_scenario: str, chat_list: List[ChatEntry]):
+        generated_prompt: str = self.create_prompt(experiment_scenario, chat_list)
+        full_response = await openai.Completion.acreate(**self._create_request(generated_prompt))
+        return self._parse_response(generated_prompt, full_response)
+
+    def _create_request(self, generated_prompt: str) -> dict:
+        return dict(
             model=self.model_name,
             prompt=generated_prompt,
             max_tokens=100,  # Limit the response length to 100 tokens.
@@ -41,6 +47,7 @@ class PersonOpenAiCompletion(Person):
             temperature=0.6,  # Control the randomness of the output.
         )
 
+    def _parse_response(self, generated_prompt: str, full_response) -> ChatEntry:
         # Retrieve the generated response
         chat_answer: str = full_response.choices[0].text
         return ChatEntry(entity=self, prompt=generated_prompt, answer=chat_answer)
@@ -49,19 +56,23 @@ class PersonOpenAiCompletion(Person):
         """ 
         Creates a prompt with the past conversation formatted as a string.
         """
-        output = ("Instructions: \n"
-                  f"Your name is {self.name}. \n"
-                  f"The scenario is the following: {experiment_scenario}\n"
-                  f"This is your background story: {self.background_story}\n\n"
-                  "The following is a conversation between you and other speakers. Complete "
-                  "your next reply (starting with 'Me:'). Try to keep the reply shorter than "
-                  "30 words.\n\n")
-
-        for chat_entry in chat_list:
-            cur_person = chat_entry.entity
-            current_name = "Me" if cur_person is self else cur_person.name
-            output += f"{current_name}: {chat_entry.answer}\n"
-            output += f"###################################\n"
-
+        output = self._prompt_builder.header(
+            experiment_scenario, lambda: self._render_header(experiment_scenario))
+        output += self._prompt_builder.text(chat_list)
         output += "Me: "
         return output
+
+    def _render_header(self, experiment_scenario: str) -> str:
+        return ("Instructions: \n"
+                f"Your name is {self.name}. \n"
+                f"The scenario is the following: {experiment_scenario}\n"
+                f"This is your background story: {self.background_story}\n\n"
+                "The following is a conversation between you and other speakers. Complete "
+                "your next reply (starting with 'Me:'). Try to keep the reply shorter than "
+                "30 words.\n\n")
+
+    def _render_chat_entry(self, chat_entry: ChatEntry) -> str:
+        cur_person = chat_entry.entity
+        current_name = "Me" if cur_person is self else cur_person.name
+        return (f"{current_name}: {chat_entry.answer}\n"
+                f"###################################\n")
@@ -0,0 +1,131 @@
+"""
+This file contains the prefix cache of the persons which run a local HuggingFace model.
+
+The prompt of a person on each turn is the prompt of its previous turn, with a few more chat entries
+(the tail of the previous prompt aside). Without a cache, every call to `model.generate` computes
+the attention keys and values of the whole prompt again. A `PrefixCache` keeps the keys and values
+(`past_key_values`) of the last prompt of a single person (or of a single row of a batch), so the
+next call only prefills the tokens after the longest common prefix.
+
+Prompts must keep their volatile parts (e.g. the current time) at their end, after the history,
+for the prefix to stay stable between turns.
+
+The keys and values are kept in the legacy format of `transformers` (a tuple of (key, value) per
+layer, each of shape [batch, heads, sequence, head dim]), which every model supports.
+"""
+from __future__ import annotations
+
+import logging
+from typing import Any, Optional, Sequence, Union
+
+import torch
+
+log = logging.getLogger(__name__)
+
+PastKeyValues = tuple[tuple[torch.Tensor, torch.Tensor], ...]
+
+
+class PrefixCache:
+    """ The keys and values of the last prompt (and answer) of a single person, or batch row. """
+
+    def __init__(self):
+        # The token ids whose keys and values are cached (on the CPU, for comparing prompts).
+        self.input_ids: Optional[torch.Tensor] = None
+        self.past_key_values: Optional[PastKeyValues] = None
+
+    def __len__(self) -> int:
+        return 0 if self.input_ids is None else len(self.input_ids)
+
+    def lookup(self, input_ids: torch.Tensor) -> tuple[int, Optional[PastKeyValues]]:
+        """
+        Returns the length of the cached prefix of `input_ids` (a 1-D tensor), and its keys and
+        values. At least the last token is never cached, as generation starts from its logits.
+        """
+        if self.input_ids is None:
+            return 0, None
+        input_ids = input_ids.cpu()
+        length = min(len(self.input_ids), len(input_ids) - 1)
+        mismatches = (self.input_ids[:length] != input_ids[:length]).nonzero()
+        if len(mismatches):
+            length = int(mismatches[0])
+        log.debug(f"Prefix cache reuses {length} of {len(input_ids)} prompt tokens")
+        if length == 0:
+            return 0, None
+        return length, crop(self.past_key_values, length)
+
+    def store(self, input_ids: torch.Tensor, past_key_values: Any):
+        """
+        Keeps `past_key_values`, the keys and values of the first tokens of `input_ids` (a 1-D
+        tensor, e.g. a generated sequence whose last token wasn't fed to the model yet).
+        """
+        self.past_key_values = to_legacy(past_key_values)
+        if not self.past_key_values:
+            self.clear()
+            return
+        self.input_ids = input_ids[:sequence_length(self.past_key_values)].cpu()
+
+    def prefill(self, model: Any, input_ids: torch.Tensor):
+        """
+        Extends the cache with every token of `input_ids` (a 1-D tensor) except the last one,
+        computing only the tokens after the cached prefix.
+        """
+        length, past_key_values = self.lookup(input_ids)
+        if length < len(input_ids) - 1:
+            new_ids = input_ids[length:-1].unsqueeze(0).to(model.device)
+            position_ids = torch.arange(length, len(input_ids) - 1, device=model.device).unsqueeze(0)
+            with torch.inference_mode():
+                outputs = model(input_ids=new_ids, position_ids=position_ids,
+                                past_key_values=past_key_values, use_cache=True)
+            past_key_values = outputs.past_key_values
+        self.store(input_ids, past_key_values)
+
+    def clear(self):
+        self.input_ids = None
+        self.past_key_values = None
+
+
+def to_legacy(past_key_values: Any) -> Optional[PastKeyValues]:
+    if past_key_values is None:
+        return None
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple((key, value) for key, value in past_key_values)
+
+
+def sequence_length(past_key_values: PastKeyValues) -> int:
+    return past_key_values[0][0].shape[2]
+
+
+def crop(past_key_values: PastKeyValues, length: int) -> PastKeyValues:
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in past_key_values)
+
+
+def prefill_batch(model: Union[Any, Sequence[Any]], caches: Sequence[PrefixCache],
+                  sequences: Sequence[Sequence[int]]) -> Optional[PastKeyValues]:
+    """
+    Prefills the cache of every row of a batch with its sequence (except its last token), and
+    returns the keys and values of the batch, left padded as `prompt_tokenizer.left_pad` pads the
+    sequences. Generating from the padded sequences with them only computes their last tokens.
+    `model` may also be a list of the model of every row (e.g. with its own LoRA adapter).
+    """
+    models = model if isinstance(model, (list, tuple)) else [model] * len(caches)
+    for row_model, cache, sequence in zip(models, caches, sequences):
+        cache.prefill(row_model, torch.tensor(sequence, dtype=torch.long))
+    length = max(len(cache) for cache in caches)
+    if length == 0:
+        return None
+    reference = next(cache.past_key_values for cache in caches if len(cache))
+    layers = []
+    for layer, (reference_key, reference_value) in enumerate(reference):
+        keys, values = [], []
+        for cache in caches:
+            if len(cache):
+                key, value = cache.past_key_values[layer]
+            else:
+                key = reference_key[:, :, :0]
+                value = reference_value[:, :, :0]
+            padding = length - key.shape[2]
+            keys.append(torch.nn.functional.pad(key, (0, 0, padding, 0)))
+            values.append(torch.nn.functional.pad(value, (0, 0, padding, 0)))
+        layers.append((torch.cat(keys), torch.cat(values)))
+    return tuple(layers)
@@ -0,0 +1,133 @@
+"""
+This file contains an incremental prompt builder, used by persons to render the chat history.
+
+Rendering the whole chat history on every turn makes a session quadratic in prompt building time.
+Instead, each person keeps an `IncrementalPromptBuilder` which caches the static header of its
+prompt, and the rendered text of every `ChatEntry` it has already seen. On each call only the
+entries that were added since the last call are rendered.
+
+The session room only appends to the chat history, except for survey questions which are added
+temporarily at the end of the history and then removed. The builder detects such rewrites by
+comparing the identity of the last entry it rendered, and drops only the entries which are no
+longer part of the history.
+
+The builder also keeps the token ids of the segments (see `persons.prompt_tokenizer`), so the
+input ids of a prompt are assembled without tokenizing the history again.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Callable, Hashable, Sequence, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from session_rooms.ChatEntry import ChatEntry
+
+_NO_HEADER = object()
+
+
+class IncrementalPromptBuilder:
+    """
+    Caches the rendered prompt parts of a single person.
+
+    :param render_entry: renders a single chat entry, exactly as the person's template does.
+        The rendered value must only depend on the entry itself (and the owning person).
+    """
+
+    def __init__(self, render_entry: Callable[[ChatEntry], Any]):
+        self._render_entry = render_entry
+        self._header_key: Hashable = _NO_HEADER
+        self._header: Any = None
+        # The entries which are currently rendered, and their rendered segments.
+        self._entries: list[ChatEntry] = []
+        self._segments: list[Any] = []
+        # The token ids of the first segments, their sizes, and all of them concatenated (see `token_ids`).
+        self._token_ids: list[Sequence[int]] = []
+        self._sizes: list[int] = []
+        self._flat_token_ids: list[int] = []
+        # Text of all the string segments joined, and the offset of each segment inside it.
+        self._text = ""
+        self._offsets: list[int] = [0]
+
+    def header(self, key: Hashable, render_header: Callable[[], Any]) -> Any:
+        """
+        Returns the cached header of the prompt, rendering it only when `key` changes
+        (e.g. when the person is used with another scenario).
+        """
+        if key != self._header_key:
+            self._header = render_header()
+            self._header_key = key
+        return self._header
+
+    def segments(self, chat_list: Sequence[ChatEntry]) -> list[Any]:
+        """ Returns the rendered segment of every entry in `chat_list`. """
+        self._sync(chat_list)
+        return self._segments
+
+    def text(self, chat_list: Sequence[ChatEntry]) -> str:
+        """ Returns the rendered segments of `chat_list` concatenated (segments must be strings). """
+        self._sync(chat_list)
+        return self._text
+
+    def token_ids(self, chat_list: Sequence[ChatEntry],
+                  encode_entry: Callable[[ChatEntry, Any], Sequence[int]]) -> list[Sequence[int]]:
+        """
+        Returns the token ids of the rendered segment of every entry in `chat_list`. Each segment
+        is encoded only once, so `encode_entry` must not change between calls.
+        """
+        self._sync(chat_list)
+        for i in range(len(self._token_ids), len(self._segments)):
+            segment_ids = encode_entry(self._entries[i], self._segments[i])
+            self._token_ids.append(segment_ids)
+            self._sizes.append(len(segment_ids))
+            self._flat_token_ids.extend(segment_ids)
+        return self._token_ids
+
+    def token_sizes(self, chat_list: Sequence[ChatEntry],
+                    encode_entry: Callable[[ChatEntry, Any], Sequence[int]]) -> list[int]:
+        """ Returns the token count of the rendered segment of every entry in `chat_list`. """
+        self.token_ids(chat_list, encode_entry)
+        return self._sizes
+
+    def flat_token_ids(self, chat_list: Sequence[ChatEntry],
+                       encode_entry: Callable[[ChatEntry, Any], Sequence[int]]) -> list[int]:
+        """ Returns the token ids of all the rendered segments of `chat_list` concatenated. """
+        self.token_ids(chat_list, encode_entry)
+        return self._flat_token_ids
+
+    def reset(self):
+        """ Drops every cached value. """
+        self._header_key = _NO_HEADER
+        self._header = None
+        self._truncate(0)
+
+    def _sync(self, chat_list: Sequence[ChatEntry]):
+        common = min(len(chat_list), len(self._entries))
+        # The history is append only, so if the last shared entry is the same object,
+        # the whole prefix is the same. Otherwise, the history was rewritten.
+        if common and chat_list[common - 1] is not self._entries[common - 1]:
+            common = 0
+        if common < len(self._entries):
+            self._truncate(common)
+
+        new_segments = []
+        for i in range(common, len(chat_list)):
+            chat_entry = chat_list[i]
+            segment = self._render_entry(chat_entry)
+            self._entries.append(chat_entry)
+            self._segments.append(segment)
+            new_segments.append(segment)
+            if isinstance(segment, str):
+                self._offsets.append(self._offsets[-1] + len(segment))
+        if new_segments and isinstance(new_segments[0], str):
+            self._text += "".join(new_segments)
+
+    def _truncate(self, length: int):
+        del self._entries[length:]
+        del self._segments[length:]
+        if length < len(self._token_ids):
+            del self._flat_token_ids[len(self._flat_token_ids) - sum(self._sizes[length:]):]
+            del self._token_ids[length:]
+            del self._sizes[length:]
+        if len(self._offsets) > 1:
+            del self._offsets[length + 1:]
+            self._text = self._text[:self._offsets[-1]]
@@ -0,0 +1,183 @@
+"""
+This file contains the prompt tokenizer of the persons which run a local HuggingFace model.
+
+Tokenizing the whole prompt on every turn makes a session quadratic in tokenization time, as the
+prompt renders the whole history. Instead, every `ChatEntry` caches the token ids of its rendered
+segment per tokenizer, and a `PromptTokenizer` assembles the input ids of a prompt by concatenating
+the cached ids of the header, of every chat entry and of the tail. On each turn only the entries
+which were added since the last turn are tokenized.
+
+Every part of the prompt except the header follows a newline (rendered chat entries end with one),
+so each part is tokenized after a newline anchor, which is then removed. Likewise, a part which ends
+with whitespace is tokenized before a word (as the next part starts with one), as some tokenizers
+split trailing whitespace by what follows it. Tokens don't span newlines in the common tokenizers,
+so the concatenated ids are the ids of the whole prompt.
+
+Models which only receive the prompt text (`HuggingFaceModel`) use `encode_text`, which caches the
+ids of each line of the text instead.
+"""
+from __future__ import annotations
+
+import re
+from itertools import chain
+from typing import Any, Optional, Sequence, TYPE_CHECKING
+
+import torch
+
+if TYPE_CHECKING:
+    from persons.context_window import ContextWindow
+    from persons.prompt_builder import IncrementalPromptBuilder
+    from session_rooms.ChatEntry import ChatEntry
+
+_ANCHOR = "\n"
+_SENTINEL = "x"
+_MAX_CACHED_FIXED_PARTS = 16
+_MAX_CACHED_TEXT_SEGMENTS = 4096
+# Splits a text into lines, where the next line starts with a word (as the parts of a prompt do).
+_LINES_PATTERN = re.compile(r"(?<=\n)(?=\S)")
+
+
+class PromptTokenizer:
+    """
+    Tokenizes the prompts of a person, reusing the cached token ids of its parts.
+
+    :param tokenizer: the tokenizer of the model the prompts are fed into.
+    """
+
+    def __init__(self, tokenizer: Any):
+        self.tokenizer = tokenizer
+        self._anchor_ids = tuple(tokenizer(_ANCHOR, add_special_tokens=False).input_ids)
+        self._sentinel_ids = self._strip_anchor(
+            tuple(tokenizer(_ANCHOR + _SENTINEL, add_special_tokens=False).input_ids))
+        self._fixed_ids: dict[tuple[bool, str], tuple[int, ...]] = {}
+        self._text_segment_ids: dict[str, tuple[int, ...]] = {}
+
+    def encode_segment(self, text: str, followed: bool = True) -> tuple[int, ...]:
+        """
+        The ids of `text`, as a part of the prompt which follows a newline (and which is followed
+        by a word, unless `followed` is False).
+        """
+        input_ids = self._encode(text, anchored=True, followed=followed)
+        if input_ids is not None:
+            return input_ids
+        # The anchor was merged with the text (e.g. with its leading newlines).
+        return self._encode(text, anchored=False, followed=followed)
+
+    def _encode(self, text: str, anchored: bool, followed: bool = True,
+                add_special_tokens: bool = False) -> Optional[tuple[int, ...]]:
+        prefix = _ANCHOR if anchored else ""
+        if followed and text[-1:].isspace() and self._sentinel_ids:
+            input_ids = self._strip_anchor(
+                tuple(self.tokenizer(prefix + text + _SENTINEL, add_special_tokens=add_special_tokens).input_ids),
+                anchored)
+            if input_ids is not None and input_ids[-len(self._sentinel_ids):] == self._sentinel_ids:
+                return input_ids[:-len(self._sentinel_ids)]
+        return self._strip_anchor(
+            tuple(self.tokenizer(prefix + text, add_special_tokens=add_special_tokens).input_ids), anchored)
+
+    def _strip_anchor(self, input_ids: tuple[int, ...], anchored: bool = True) -> Optional[tuple[int, ...]]:
+        if not anchored:
+            return input_ids
+        if input_ids[:len(self._anchor_ids)] != self._anchor_ids:
+            return None
+        return input_ids[len(self._anchor_ids):]
+
+    def encode_entry(self, chat_entry: ChatEntry, segment: str) -> tuple[int, ...]:
+        """ The ids of the rendered `segment` of `chat_entry`, cached in the entry itself. """
+        return chat_entry.token_ids(self.tokenizer, segment, self.encode_segment)
+
+    def encode_fixed(self, text: str, add_special_tokens: bool = False) -> tuple[int, ...]:
+        """
+        The ids of the fixed parts of the prompt, which repeat on every turn: the header (the start
+        of the prompt, with the special tokens), or the tail (which follows a newline, and ends the prompt).
+        """
+        key = (add_special_tokens, text)
+        if key not in self._fixed_ids:
+            if len(self._fixed_ids) >= _MAX_CACHED_FIXED_PARTS:
+                self._fixed_ids.clear()
+            if add_special_tokens:
+                self._fixed_ids[key] = self._encode(text, anchored=False, add_special_tokens=True)
+            elif not text:
+                self._fixed_ids[key] = ()
+            else:
+                self._fixed_ids[key] = self.encode_segment(text, followed=False)
+        return self._fixed_ids[key]
+
+    def special_ids(self) -> tuple[int, ...]:
+        """ The special tokens (e.g. BOS) which start every prompt. """
+        return self.encode_fixed("", add_special_tokens=True)
+
+    def prompt_ids(self, prompt_builder: IncrementalPromptBuilder, chat_list: Sequence[ChatEntry],
+                   header: str, tail: str, context_window: ContextWindow = None) -> list[int]:
+        """
+        The ids of the prompt `header + history + tail`, where the history is rendered by
+        `prompt_builder`, and trimmed by `context_window` (if any) as `ContextWindow.fit` does.
+        """
+        header_ids, history_ids, tail_ids = self.prompt_parts_ids(
+            prompt_builder, chat_list, header, tail, context_window)
+        return [*header_ids, *history_ids, *tail_ids]
+
+    def prompt_parts_ids(self, prompt_builder: IncrementalPromptBuilder, chat_list: Sequence[ChatEntry],
+                         header: str, tail: str, context_window: ContextWindow = None
+                         ) -> tuple[Sequence[int], Sequence[int], Sequence[int]]:
+        """ Same as `prompt_ids`, with the ids of the header, the history and the tail apart. """
+        header_ids = self.encode_fixed(header, add_special_tokens=True)
+        tail_ids = self.encode_fixed(tail)
+        if context_window is None:
+            return header_ids, prompt_builder.flat_token_ids(chat_list, self.encode_entry), tail_ids
+        header_ids, history_ids = context_window.fit_ids(prompt_builder, chat_list, header_ids, tail_ids)
+        return header_ids, history_ids, tail_ids
+
+    def encode_text(self, text: str) -> list[int]:
+        """
+        The ids of a whole prompt (with the special tokens), given only as text. The ids of each
+        line are cached, so only the lines which weren't seen yet are tokenized.
+        """
+        first, *lines = _LINES_PATTERN.split(text)
+        if not lines:
+            return list(self._encode(text, anchored=False, followed=False, add_special_tokens=True))
+        input_ids = list(self.encode_fixed(first, add_special_tokens=True))
+        for line in lines[:-1]:
+            line_ids = self._text_segment_ids.get(line)
+            if line_ids is None:
+                if len(self._text_segment_ids) >= _MAX_CACHED_TEXT_SEGMENTS:
+                    self._text_segment_ids.clear()
+                line_ids = self._text_segment_ids[line] = self.encode_segment(line)
+            input_ids.extend(line_ids)
+        # The last line ends the prompt, and it's usually the one which changes between prompts.
+        input_ids.extend(self.encode_segment(lines[-1], followed=False))
+        return input_ids
+
+
+def concat_ids(segments_ids: Sequence[Sequence[int]]) -> list[int]:
+    return list(chain.from_iterable(segments_ids))
+
+
+def left_pad(sequences: Sequence[Sequence[int]], pad_token_id: int) -> tuple[torch.Tensor, torch.Tensor]:
+    """ The input ids and the attention mask of a left padded batch of token id sequences. """
+    length = max(len(sequence) for sequence in sequences)
+    input_ids = torch.full((len(sequences), length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), length), dtype=torch.long)
+    for row, sequence in enumerate(sequences):
+        if sequence:
+            input_ids[row, length - len(sequence):] = torch.tensor(sequence, dtype=torch.long)
+            attention_mask[row, length - len(sequence):] = 1
+    return input_ids, attention_mask
+
+
+def length_buckets(lengths: Sequence[int], max_new_tokens: int, max_tokens: Optional[int]) -> list[list[int]]:
+    """
+    Splits the indices of sequences of the given `lengths` into batches of similar lengths, such that
+    every batch (left padded, with `max_new_tokens` generated tokens per row) has at most `max_tokens`
+    tokens. A longer sequence is a batch of its own. Without `max_tokens`, all the indices are a single batch.
+    """
+    if max_tokens is None:
+        return [list(range(len(lengths)))]
+    buckets: list[list[int]] = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # The sequences are sorted, so the new one is the longest in its batch.
+        if buckets and (len(buckets[-1]) + 1) * (lengths[i] + max_new_tokens) <= max_tokens:
+            buckets[-1].append(i)
+        else:
+            buckets.append([i])
+    return buckets
@@ -0,0 +1,93 @@
+"""
+This file contains the stopping criteria of the persons which run a local HuggingFace model.
+
+The persons keep only a part of the generated text (usually its first line), but generation runs
+until `max_new_tokens`, so most of the decoding steps compute tokens which are thrown away.
+A `StopStringsCriteria` stops the generation as soon as every generated text contains one of its
+stop strings (e.g. a newline, the name prefix of the next speaker, or the end marker of the prompt
+template), so the kept part of each answer is complete.
+
+In a batch, every row is checked on its own. A row is finished once it contains a stop string or
+the EOS token, and the generation stops when all the rows are finished.
+
+Persons read the stop strings from the "stop_strings" key of their configuration (a list of strings,
+or false to always generate `max_new_tokens` tokens).
+"""
+from __future__ import annotations
+
+import logging
+from typing import Any, Optional, Sequence, Union
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+log = logging.getLogger(__name__)
+
+# Every person keeps only the first line of its answer by default.
+DEFAULT_STOP_STRINGS = ("\n",)
+
+
+class StopStringsCriteria(StoppingCriteria):
+    """
+    Stops the generation once the text generated by every row contains one of `stop_strings`.
+
+    :param prompt_length: the length of the (padded) input ids, after which the generated tokens start.
+    :param skip_leading_whitespace: whether the whitespace which starts the generated text is ignored
+        (for answers which are stripped before they are cut at the stop string).
+    """
+
+    def __init__(self, tokenizer: Any, stop_strings: Sequence[str], prompt_length: int,
+                 skip_leading_whitespace: bool = False):
+        self.tokenizer = tokenizer
+        self.stop_strings = tuple(stop_strings)
+        self.prompt_length = prompt_length
+        self.skip_leading_whitespace = skip_leading_whitespace
+        self._finished: Optional[list[bool]] = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        if self._finished is None:
+            self._finished = [False] * input_ids.shape[0]
+        for row, finished in enumerate(self._finished):
+            if not finished:
+                self._finished[row] = self.is_finished(input_ids[row, self.prompt_length:])
+        if all(self._finished):
+            log.debug(f"Stopped generating after {input_ids.shape[1] - self.prompt_length} tokens")
+            return True
+        return False
+
+    def is_finished(self, generated_ids: torch.Tensor) -> bool:
+        """ Whether a row which generated `generated_ids` (without its prompt) is finished. """
+        eos_token_id = self.tokenizer.eos_token_id
+        if eos_token_id is not None and bool((generated_ids == eos_token_id).any()):
+            return True
+        text = self.tokenizer.decode(generated_ids, skip_special_tokens=True)
+        if self.skip_leading_whitespace:
+            text = text.lstrip()
+        return any(stop_string in text for stop_string in self.stop_strings)
+
+
+def get_stop_strings(config: Union[None, bool, str, Sequence[str]],
+                     default: Optional[Sequence[str]] = DEFAULT_STOP_STRINGS) -> Optional[tuple[str, ...]]:
+    """ The stop strings described by the "stop_strings" configuration of a person (None to disable). """
+    if config is None or config is True:
+        config = default
+    elif isinstance(config, str):
+        config = [config]
+    return tuple(config) if config else None
+
+
+def stopping_criteria(tokenizer: Any, stop_strings: Optional[Sequence[str]], prompt_length: int,
+                      skip_leading_whitespace: bool = False) -> Optional[StoppingCriteriaList]:
+    """ The `stopping_criteria` argument of `model.generate` for `stop_strings` (None if there are none). """
+    if not stop_strings:
+        return None
+    return StoppingCriteriaList([
+        StopStringsCriteria(tokenizer, stop_strings, prompt_length, skip_leading_whitespace)])
+
+
+def row_stop_criteria(tokenizer: Any, stop_strings: Optional[Sequence[str]],
+                      skip_leading_whitespace: bool = False) -> Optional[StopStringsCriteria]:
+    """ The criteria checked by `is_finished` for a single row (e.g. by `persons.generation_engine`). """
+    if not stop_strings:
+        return None
+    return StopStringsCriteria(tokenizer, stop_strings, 0, skip_leading_whitespace)
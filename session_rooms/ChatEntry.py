@@ -1,7 +1,8 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
-from typing import Any, TYPE_CHECKING, Union
+import dataclasses
+import sys
+from typing import Any, Callable, Optional, Sequence, TYPE_CHECKING, Union
 
 from termcolor import colored
 
@@ -9,15 +10,137 @@ if TYPE_CHECKING:
     from persons.person import Person
     from session_rooms.session_room import System
 
+# Strings up to this length (names, times, short prompts) are interned, so repeated values are
+# stored only once across the whole session.
+_INTERN_MAX_LENGTH = 64
+
+
+def _intern(value: Any) -> Any:
+    if type(value) is str and len(value) <= _INTERN_MAX_LENGTH:
+        return sys.intern(value)
+    return value
+
+
+class LazyPrompt:
+    """
+    A prompt which is rendered only when it is read.
+
+    Instead of the full prompt string (which renders the whole history, so storing one per entry
+    is quadratic in the session length), it keeps the template which rendered it, a reference to
+    the history and the length of the history when the prompt was created.
+    The template must only depend on the given history (and `args`), and the history must be
+    append only (as chat rooms are), so rendering it again gives the original prompt.
+    Lazy prompts are compared by their template, arguments and history, and pickled rendered.
+    """
+    __slots__ = ("template", "history", "offset", "args")
+
+    def __init__(self, template: Callable[..., Any], history: Sequence[ChatEntry], *args,
+                 offset: int = None):
+        self.template = template
+        self.history = history
+        self.offset = len(history) if offset is None else offset
+        self.args = args
+
+    def render(self) -> Any:
+        return self.template(self.history[:self.offset], *self.args)
+
+    def __eq__(self, other):
+        # Prompts of the same template, arguments and history are equal without rendering them.
+        if isinstance(other, LazyPrompt):
+            return (self.template, self.offset, self.args) == (other.template, other.offset, other.args) and \
+                (self.history is other.history or self.history[:self.offset] == other.history[:other.offset])
+        if isinstance(other, str):
+            return self.render() == other
+        return NotImplemented
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # The template is usually a method of a person, which must not be pickled with its model.
+        return str, (self.render(),)
+
 
-@dataclass
 class ChatEntry:
-    entity: Union['Person', 'System']
-    prompt: Any
-    answer: str
-    # The original embedding from the mind of the agent who generated this entry.
-    original_embedding: Any = None
-    time: str = None
+    """
+    A single message of the chat.
+
+    Entries are kept for the whole session (in every room of a batch), so the class is compact:
+    it uses `__slots__`, interns short strings, and accepts a `LazyPrompt` instead of the prompt
+    string. `prompt` always returns the rendered prompt.
+    It also caches the token ids of its renderings per tokenizer (see `token_ids`).
+    """
+    __slots__ = ("entity", "_prompt", "answer", "original_embedding", "time", "_token_ids")
+
+    def __init__(self, entity: Union['Person', 'System'], prompt: Any, answer: str,
+                 original_embedding: Any = None, time: str = None):
+        self.entity = entity
+        self._prompt = _intern(prompt)
+        self.answer = _intern(answer)
+        # The original embedding from the mind of the agent who generated this entry.
+        self.original_embedding = original_embedding
+        self.time = _intern(time)
+        self._token_ids = None
+
+    @property
+    def prompt(self) -> Any:
+        if isinstance(self._prompt, LazyPrompt):
+            return self._prompt.render()
+        return self._prompt
+
+    @prompt.setter
+    def prompt(self, prompt: Any):
+        self._prompt = _intern(prompt)
+
+    @property
+    def lazy_prompt(self) -> Optional[LazyPrompt]:
+        """ The prompt of this entry if it's rendered lazily, None otherwise. """
+        return self._prompt if isinstance(self._prompt, LazyPrompt) else None
+
+    def token_ids(self, tokenizer: Any, text: str,
+                  encode: Callable[[str], Sequence[int]]) -> Sequence[int]:
+        """
+        Returns the token ids of `text`, a rendering of this entry by some person, encoding it with
+        `encode` only the first time it's requested with `tokenizer`. Persons which render the
+        entry the same way (e.g. every other person of the session) share the cached ids.
+        """
+        # Tokenizers are shared by the model caches and kept for the whole run, so their id is stable.
+        key = (id(tokenizer), text)
+        if self._token_ids is None:
+            self._token_ids = {}
+        input_ids = self._token_ids.get(key)
+        if input_ids is None:
+            input_ids = self._token_ids[key] = encode(text)
+        return input_ids
+
+    def __json__(self):
+        """ The same fields as the former dataclass, with the prompt rendered. """
+        entity = dataclasses.asdict(self.entity) if dataclasses.is_dataclass(self.entity) else self.entity
+        return {
+            "entity": entity,
+            "prompt": self.prompt,
+            "answer": self.answer,
+            "original_embedding": self.original_embedding,
+            "time": self.time,
+        }
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return (self.entity, self._prompt, self.answer, self.original_embedding, self.time) == \
+            (other.entity, other._prompt, other.answer, other.original_embedding, other.time)
+
+    __hash__ = None
+
+    def __getstate__(self):
+        # The cached token ids are keyed by tokenizers of this process, and lazy prompts are rendered.
+        state = {slot: getattr(self, slot) for slot in self.__slots__ if slot != "_token_ids"}
+        state["_prompt"] = self.prompt
+        return state
+
+    def __setstate__(self, state: dict):
+        object.__setattr__(self, "_token_ids", None)
+        for slot, value in state.items():
+            object.__setattr__(self, slot, value)
 
     def __str__(self):
         name = self.entity.name if hasattr(self.entity,"name") else self.entity.get("name")
@@ -3,8 +3,10 @@ import logging
 from typing import TYPE_CHECKING
 
 
+from . import async_session_room
 from . import batch_session_room
 from . import session_room
+from . import tick_session_room
 
 logging.getLogger(__name__).setLevel(logging.DEBUG)
 if TYPE_CHECKING:
@@ -14,6 +16,8 @@ if TYPE_CHECKING:
 def get_session_room(name: str) -> type['SessionRoom']:
     _dict = {
         "base": session_room.SessionRoom,
-        "batch": batch_session_room.BatchSessionRoom
+        "batch": batch_session_room.BatchSessionRoom,
+        "async": async_session_room.AsyncSessionRoom,
+        "tick": tick_session_room.TickSessionRoom,
     }
     return _dict.get(name)
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import pickle
+from typing import TYPE_CHECKING
+
+from experiments.experiment_output import ExperimentOutput
+from .session_room import SessionRoom
+
+if TYPE_CHECKING:
+    from persons.person import Person
+
+log = logging.getLogger(__name__)
+
+
+class AsyncSessionRoom(SessionRoom):
+    """
+    A session room driven by an asyncio event loop.
+
+    Persons are asked through `Person.agenerate_answer`, so I/O bound persons don't block the loop,
+    and survey answers are generated concurrently. Several experiments can run on the same event
+    loop by awaiting `arun` (or `Experiment.arun`) of each one of them.
+    """
+
+    def run(self, save_session_file_name: str = None) -> ExperimentOutput:
+        return asyncio.run(self.arun(save_session_file_name))
+
+    async def arun(self, save_session_file_name: str = None) -> ExperimentOutput:
+        """ Runs the session room and returns the generated chat """
+        log.info("Async session room is running")
+
+        output = self._initial_outputs()[0]
+        while not self.experiment.end_type.did_end(self):
+            await self.aask_survey_questions_if_needed(output)
+            new_chat_entry = await self.aiterate()
+            if new_chat_entry is not None:
+                self._store_chat_entry(output, self.chat_room[-1])
+            self._checkpoint_turn([new_chat_entry])
+        await self.aask_survey_questions_if_needed(output)
+
+        if save_session_file_name:
+            await asyncio.get_running_loop().run_in_executor(None, self._save, save_session_file_name)
+
+        return output
+
+    async def aask_survey_questions_if_needed(self, experiment_output: ExperimentOutput):
+        """ Coroutine version of `ask_survey_questions_if_needed`. """
+        survey_questions = self._get_triggered_survey_questions()
+        if not survey_questions:
+            return
+
+        log.info("Starting survey. Everyone is answering this end_prompt:")
+        for survey_question in survey_questions:
+            chat_room_with_survey = self._start_survey_question(experiment_output, survey_question)
+            new_chat_entries = await self.survey_executor.agenerate_answers(
+                self.experiment.persons, self.experiment.scenario, chat_room_with_survey)
+            self._store_survey_answers(experiment_output, new_chat_entries)
+            self._checkpoint_survey([experiment_output])
+
+    async def aiterate(self):
+        next_person: Person = self.experiment.host.get_curr_person_and_move_to_next()
+        new_chat_entry = await next_person.agenerate_answer(
+            self.experiment.scenario, self.chat_room)
+        if new_chat_entry is not None:
+            self.chat_room.append(new_chat_entry)
+            log.info(new_chat_entry)
+        return new_chat_entry
+
+    def _save(self, save_session_file_name: str):
+        with open(save_session_file_name, "wb") as file:
+            pickle.dump(self, file)
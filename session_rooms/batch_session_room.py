@@ -5,9 +5,9 @@ import pickle
 from typing import TYPE_CHECKING
 
 from experiments.experiment_output import ExperimentOutput
-from experiments.survey_question import SurveyQuestion
 from .ChatEntry import ChatEntry
 from .session_room import SessionRoom, System
+from .transcript_view import TranscriptView
 
 if TYPE_CHECKING:
     from experiments.batch_experiment import BatchExperiment
@@ -24,12 +24,13 @@ class BatchSessionRoom(SessionRoom):
     def run(self, save_session_file_name: str = None) -> list[ExperimentOutput]:
         log.info("Starting batch session (batch size %d)", self.batch_size)
 
-        outputs = [ExperimentOutput() for _ in range(self.batch_size)]
+        outputs = self._initial_outputs()
         while not self.experiment.end_type.did_end(self):
             self.ask_survey_questions_if_needed(outputs)
             self.iterate()
             for i, room in enumerate(self.chat_rooms):
-                outputs[i].chat_entry.append(room[-1])
+                self._store_chat_entry(outputs[i], room[-1], shard=i)
+            self._checkpoint_turn([room[-1] for room in self.chat_rooms])
         self.ask_survey_questions_if_needed(outputs)
         if save_session_file_name:
             with open(save_session_file_name, "wb") as file:
@@ -41,45 +42,32 @@ class BatchSessionRoom(SessionRoom):
     def ask_survey_questions_if_needed(self, outputs: list[ExperimentOutput]) -> None:
         """
         Asks the survey questions that should be triggered at the current iteration.
-        All persons participant in the survey and answers are stored in the
-        `experiment_output`. This function does not modify `self.chat_room`.
+        Each person answers each survey question once, for all the chat rooms together, and the
+        answer of each room is stored in the `ExperimentOutput` of that room.
+        This function does not modify `self.chat_rooms`.
         """
-        for experiment_output in outputs:
-            # Keep only the survey questions that should be asked at the current iteration.
-            should_keep = lambda cur_len, trigger: (cur_len in trigger) or \
-                                                   f"{trigger}".lower() == "always" or \
-                                                   (-1 in trigger and self.experiment.end_type.did_end(self))
-            survey_questions = [q for q in self.experiment.survey_questions \
-                                if should_keep(len(self.chat_room), q.get("iterations"))]
-
-            if not survey_questions:
-                return
-
-            log.info("Starting survey. Everyone is answering this end_prompt:")
-            for survey_question in survey_questions:
-                experiment_output.survey_question.append(
-                    SurveyQuestion(
-                        question_id=survey_question["id"],
-                        question_content=survey_question["question"],
-                        iteration=len(self.chat_room),
-                        chat_entry=self.chat_room))
-
-                survey_entry = ChatEntry(System(), "", survey_question["question"])
-                log.info(survey_entry)
-                for i in range(len(self.chat_rooms)):
-                    # Copy the chat room, so it can later "forget" the survey question.
-                    self.chat_rooms[i].append(survey_entry)
-
-                for next_person in self.experiment.persons:
-                    new_chat_entry = next_person.generate_answer(
-                        self.experiment.scenario, self.chat_rooms)
+        survey_questions = self._get_triggered_survey_questions()
+        if not survey_questions:
+            return
+
+        log.info("Starting survey. Everyone is answering this end_prompt:")
+        for survey_question in survey_questions:
+            for i, experiment_output in enumerate(outputs):
+                self._store_survey_question(experiment_output, survey_question, shard=i)
+
+            survey_entry = ChatEntry(System(), "", survey_question["question"])
+            log.info(survey_entry)
+            # A view of each chat room with the survey question, so the rooms are never modified.
+            chat_rooms_with_survey = [TranscriptView(room, [survey_entry]) for room in self.chat_rooms]
+
+            for next_person in self.experiment.persons:
+                new_chat_entries = next_person.generate_answer(
+                    self.experiment.scenario, chat_rooms_with_survey)
+                for i, (experiment_output, new_chat_entry) in enumerate(zip(outputs, new_chat_entries)):
                     if new_chat_entry is not None:
-                        experiment_output.survey_question[-1].chat_entry.append(
-                            new_chat_entry)
-                        log.info(new_chat_entry)
-                # remove the question
-                for chat_room in self.chat_rooms:
-                    chat_room.pop()
+                        self._store_survey_answer(experiment_output, new_chat_entry, shard=i)
+                log.info(new_chat_entries)
+            self._checkpoint_survey(outputs)
 
     def iterate(self):
         next_person = self.experiment.host.get_curr_person_and_move_to_next()
@@ -92,6 +80,9 @@ class BatchSessionRoom(SessionRoom):
         for idx, entry in enumerate(new_chat_entries):
             log.info(f"{idx}-{entry}")
 
+    def _chat_rooms(self) -> list[list[ChatEntry]]:
+        return self.chat_rooms
+
     @property
     def session_length(self) -> int:
         return len(min(self.chat_rooms, key=lambda room: len(room)))
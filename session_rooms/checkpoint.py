@@ -0,0 +1,253 @@
+"""
+This file contains an append only checkpoint log of a running session room.
+
+After every turn (and every answered survey question) a single JSON line is appended to the log.
+Each line holds the new chat entries and the state needed to continue the session from it (the
+position of the host, the counters of the end type and the inner state of the persons).
+Models are never written into the log. When resuming, the experiment is loaded again from its
+configuration (which loads the models), and the log is replayed on top of it.
+
+Prompts rendered lazily (see `session_rooms.ChatEntry.LazyPrompt`) aren't rendered into the log, as
+each of them renders the whole history: the log keeps their template (a method of a person), their
+arguments and the length of the history in their room, so the log grows linearly with the session.
+"""
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, IO, List, Optional, Sequence, TYPE_CHECKING, Union
+
+from experiments.experiment_output import ExperimentOutput
+from experiments.output_sink import iter_records
+from experiments.survey_question import SurveyQuestion
+from session_rooms.ChatEntry import ChatEntry, LazyPrompt
+from session_rooms.transcript_view import TranscriptView
+
+if TYPE_CHECKING:
+    from session_rooms.session_room import SessionRoom
+
+log = logging.getLogger(__name__)
+
+TURN_RECORD = "turn"
+SURVEY_RECORD = "survey"
+# Attributes of a batched person holding the entities of its rows.
+_BATCH_ENTITIES_ATTRIBUTES = ("persons_instances", "persons")
+
+
+class CheckpointLog:
+    """
+    Appends the progress of a session room to a JSON lines file.
+
+    :param path: the log file.
+    :param append: whether to continue an existing log (when resuming), instead of overwriting it.
+    :param fsync: whether to force every record to the disk before continuing.
+    """
+
+    def __init__(self, path: Union[str, Path], append: bool = False, fsync: bool = True):
+        self.path = Path(path)
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if append and self.path.exists():
+            self._drop_partial_record()
+        self._file: IO[str] = open(self.path, "a" if append else "w", encoding="utf-8")
+
+    def write_turn(self, session_room: SessionRoom, chat_entries: List[Optional[ChatEntry]]):
+        """ Records a turn, with the new chat entry of each room (or None if nothing was added). """
+        entities = _EntityRefs(session_room.experiment.persons)
+        self._write({
+            "record": TURN_RECORD,
+            "chat_entries": [entities.dump_chat_entry(chat_entry, room)
+                             for chat_entry, room in zip(chat_entries, session_room._chat_rooms())],
+            "state": _dump_state(session_room),
+        })
+
+    def write_survey(self, session_room: SessionRoom, survey_questions: List[SurveyQuestion]):
+        """ Records a fully answered survey question, with its answers in each room. """
+        entities = _EntityRefs(session_room.experiment.persons)
+        self._write({
+            "record": SURVEY_RECORD,
+            "survey_questions": [{
+                "question_id": survey_question.question_id,
+                "question_content": survey_question.question_content,
+                "iteration": survey_question.iteration,
+                "chat_entries": [entities.dump_chat_entry(chat_entry, room)
+                                 for chat_entry in survey_question.chat_entry],
+            } for survey_question, room in zip(survey_questions, session_room._chat_rooms())],
+            "state": _dump_state(session_room),
+        })
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def _write(self, record: dict):
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def _drop_partial_record(self):
+        """ Removes a last record which was only partially written (e.g. the process was killed). """
+        with open(self.path, "rb+") as file:
+            content = file.read()
+            if content and not content.endswith(b"\n"):
+                file.truncate(content.rfind(b"\n") + 1)
+
+
+@dataclass
+class Checkpoint:
+    """ The progress of a session room, as read from a checkpoint log. """
+    rooms: List[List[ChatEntry]] = field(default_factory=list)
+    outputs: List[ExperimentOutput] = field(default_factory=list)
+    # The state of the host, the end type and the persons, after the last durable record.
+    state: Optional[dict] = None
+    # The survey questions already answered at the last iteration of the log.
+    answered_survey_question_ids: set = field(default_factory=set)
+
+
+def read_checkpoint(path: Union[str, Path], session_room: SessionRoom, rooms_count: int) -> Checkpoint:
+    """
+    Replays the checkpoint log at `path` over the persons of `session_room`.
+    Returns the rebuilt rooms and outputs, without modifying `session_room`.
+    """
+    entities = _EntityRefs(session_room.experiment.persons)
+    checkpoint = Checkpoint(rooms=[[] for _ in range(rooms_count)],
+                            outputs=[ExperimentOutput() for _ in range(rooms_count)])
+    for record in iter_records(path):
+        kind = record.get("record")
+        if kind == TURN_RECORD:
+            for room, output, chat_entry in zip(checkpoint.rooms, checkpoint.outputs,
+                                                record["chat_entries"]):
+                if chat_entry is not None:
+                    chat_entry = entities.load_chat_entry(chat_entry, room)
+                    room.append(chat_entry)
+                    output.chat_entry.append(chat_entry)
+            checkpoint.answered_survey_question_ids = set()
+        elif kind == SURVEY_RECORD:
+            for room, output, survey_question in zip(checkpoint.rooms, checkpoint.outputs,
+                                                     record["survey_questions"]):
+                output.survey_question.append(SurveyQuestion(
+                    question_id=survey_question["question_id"],
+                    question_content=survey_question["question_content"],
+                    iteration=survey_question["iteration"],
+                    chat_entry=[entities.load_chat_entry(chat_entry, room)
+                                for chat_entry in survey_question["chat_entries"]]))
+            checkpoint.answered_survey_question_ids.add(record["survey_questions"][0]["question_id"])
+        else:
+            continue
+        checkpoint.state = record["state"]
+    return checkpoint
+
+
+def restore_state(session_room: SessionRoom, state: Optional[dict]):
+    """ Restores the host, the end type and the persons of `session_room` to `state`. """
+    if state is None:
+        return
+    experiment = session_room.experiment
+    experiment.host.restore_checkpoint_state(state["host"])
+    experiment.end_type.restore_checkpoint_state(state["end_type"])
+    for person, person_state in zip(experiment.persons, state["persons"]):
+        person.restore_checkpoint_state(person_state)
+
+
+def _dump_state(session_room: SessionRoom) -> dict:
+    experiment = session_room.experiment
+    return {
+        "host": experiment.host.checkpoint_state(),
+        "end_type": experiment.end_type.checkpoint_state(),
+        "persons": [person.checkpoint_state() for person in experiment.persons],
+    }
+
+
+class _EntityRefs:
+    """
+    Maps the entities of chat entries to JSON references and back.
+    A person is referenced by its index in the experiment, a person in a batch by the index of the
+    batched person, the attribute holding its rows and its row. The System is referenced by None.
+    """
+
+    def __init__(self, persons: list):
+        # Imported here, as the persons package imports the session room module.
+        from persons.batch.batch_person import BatchedPerson
+        self.persons = persons
+        self._refs: dict[int, list] = {}
+        for i, person in enumerate(persons):
+            self._refs[id(person)] = [i]
+            if isinstance(person, BatchedPerson):
+                for attribute in _BATCH_ENTITIES_ATTRIBUTES:
+                    for row, entity in enumerate(getattr(person, attribute, ())):
+                        self._refs.setdefault(id(entity), [i, attribute, row])
+
+    def dump_chat_entry(self, chat_entry: Optional[ChatEntry], room: Sequence[ChatEntry] = ()) -> Optional[dict]:
+        """ The JSON record of `chat_entry`, whose lazy prompt (if any) renders a history of `room`. """
+        if chat_entry is None:
+            return None
+        lazy_prompt = chat_entry.lazy_prompt
+        return {
+            "speaker": self._refs.get(id(chat_entry.entity)),
+            "prompt": (self._dump_lazy_prompt(lazy_prompt, room) if lazy_prompt is not None else None)
+                      or chat_entry.prompt,
+            "answer": chat_entry.answer,
+            "time": chat_entry.time,
+        }
+
+    def load_chat_entry(self, chat_entry: dict, room: Sequence[ChatEntry] = ()) -> ChatEntry:
+        prompt = chat_entry["prompt"]
+        if isinstance(prompt, dict):
+            prompt = self._load_lazy_prompt(prompt, room)
+        return ChatEntry(entity=self._load_entity(chat_entry["speaker"]), prompt=prompt,
+                         answer=chat_entry["answer"], time=chat_entry["time"])
+
+    def _dump_lazy_prompt(self, prompt: LazyPrompt, room: Sequence[ChatEntry]) -> Optional[dict]:
+        """
+        The template, arguments and history of `prompt`, where the history is the first entries of
+        `room` followed by a few other entries (e.g. a survey question), or None if the prompt can only
+        be written rendered (its template isn't a method of a person, or its arguments aren't JSON values).
+        """
+        owner = self._refs.get(id(getattr(prompt.template, "__self__", None)))
+        if owner is None:
+            return None
+        args = []
+        for arg in prompt.args:
+            ref = self._refs.get(id(arg))
+            if ref is not None:
+                args.append({"ref": ref})
+            elif arg is None or isinstance(arg, (str, int, float, bool)):
+                args.append({"value": arg})
+            else:
+                return None
+        # The room is append only, so the history shares all the entries of the room up to its last shared one.
+        shared = min(prompt.offset, len(room))
+        while shared > 0 and prompt.history[shared - 1] is not room[shared - 1]:
+            shared -= 1
+        return {
+            "template": [owner, prompt.template.__name__],
+            "args": args,
+            "shared": shared,
+            "extra": [self.dump_chat_entry(chat_entry) for chat_entry in prompt.history[shared:prompt.offset]],
+        }
+
+    def _load_lazy_prompt(self, prompt: dict, room: List[ChatEntry]) -> LazyPrompt:
+        owner, template = prompt["template"]
+        args = [self._load_entity(arg["ref"]) if "ref" in arg else arg["value"] for arg in prompt["args"]]
+        extra = [self.load_chat_entry(chat_entry) for chat_entry in prompt["extra"]]
+        shared = prompt["shared"]
+        base = room if shared == len(room) else room[:shared]
+        return LazyPrompt(getattr(self._load_entity(owner), template), TranscriptView(base, extra), *args)
+
+    def _load_entity(self, ref: Optional[list]) -> Any:
+        if ref is None:
+            # Imported here, as the session room module imports this one.
+            from session_rooms.session_room import System
+            return System()
+        person = self.persons[ref[0]]
+        if len(ref) == 1:
+            return person
+        return getattr(person, ref[1])[ref[2]]
@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import copy
 import logging
 from dataclasses import dataclass
 from typing import List, Optional
@@ -12,9 +11,13 @@ from experiments.survey_question import SurveyQuestion
 from typing import TYPE_CHECKING
 
 from session_rooms.ChatEntry import ChatEntry
+from session_rooms.survey_executor import DEFAULT_MAX_WORKERS, SurveyExecutor
+from session_rooms.transcript_view import TranscriptView
 
 if TYPE_CHECKING:
     from experiments.experiment import Experiment
+    from experiments.output_sink import JsonlOutputSink
+    from session_rooms.checkpoint import CheckpointLog
     from persons.person import Person
 
 log = logging.getLogger(__name__)
@@ -24,17 +27,25 @@ class SessionRoom:
     def __init__(self, experiment: Optional[Experiment], *args, **kwargs):
         self.experiment: Experiment = experiment
         self.chat_room: List[ChatEntry] = []
+        self.survey_executor = SurveyExecutor(kwargs.get("survey_max_workers", DEFAULT_MAX_WORKERS))
+        # When set, every entry of the output is also streamed into it as soon as it's produced.
+        self.output_sink: Optional[JsonlOutputSink] = None
+        # When set, the progress of the session is appended into it after every turn.
+        self.checkpoint: Optional[CheckpointLog] = None
+        self._restored_outputs: Optional[List[ExperimentOutput]] = None
+        self._answered_survey_question_ids: set = set()
 
     def run(self, save_session_file_name: str = None) -> ExperimentOutput:
         """ Runs the session room and returns the generated chat as a dataframe """
         log.info("Session room is running")
 
-        output = ExperimentOutput()
+        output = self._initial_outputs()[0]
         while not self.experiment.end_type.did_end(self):
             self.ask_survey_questions_if_needed(output)
             new_chat_entry = self.iterate()
             if new_chat_entry is not None:
-                output.chat_entry.append(self.chat_room[-1])
+                self._store_chat_entry(output, self.chat_room[-1])
+            self._checkpoint_turn([new_chat_entry])
         self.ask_survey_questions_if_needed(output)
 
         if save_session_file_name:
@@ -49,38 +60,123 @@ class SessionRoom:
         All persons participant in the survey and answers are stored in the
         `experiment_output`. This function does not modify `self.chat_room`.
         """
-
-        # Keep only the survey questions that should be asked at the current iteration.
-        should_keep = lambda cur_len, trigger: (cur_len in trigger) or \
-                                               f"{trigger}".lower() == "always" or \
-                                               (-1 in trigger and self.experiment.end_type.did_end(self))
-        survey_questions = [q for q in self.experiment.survey_questions \
-                            if should_keep(len(self.chat_room), q.get("iterations"))]
-
+        survey_questions = self._get_triggered_survey_questions()
         if not survey_questions:
             return
 
         log.info("Starting survey. Everyone is answering this end_prompt:")
         for survey_question in survey_questions:
-            experiment_output.survey_question.append(
-                SurveyQuestion(
-                    question_id=survey_question["id"],
-                    question_content=survey_question["question"],
-                    iteration=len(self.chat_room),
-                    chat_entry=self.chat_room))
-
-            survey_entry = ChatEntry(System(), "", survey_question["question"])
-            log.info(survey_entry)
-            # Copy the chat room, so it can later "forget" the survey question.
-            chat_room_with_survery = copy.deepcopy(self.chat_room) + [survey_entry]
-
-            for next_person in self.experiment.persons:
-                new_chat_entry = next_person.generate_answer(
-                    self.experiment.scenario, chat_room_with_survery)
-                if new_chat_entry is not None:
-                    experiment_output.survey_question[-1].chat_entry.append(
-                        new_chat_entry)
-                    log.info(new_chat_entry)
+            chat_room_with_survey = self._start_survey_question(experiment_output, survey_question)
+            new_chat_entries = self.survey_executor.generate_answers(
+                self.experiment.persons, self.experiment.scenario, chat_room_with_survey)
+            self._store_survey_answers(experiment_output, new_chat_entries)
+            self._checkpoint_survey([experiment_output])
+
+    def restore_from_checkpoint(self, checkpoint_path: str):
+        """
+        Continues the session from the checkpoint log at `checkpoint_path` (written into
+        `self.checkpoint` by a previous run of the same configuration).
+        The chat, the survey answers and the state of the host, the end type and the persons are
+        restored, so the next `run` continues right after the last recorded turn.
+        """
+        # Imported here, as the checkpoint module imports the output modules, which import this one.
+        from session_rooms.checkpoint import read_checkpoint, restore_state
+
+        rooms = self._chat_rooms()
+        checkpoint = read_checkpoint(checkpoint_path, self, len(rooms))
+        for room, restored_room in zip(rooms, checkpoint.rooms):
+            room[:] = restored_room
+        restore_state(self, checkpoint.state)
+        self._restored_outputs = checkpoint.outputs
+        self._answered_survey_question_ids = checkpoint.answered_survey_question_ids
+        if self.output_sink is not None:
+            for shard, output in enumerate(checkpoint.outputs):
+                for chat_entry in output.chat_entry:
+                    self.output_sink.write_chat_entry(chat_entry, shard)
+                for survey_question in output.survey_question:
+                    self.output_sink.write_survey_question(survey_question, shard)
+                    for chat_entry in survey_question.chat_entry:
+                        self.output_sink.write_survey_answer(survey_question, chat_entry, shard)
+        log.info(f"Restored {self.session_length} chat entries from {checkpoint_path}")
+
+    def _chat_rooms(self) -> List[List[ChatEntry]]:
+        return [self.chat_room]
+
+    def _initial_outputs(self) -> List[ExperimentOutput]:
+        """ The outputs to continue, restored from a checkpoint (only for the first run), or new ones. """
+        outputs, self._restored_outputs = self._restored_outputs, None
+        return outputs or [ExperimentOutput() for _ in self._chat_rooms()]
+
+    def _checkpoint_turn(self, chat_entries: List[Optional[ChatEntry]]):
+        if self.checkpoint is not None:
+            self.checkpoint.write_turn(self, chat_entries)
+
+    def _checkpoint_survey(self, experiment_outputs: List[ExperimentOutput]):
+        if self.checkpoint is not None:
+            self.checkpoint.write_survey(
+                self, [experiment_output.survey_question[-1] for experiment_output in experiment_outputs])
+
+    def _get_triggered_survey_questions(self) -> list[dict]:
+        """ Returns the survey questions that should be asked at the current iteration. """
+        should_keep = lambda cur_len, trigger: f"{trigger}".lower() == "always" or \
+                                               (cur_len in trigger) or \
+                                               (-1 in trigger and self.experiment.end_type.did_end(self))
+        survey_questions = [q for q in self.experiment.survey_questions \
+                            if should_keep(self.session_length, q.get("iterations"))]
+        # Right after resuming, the questions that were already answered at this iteration are skipped.
+        answered, self._answered_survey_question_ids = self._answered_survey_question_ids, set()
+        return [q for q in survey_questions if q["id"] not in answered]
+
+    def _store_chat_entry(self, experiment_output: ExperimentOutput, chat_entry: ChatEntry,
+                          shard: int = 0):
+        experiment_output.chat_entry.append(chat_entry)
+        if self.output_sink is not None:
+            self.output_sink.write_chat_entry(chat_entry, shard)
+
+    def _store_survey_question(self, experiment_output: ExperimentOutput, survey_question: dict,
+                               shard: int = 0):
+        experiment_output.survey_question.append(
+            SurveyQuestion(
+                question_id=survey_question["id"],
+                question_content=survey_question["question"],
+                iteration=self.session_length,
+                chat_entry=[]))
+        if self.output_sink is not None:
+            self.output_sink.write_survey_question(experiment_output.survey_question[-1], shard)
+
+    def _store_survey_answer(self, experiment_output: ExperimentOutput, chat_entry: ChatEntry,
+                             shard: int = 0):
+        experiment_output.survey_question[-1].chat_entry.append(chat_entry)
+        if self.output_sink is not None:
+            self.output_sink.write_survey_answer(experiment_output.survey_question[-1], chat_entry, shard)
+
+    def _start_survey_question(self, experiment_output: ExperimentOutput,
+                               survey_question: dict) -> TranscriptView:
+        """
+        Adds the survey question to `experiment_output`, and returns the chat room as seen by the
+        persons answering it.
+        """
+        self._store_survey_question(experiment_output, survey_question)
+
+        survey_entry = ChatEntry(System(), "", survey_question["question"])
+        log.info(survey_entry)
+        # A view of the chat room with the survey question, so the chat room itself
+        # never sees (and doesn't need to "forget") the survey question.
+        return TranscriptView(self.chat_room, [survey_entry])
+
+    def _store_survey_answers(self, experiment_output: ExperimentOutput,
+                              new_chat_entries: List[Optional[ChatEntry]]):
+        for new_chat_entry in new_chat_entries:
+            if new_chat_entry is not None:
+                self._store_survey_answer(experiment_output, new_chat_entry)
+                log.info(new_chat_entry)
+
+    def __getstate__(self):
+        # Open files are not pickled with the session.
+        state = self.__dict__.copy()
+        state["output_sink"] = None
+        state["checkpoint"] = None
+        return state
 
     @staticmethod
     def load_from_pickle(save_session_file_name: str) -> SessionRoom:
@@ -0,0 +1,138 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Hashable, Sequence, TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from persons.person import Person
+    from session_rooms.ChatEntry import ChatEntry
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class SurveyExecutor:
+    """
+    Collects the answers of all persons to a single survey question.
+
+    The answers are independent of each other, so:
+        - Persons which share the same model (same `batch_generation_key`) answer together in a
+          single batched generation call.
+        - All the other persons answer concurrently on a bounded thread pool, except for persons
+          sharing a model instance (see `Person.shared_models`), which isn't thread-safe, so they
+          answer one after another on the same thread.
+        - Interactive persons (e.g. humans) answer one after another in the calling thread.
+    The answers are always returned in the order of the given persons.
+    """
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+
+    def generate_answers(self, persons: Sequence[Person], experiment_scenario: str,
+                         chat_list: Sequence[ChatEntry]) -> list[Union[ChatEntry, None]]:
+        answers: list[Union[ChatEntry, None]] = [None] * len(persons)
+        interactive = [i for i, person in enumerate(persons) if person.INTERACTIVE]
+        tasks = self._tasks(persons)
+        workers = min(self.max_workers, len(tasks))
+        if workers <= 1:
+            for task in tasks:
+                self._scatter(answers, self._indices(task),
+                              self._generate_task(persons, task, experiment_scenario, chat_list))
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="survey") as pool:
+                futures: list[tuple[list[list[int]], Future]] = [
+                    (task, pool.submit(self._generate_task, persons, task, experiment_scenario, chat_list))
+                    for task in tasks]
+                for i in interactive:
+                    answers[i] = persons[i].generate_answer(experiment_scenario, chat_list)
+                interactive = []
+                for task, future in futures:
+                    self._scatter(answers, self._indices(task), future.result())
+        for i in interactive:
+            answers[i] = persons[i].generate_answer(experiment_scenario, chat_list)
+        return answers
+
+    async def agenerate_answers(self, persons: Sequence[Person], experiment_scenario: str,
+                                chat_list: Sequence[ChatEntry]) -> list[Union[ChatEntry, None]]:
+        """
+        Coroutine version of `generate_answers`. At most `max_workers` persons (or batches of
+        persons) are generating at the same time.
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(max(self.max_workers, 1))
+        interactive_lock = asyncio.Lock()
+
+        async def generate(task: list[list[int]]) -> list[Union[ChatEntry, None]]:
+            person = persons[task[0][0]]
+            if person.INTERACTIVE:
+                async with interactive_lock:
+                    return [await person.agenerate_answer(experiment_scenario, chat_list)]
+            async with semaphore:
+                if len(task) == 1 and len(task[0]) == 1:
+                    return [await person.agenerate_answer(experiment_scenario, chat_list)]
+                return await loop.run_in_executor(None, self._generate_task, persons, task,
+                                                  experiment_scenario, chat_list)
+
+        tasks = [[[i]] for i, person in enumerate(persons) if person.INTERACTIVE] + self._tasks(persons)
+        answers: list[Union[ChatEntry, None]] = [None] * len(persons)
+        for task, task_answers in zip(tasks, await asyncio.gather(*map(generate, tasks))):
+            self._scatter(answers, self._indices(task), task_answers)
+        return answers
+
+    @staticmethod
+    def _group(persons: Sequence[Person]) -> dict[Hashable, list[int]]:
+        """ Groups the indices of the persons that should generate their answers together. """
+        groups: dict[Hashable, list[int]] = {}
+        for i, person in enumerate(persons):
+            key = person.batch_generation_key()
+            if person.INTERACTIVE or key is None:
+                groups[("single", i)] = [i]
+            else:
+                groups.setdefault(key, []).append(i)
+        return groups
+
+    @classmethod
+    def _tasks(cls, persons: Sequence[Person]) -> list[list[list[int]]]:
+        """
+        Splits the groups of the (non-interactive) persons into tasks, which run on a single thread
+        each: the groups of persons sharing a model are in the same task.
+        """
+        tasks: list[tuple[set, list[list[int]]]] = []
+        for indices in cls._group(persons).values():
+            if persons[indices[0]].INTERACTIVE:
+                continue
+            models = {model for i in indices for model in persons[i].shared_models()}
+            groups = [indices]
+            for task_models, task_groups in [task for task in tasks if task[0] & models]:
+                models |= task_models
+                groups = task_groups + groups
+            tasks = [task for task in tasks if not task[0] & models]
+            tasks.append((models, groups))
+        return [groups for _, groups in tasks]
+
+    @classmethod
+    def _generate_task(cls, persons: Sequence[Person], task: list[list[int]], experiment_scenario: str,
+                       chat_list: Sequence[ChatEntry]) -> list[Union[ChatEntry, None]]:
+        return [answer for indices in task
+                for answer in cls._generate_group(persons, indices, experiment_scenario, chat_list)]
+
+    @staticmethod
+    def _generate_group(persons: Sequence[Person], indices: list[int], experiment_scenario: str,
+                        chat_list: Sequence[ChatEntry]) -> list[Union[ChatEntry, None]]:
+        if len(indices) == 1:
+            return [persons[indices[0]].generate_answer(experiment_scenario, chat_list)]
+        group = [persons[i] for i in indices]
+        log.debug(f"Generating {len(group)} survey answers in a single batch")
+        return type(group[0]).generate_batch_answers(group, experiment_scenario, chat_list)
+
+    @staticmethod
+    def _indices(task: list[list[int]]) -> list[int]:
+        return [i for indices in task for i in indices]
+
+    @staticmethod
+    def _scatter(answers: list, indices: list[int], group_answers: list):
+        for i, answer in zip(indices, group_answers):
+            answers[i] = answer
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import logging
+import random
+from typing import List, Optional, TYPE_CHECKING
+
+from .session_room import ChatEntry, SessionRoom
+
+if TYPE_CHECKING:
+    from experiments.experiment import Experiment
+    from persons.asynchronous_persons.inner_scheduler_asynchronous_person import InnerSchedulerAsynchronousPerson
+
+log = logging.getLogger(__name__)
+
+# How the speaker of a tick is chosen among the persons that want to speak:
+# the first one, starting from the person the host chose,
+FIRST_SPEAKER = "first"
+# the one with the highest probability of speaking,
+HIGHEST_PROBABILITY_SPEAKER = "highest_probability"
+# or a random one.
+RANDOM_SPEAKER = "random"
+
+
+class TickSessionRoom(SessionRoom):
+    """
+    A session room where every inner scheduler person decides whether to speak on every tick.
+
+    When the host chooses an inner scheduler person which decides by logits (see `decision_inputs`),
+    all such persons decide together, in a single padded batch per scheduling model, and only the
+    chosen speaker generates an answer. So the time of a spoken message doesn't grow with the number
+    of silent persons. Other persons are asked one by one, as in the base session room.
+    """
+
+    def __init__(self, experiment: Optional[Experiment], *args, **kwargs):
+        super().__init__(experiment, *args, **kwargs)
+        self.speaker_selection = kwargs.get("speaker_selection", FIRST_SPEAKER)
+        if self.speaker_selection not in (FIRST_SPEAKER, HIGHEST_PROBABILITY_SPEAKER, RANDOM_SPEAKER):
+            raise ValueError(f"Unknown speaker selection: {self.speaker_selection}")
+
+    def iterate(self):
+        # Imported here, as the persons import the session room module.
+        from persons.asynchronous_persons.inner_scheduler_asynchronous_person import \
+            InnerSchedulerAsynchronousPerson, batch_speak_probabilities
+
+        next_person = self.experiment.host.get_curr_person_and_move_to_next()
+        scenario = self.experiment.scenario
+        next_inputs = (next_person.decision_inputs(scenario, self.chat_room)
+                       if isinstance(next_person, InnerSchedulerAsynchronousPerson) else None)
+        if next_inputs is None:
+            return self._generate_answer(next_person)
+
+        persons = self.experiment.persons
+        start = persons.index(next_person)
+        # The persons of the tick, starting from the one the host chose.
+        persons = [person for person in persons[start:] + persons[:start]
+                   if isinstance(person, InnerSchedulerAsynchronousPerson)]
+        # The context of every person is built (and fit into its context window) once per tick.
+        decision_inputs = [next_inputs] + [person.decision_inputs(scenario, self.chat_room) for person in persons[1:]]
+        probabilities = batch_speak_probabilities(persons, scenario, self.chat_room, decision_inputs)
+        speakers = [person for person, probability in zip(persons, probabilities)
+                    if probability is not None and person.wants_to_speak()]
+        if not speakers:
+            log.info("No one chose to speak")
+            return None
+        speaker = self._select_speaker(speakers)
+        log.info(f"{speaker.name} was chosen to speak, out of {len(speakers)} persons who wanted to")
+        return self._append(speaker.generate_decided_answer(scenario, self.chat_room))
+
+    def _select_speaker(self, speakers: List[InnerSchedulerAsynchronousPerson]
+                        ) -> InnerSchedulerAsynchronousPerson:
+        if self.speaker_selection == HIGHEST_PROBABILITY_SPEAKER:
+            return max(speakers, key=lambda person: person.last_speak_probability)
+        if self.speaker_selection == RANDOM_SPEAKER:
+            return random.choice(speakers)
+        return speakers[0]
+
+    def _generate_answer(self, person) -> Optional[ChatEntry]:
+        return self._append(person.generate_answer(self.experiment.scenario, self.chat_room))
+
+    def _append(self, new_chat_entry: Optional[ChatEntry]) -> Optional[ChatEntry]:
+        if new_chat_entry is not None:
+            self.chat_room.append(new_chat_entry)
+            log.info(new_chat_entry)
+        return new_chat_entry
@@ -0,0 +1,51 @@
+from __future__ import annotations
+
+from collections.abc import Sequence
+from itertools import chain, islice
+from typing import Iterable, Iterator, TYPE_CHECKING, Union
+
+if TYPE_CHECKING:
+    from session_rooms.ChatEntry import ChatEntry
+
+
+class TranscriptView(Sequence):
+    """
+    A read only view over a chat history, with extra entries added at its end.
+
+    The view does not copy the history, so creating it costs O(1) memory no matter how long the
+    history is. The length of the base history is captured when the view is created, so entries
+    appended to the base afterwards are not part of the view.
+    Persons can use it like a list of `ChatEntry`.
+    """
+    __slots__ = ("_base", "_base_len", "_overlay")
+
+    def __init__(self, base: Sequence[ChatEntry], overlay: Iterable[ChatEntry] = ()):
+        self._base = base
+        self._base_len = len(base)
+        self._overlay = tuple(overlay)
+
+    def __len__(self) -> int:
+        return self._base_len + len(self._overlay)
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("transcript index out of range")
+        if index < self._base_len:
+            return self._base[index]
+        return self._overlay[index - self._base_len]
+
+    def __iter__(self) -> Iterator[ChatEntry]:
+        return chain(islice(self._base, self._base_len), self._overlay)
+
+    def __add__(self, other: Iterable[ChatEntry]) -> TranscriptView:
+        """ Returns a new view with `other` added after the current overlay. """
+        view = TranscriptView(self._base, self._overlay + tuple(other))
+        view._base_len = self._base_len
+        return view
+
+    def __repr__(self):
+        return f"TranscriptView({list(self)!r})"